@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the large-batch mode of the cross-validation scripts.
+The scripts train on batches of 4 instances, which leaves most of the
+vectorization of the CPU unused. With the setting 'batch_size' (e.g.
+CCNN_BATCH_SIZE=32, see 'ccnn_options.py'), a script trains on larger batches
+with the learning rate and the number of training steps scaled to the batch
+size (k times larger batches than 4):
+
+- the learning rate is multiplied by sqrt(k) (setting 'lr_scaling': 'sqrt', the
+  rule suited to Adam), by k ('linear') or kept ('none'),
+- the number of steps is divided by k, so that every instance is seen as many
+  times as with batches of 4 (multiplied further by the setting
+  'steps_fraction', e.g. 0.5 to train for half as many epochs),
+- the learning rate is increased linearly from 0 during the first steps
+  (setting 'warmup_fraction', the fraction of the steps, by default 0.05 for
+  batches larger than 4, 0 = no warmup).
+
+With batches of 4 (and no setting given), the scripts train exactly as before.
+Running this module as a script measures the throughput of the training step of
+a condition for each batch size (instances per second, on synthetic data), or
+runs a cross-validation script for each batch size (and fraction of steps) and
+reports the wall time and the accuracy (or mean absolute error) of each run
+compared with the run with batches of 4, i.e. the time needed to reach the
+accuracy of the baseline:
+
+    python ccnn_batch.py throughput [--conditions ccnn_class_CONVtrainFULLtrain] [--batch-sizes 4 8 16 32 64]
+    python ccnn_batch.py compare ccnn_class_CONVtrainFULLtrain.py [--batch-sizes 4 16 32] [--steps-fractions 1 0.5] [--set target_data=2]
+"""
+# Importing necessary libraries
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+from ccnn_options import ENV_PREFIX, option, option_env
+
+BASE_BATCH_SIZE = 4
+LR_SCALING = ['sqrt', 'linear', 'none']
+
+# %% ####################### Function definitions #############################
+
+# scale_schedule scales the learning rate and the number of training steps of
+# a script to the batch size
+# INPUT: learning_rate: learning rate of the script (batches of 4)
+#        num_steps: number of training steps of the script (batches of 4)
+#        batch_size: batch size used
+# OUTPUT: learning_rate, num_steps: scaled learning rate and number of steps
+#         warmup_steps: number of steps of the warmup of the learning rate
+def scale_schedule(learning_rate, num_steps, batch_size):
+    k = batch_size / float(BASE_BATCH_SIZE)
+    scaling = option('lr_scaling', 'sqrt')
+    if scaling not in LR_SCALING:
+        raise ValueError("'lr_scaling' must be one of %s, not %r" % (', '.join(LR_SCALING), scaling))
+    if scaling == 'sqrt':
+        learning_rate *= math.sqrt(k)
+    elif scaling == 'linear':
+        learning_rate *= k
+    # The scripts run one step more than a round number (e.g. 5001), so that
+    # the last step is reported
+    num_steps = int(math.ceil((num_steps - 1) / k * float(option('steps_fraction', 1.0)))) + 1
+    warmup_fraction = option('warmup_fraction', 0.05 if k > 1 else 0.0)
+    return learning_rate, num_steps, int(warmup_fraction * num_steps)
+
+# adam_optimizer returns the training op of the scripts: Adam with the given
+# learning rate, increased linearly from 0 during the warmup steps
+def adam_optimizer(loss, learning_rate, warmup_steps=0):
+    import tensorflow as tf
+    if not warmup_steps:
+        return tf.train.AdamOptimizer(learning_rate).minimize(loss)
+    global_step = tf.train.get_or_create_global_step()
+    rate = learning_rate * tf.minimum(1.0, tf.cast(global_step + 1, tf.float32) / warmup_steps)
+    return tf.train.AdamOptimizer(rate).minimize(loss, global_step=global_step)
+
+# throughput measures the training step of a condition for a batch size
+# OUTPUT: instances per second
+def throughput(condition, batch_size, num_roi=111, num_steps=100):
+    from ccnn_session import CONDITIONS, benchmark_step
+    task, train_layers = CONDITIONS[condition]
+    _, seconds = benchmark_step(task, train_layers, False, num_roi, num_steps, batch_size=batch_size)
+    return batch_size / seconds
+
+# run_condition runs a cross-validation script with a batch size and fraction
+# of steps (output written into a log file), and reads its results from the
+# results store (see ccnn_results.py)
+# INPUT: script: name of the script
+#        batch_size, steps_fraction: settings of the run
+#        options: other settings of the script (e.g. {'target_data': 2})
+# OUTPUT: dictionary of the settings, the wall time and the performance
+#         (accuracy in % or mean absolute error) of the run
+def run_condition(script, batch_size, steps_fraction=1.0, options=None):
+    from ccnn_results import performance, query
+    settings = dict(options or {}, batch_size=batch_size, steps_fraction=steps_fraction)
+    run_tag = 'batch%d_steps%g_%d' % (batch_size, steps_fraction, int(time.time()))
+    env = dict(os.environ)
+    env.update(option_env(settings))
+    env[ENV_PREFIX + 'RUN_TAG'] = run_tag
+    log_file = 'ccnn_batch_%s.log' % run_tag
+    start = time.time()
+    with open(log_file, 'w') as log:
+        returncode = subprocess.call([sys.executable, script], env=env, stdout=log, stderr=subprocess.STDOUT)
+    seconds = time.time() - start
+    if returncode != 0:
+        raise RuntimeError('%s failed with batch size %d (see %s)' % (script, batch_size, log_file))
+    rows = query(run_tag=run_tag)
+    return {'batch_size': batch_size, 'steps_fraction': steps_fraction, 'run_tag': run_tag,
+            'seconds': seconds, 'classification': bool(rows['prediction'].shape[1] > 1),
+            'performance': float(performance(rows['label'], rows['prediction']))}
+
+# compare_runs compares the runs with the baseline run (batches of 4, all
+# steps): speedup, difference of performance, and whether the performance is
+# equal to that of the baseline (within the tolerance: percentage points of
+# accuracy, or years of mean absolute error)
+def compare_runs(runs, tolerance):
+    baseline = [run for run in runs if run['batch_size'] == BASE_BATCH_SIZE and run['steps_fraction'] == 1.0][0]
+    for run in runs:
+        run['speedup'] = baseline['seconds'] / run['seconds']
+        run['difference'] = run['performance'] - baseline['performance']
+        if run['classification']:
+            run['equal'] = run['difference'] >= -tolerance
+        else:
+            run['equal'] = run['difference'] <= tolerance
+    equal = [run for run in runs if run['equal']]
+    return min(equal, key=lambda run: run['seconds'])
+
+# %% ##################### Comparing batch sizes ##############################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Large-batch mode of the cross-validation scripts.')
+    parser.add_argument('command', choices=['throughput', 'compare'])
+    parser.add_argument('script', nargs='?', default=None, help='compare: cross-validation script')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[4, 8, 16, 32, 64])
+    parser.add_argument('--steps-fractions', type=float, nargs='+', default=[1.0],
+                        help='compare: fractions of the scaled number of steps')
+    parser.add_argument('--set', nargs='+', default=[], metavar='NAME=VALUE',
+                        help='compare: other settings of the script (JSON values)')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='compare: tolerated loss of accuracy (percentage points, default 1) '
+                             'or increase of MAE (years, default 0.5)')
+    parser.add_argument('--conditions', nargs='+', default=['ccnn_class_CONVtrainFULLtrain'],
+                        help='throughput: conditions (see ccnn_session.py)')
+    parser.add_argument('--rois', type=int, default=111)
+    parser.add_argument('--steps', type=int, default=100, help='throughput: timed training steps')
+    args = parser.parse_args()
+
+    if args.command == 'throughput':
+        print('%-42s %6s %14s %8s' % ('condition', 'batch', 'instances/s', 'speedup'))
+        for condition in args.conditions:
+            base = None
+            for batch_size in args.batch_sizes:
+                rate = throughput(condition, batch_size, args.rois, args.steps)
+                base = base or rate
+                print('%-42s %6d %14.1f %8.2f' % (condition, batch_size, rate, rate / base))
+        sys.exit(0)
+
+    if args.script is None:
+        parser.error('compare needs the script of a cross-validation condition')
+    options = dict((item.split('=', 1)[0], json.loads(item.split('=', 1)[1])) for item in args.set)
+    batch_sizes = sorted(set([BASE_BATCH_SIZE] + args.batch_sizes))
+    runs = []
+    for batch_size in batch_sizes:
+        for steps_fraction in (args.steps_fractions if batch_size != BASE_BATCH_SIZE else [1.0]):
+            print('Running %s with batches of %d (%g of the steps) ...' % (args.script, batch_size, steps_fraction))
+            runs.append(run_condition(args.script, batch_size, steps_fraction, options))
+    classification = runs[0]['classification']
+    tolerance = args.tolerance if args.tolerance is not None else (1.0 if classification else 0.5)
+    fastest = compare_runs(runs, tolerance)
+
+    metric = 'accuracy' if classification else 'MAE'
+    print('\n%6s %8s %10s %10s %10s %8s %6s' % ('batch', 'steps', 'time (s)', metric, 'diff', 'speedup', 'equal'))
+    for run in runs:
+        print('%6d %8g %10.0f %10.2f %+10.2f %8.2f %6s' % (
+            run['batch_size'], run['steps_fraction'], run['seconds'], run['performance'], run['difference'],
+            run['speedup'], 'yes' if run['equal'] else 'no'))
+    print('\nFastest configuration reaching the %s of batches of %d: batches of %d, %g of the steps '
+          '(%.0f s, %.2fx)' % (metric, BASE_BATCH_SIZE, fastest['batch_size'], fastest['steps_fraction'],
+                               fastest['seconds'], fastest['speedup']))
+    report_file = 'ccnn_batch_%s.json' % os.path.splitext(os.path.basename(args.script))[0]
+    with open(report_file, 'w') as f:
+        json.dump({'script': args.script, 'options': options, 'tolerance': tolerance, 'runs': runs},
+                  f, indent=1, sort_keys=True)
+    print('Report saved into %s' % report_file)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+This script computes the functional connectivity matrices of subjects from their
+ROI time series and appends them to a tensor store (see 'ccnn_tensor_store.py')
+used by the training scripts. Each input file holds the time series of one
+subject (time points in rows, ROIs in columns; .npy, .csv or whitespace
+delimited text). The subject ID is the first number found in the file name.
+
+Pearson correlation matrices (optionally Fisher z-transformed) are computed
+with batched matrix products for chunks of subjects, the chunks are processed
+in parallel by a pool of worker processes and appended to the store as soon as
+they are ready, so that only a few chunks are held in memory at a time. Subjects
+already present in the store are skipped, thus new subjects can be added to an
+existing dataset without recomputing it. The scripts pair the instances with
+the rows of the labels file by position, thus with --labels the subjects are
+appended in the order of the first column of the labels file (files of subjects
+missing from it are left out); otherwise they are appended in the order of the
+file names. Usage:
+
+    python ccnn_build_connectivity.py CORR_tensor_inhouse timeseries/*.txt [--labels labels_inhouse.txt] [--fisher-z] [--workers 4] [--chunk-size 32]
+"""
+# Importing necessary libraries
+import argparse
+import multiprocessing
+import os
+import re
+
+import numpy as np
+from ccnn_tensor_store import append_chunk, create_store, is_store, read_index, store_subjects
+
+# %% ####################### Function definitions #############################
+
+# subject_id extracts the subject ID from the name of a time series file
+def subject_id(filename):
+    match = re.search(r'\d+', os.path.basename(filename))
+    if match is None:
+        raise ValueError('no subject ID in file name %s' % filename)
+    return float(match.group())
+
+# load_timeseries reads the ROI time series of a subject
+# OUTPUT: 2D tensor (np.array) [time points, ROIs]
+def load_timeseries(filename, transpose=False):
+    if filename.endswith('.npy'):
+        timeseries = np.load(filename)
+    elif filename.endswith('.csv'):
+        timeseries = np.loadtxt(filename, delimiter=',')
+    else:
+        timeseries = np.loadtxt(filename)
+    if transpose:
+        timeseries = timeseries.T
+    return timeseries.astype(np.float64)
+
+# correlation_matrices computes the Pearson correlation matrices of a batch of
+# subjects with the same number of time points via a single batched matrix
+# product. ROIs with constant time series yield NaNs (as in the old data files).
+# INPUT: timeseries: 3D tensor (np.array) [subjects, time points, ROIs]
+#        fisher_z: if True, correlations are Fisher z-transformed (the diagonal
+#                  is set to 0)
+# OUTPUT: 3D tensor (np.array) [subjects, ROIs, ROIs]
+def correlation_matrices(timeseries, fisher_z=False):
+    centered = timeseries - np.mean(timeseries, axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centered /= np.sqrt(np.sum(np.square(centered), axis=1, keepdims=True))
+        corr = np.matmul(np.transpose(centered, (0, 2, 1)), centered)
+        np.clip(corr, -1.0, 1.0, out=corr)
+        if fisher_z:
+            diagonal = np.arange(corr.shape[1])
+            corr[:, diagonal, diagonal] = 0
+            corr = np.arctanh(np.clip(corr, -1.0 + 1e-12, 1.0 - 1e-12))
+    return corr
+
+# build_chunk computes the connectivity matrices of a chunk of subjects (run in
+# the worker processes)
+# INPUT: args: (list of file names, fisher_z, transpose)
+# OUTPUT: 3D tensor (np.array) [subjects, ROIs, ROIs] (float32), subject IDs
+def build_chunk(args):
+    filenames, fisher_z, transpose = args
+    series = [load_timeseries(filename, transpose) for filename in filenames]
+    num_roi = series[0].shape[1]
+    corr = np.empty((len(series), num_roi, num_roi), dtype=np.float32)
+    # Subjects with equal scan lengths are processed as one batch
+    lengths = np.array([s.shape[0] for s in series])
+    for length in np.unique(lengths):
+        members = np.where(lengths == length)[0]
+        corr[members] = correlation_matrices(np.stack([series[k] for k in members]), fisher_z)
+    return corr, [subject_id(filename) for filename in filenames]
+
+# %% ####################### Building the tensor store ########################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Append connectivity matrices computed '
+                                                 'from ROI time series to a tensor store.')
+    parser.add_argument('store', help="tensor store, e.g. 'CORR_tensor_inhouse'")
+    parser.add_argument('files', nargs='+', help='ROI time series files, one per subject')
+    parser.add_argument('--labels', help='labels file giving the order of the subjects (first column)')
+    parser.add_argument('--fisher-z', action='store_true', help='Fisher z-transform the correlations')
+    parser.add_argument('--transpose', action='store_true', help='files hold ROIs in rows')
+    parser.add_argument('--chunk-size', type=int, default=32, help='subjects per chunk')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    # Ordering the subjects as in the labels file
+    filenames = sorted(args.files)
+    if args.labels:
+        order = dict((s, k) for k, s in enumerate(np.loadtxt(args.labels, delimiter=',')[:, 0]))
+        missing = [f for f in filenames if subject_id(f) not in order]
+        if missing:
+            print('%d files of subjects not in %s, leaving them out' % (len(missing), args.labels))
+        filenames = sorted((f for f in filenames if subject_id(f) in order), key=lambda f: order[subject_id(f)])
+
+    # Skipping subjects that are already in the store
+    if is_store(args.store):
+        existing = set(store_subjects(args.store))
+        skipped = [f for f in filenames if subject_id(f) in existing]
+        filenames = [f for f in filenames if subject_id(f) not in existing]
+        if skipped:
+            print('%d subjects already in %s, skipping them' % (len(skipped), args.store))
+    if not filenames:
+        print('Nothing to do.')
+        raise SystemExit(0)
+
+    if not is_store(args.store):
+        num_roi = load_timeseries(filenames[0], args.transpose).shape[1]
+        create_store(args.store, num_roi)
+    num_roi = read_index(args.store)['num_roi']
+
+    chunks = [(filenames[k:(k + args.chunk_size)], args.fisher_z, args.transpose)
+              for k in range(0, len(filenames), args.chunk_size)]
+    pool = multiprocessing.Pool(max(1, args.workers))
+    try:
+        # Chunks are appended in order, as soon as they are computed
+        for k, (corr, subjects) in enumerate(pool.imap(build_chunk, chunks)):
+            if corr.shape[1] != num_roi:
+                raise ValueError('chunk %d has %d ROIs, the store has %d' % (k, corr.shape[1], num_roi))
+            append_chunk(args.store, corr, subjects)
+            print('Chunk %d/%d appended (%d subjects)' % (k+1, len(chunks), len(subjects)))
+    finally:
+        pool.terminate()
+    print('%s holds %d instances' % (args.store, read_index(args.store)['num_instances']))
@@ -32,55 +32,50 @@ target_data = 1   # 1 = in-house dataset
 # %% ########################### Loading data #################################
 
 # Importing necessary libraries
+from ccnn_session import apply_threads
+apply_threads()   # before NumPy is imported (BLAS threads, see ccnn_session.py)
 import numpy as np
-import tensorflow as tf
-from six.moves import cPickle as pickle
-
-# loading the correlation matrices
+from ccnn_memory import MemoryMonitor
+from ccnn_options import option, output_name
+from ccnn_results import append_results, dataset_name
+from ccnn_tensor_store import check_subjects, load_normalized_tensor
+from ccnn_inference import predict
+from ccnn_weight_bank import bank_weights
+
+# The settings selected above can be overridden by the experiment scheduler
+# (see ccnn_scheduler.py and ccnn_options.py)
+target_data = option('target_data', target_data)
+
+# Memory use of the phases of the script is written into the run log (see
+# ccnn_memory.py); NaNs are replaced and data are normalized while loading
+memory = MemoryMonitor('ccnn_class_CONVconstFULLconst')
+memory.phase('load')
+
+# Loading the correlation matrices (see ccnn_tensor_store.py)
 if target_data == 1:
-    picklefile = "CORR_tensor_inhouse.pickle"
+    tensor_store = "CORR_tensor_inhouse"
 elif target_data == 2:
-    picklefile = "CORR_tensor_NKI-RS_subset.pickle"
-
-with open(picklefile, 'rb') as f:
-    save = pickle.load(f)
-    data_tensor = save['data_tensor']
-    del save
+    tensor_store = "CORR_tensor_NKI-RS_subset"
 
-data_tensor = data_tensor.astype(np.float32)
+# NaNs are replaced with 0s and data are normalized using the statistics
+# stored with the dataset (see ccnn_preprocess.py)
+data_tensor, data_stats = load_normalized_tensor(tensor_store)
 
 # Loading labels
 if target_data == 1:
     labels_csv = np.loadtxt("labels_inhouse.txt", delimiter=',')                              
 elif target_data == 2:
     labels_csv = np.loadtxt("labels_NKI-RS_subset.csv", delimiter=',')
+check_subjects(tensor_store, labels_csv[:, 0])   # rows of the store and of the labels file must match
 labels = labels_csv[:, 1]
 
 # Loading weights
-picklefile = "weights_public.pickle"
-with open(picklefile, 'rb') as f:
-    save = pickle.load(f)
-    layer1_weights_age = save['layer1_weights']
-    layer1_biases_age = save['layer1_biases']
-    layer2_weights_age = save['layer2_weights']
-    layer2_biases_age = save['layer2_biases']
-    layer3_weights_age = save['layer3_weights']
-    layer3_biases_age = save['layer3_biases']
-    layer4_weights_age = save['layer4_weights']
-    layer4_biases_age = save['layer4_biases']
-    del save    
+weights = bank_weights("weights_public")
 
 # %% ####################### Function definitions #############################
 # Define functions for tensor randomization, normalization, and performance 
 # calculation
 
-# normalize_tensor standardizes an n dimesional np.array to have zero mean and 
-# standard deviation of 1
-def normalize_tensor(data_tensor):
-    data_tensor -= np.mean(data_tensor)
-    data_tensor /= np.max(np.abs(data_tensor))
-    return data_tensor
-
 # randomize_tensor generates a random permutation of instances and the 
 # corresponding labels before training
 # INPUT: dataset: 4D tensor (np.array), instances are concatenated along the 
@@ -111,73 +106,34 @@ def accuracy(predictions, labels):
     return (100.0 * np.sum(np.argmax(predictions, 1) == np.argmax(labels, 1))
             / predictions.shape[0])
   
-# %% ###### Preparing the test set and initializing network parameters ########
+# %% ######################## Evaluating the network ##########################
 
-keep_pr = 0.6 # the probability that each element is kept during dropout
-
-# Replacing NaNs with 0s and normalizing test data
-data_tensor[np.isnan(data_tensor)] = 0
-test_data = normalize_tensor(data_tensor)
+# NaNs were replaced with 0s and data were normalized at loading time
+test_data = data_tensor
 
 # One-hot encoded test labels
 num_labels = len(np.unique(labels))
 test_labels = (np.arange(num_labels) == labels[:,None]).astype(np.float32)
 
-# %% ####################### launching TensorFlow #############################
-
-# Drawing the computational graph    
-graph = tf.Graph()
-    
-with graph.as_default():
-    
-    # Input data placeholders and constants
-    tf_test_dataset = tf.constant(test_data)
-      
-    # Weights and baises are constants
-    layer1_weights = tf.constant(layer1_weights_age, name="layer1_weights")
-    layer1_biases = tf.constant(layer1_biases_age, name="layer1_biases")
-    layer2_weights = tf.constant(layer2_weights_age, name="layer2_weights")
-    layer2_biases = tf.constant(layer2_biases_age, name="layer2_biases")
-    layer3_weights = tf.constant(layer3_weights_age, name="layer3_weights")
-    layer3_biases = tf.constant(layer3_biases_age, name="layer3_biases")
-    layer4_weights = tf.constant(layer4_weights_age, name="layer4_weights")
-    layer4_biases = tf.constant(layer4_biases_age, name="layer4_biases")
-        
-    # Convolutional network architecture
-    def model(data, keep_pr):
-        # First layer: line-by-line convolution with ReLU and dropout
-        conv = tf.nn.conv2d(data, layer1_weights, [1, 1, 1, 1], padding='VALID')
-        hidden = tf.nn.dropout(tf.nn.relu(conv+layer1_biases), keep_pr)
-        # Second layer: convolution by column with ReLU and dropout
-        conv = tf.nn.conv2d(hidden, layer2_weights, [1, 1, 1, 1], padding='VALID')
-        hidden = tf.nn.dropout(tf.nn.relu(conv+layer2_biases), keep_pr)
-        # Third layer: fully connected hidden layer with dropout and ReLU
-        shape = hidden.get_shape().as_list()
-        reshape = tf.reshape(hidden, [shape[0], shape[1] * shape[2] * shape[3]])
-        hidden = tf.nn.dropout(tf.nn.relu(tf.matmul(reshape, layer3_weights) + layer3_biases), keep_pr)
-        # Fourth (output) layer: fully connected layer with logits as output
-        return tf.matmul(hidden, layer4_weights) + layer4_biases
-      
-    # Calculate predictions from test data (keep_pr of dropout is 1!)
-    test_prediction = tf.nn.softmax(model(tf_test_dataset, 1))
-    
-# Start TensorFlow session
-with tf.Session(graph=graph) as session:
-    
-    # Initializing variables     
-    tf.global_variables_initializer().run()
-    print('\nVariables initialized ...')
-    
-    # Calculating test predictions    
-    test_pred = test_prediction.eval()
+# All weights and bias terms are constants, thus the predictions are computed
+# in NumPy (see ccnn_inference.py) without building a TensorFlow graph
+memory.phase('eval')
+test_pred = predict(test_data, weights)
 
 # Calculate final accuracy    
 print('\nOverall test accuracy: %.1f%%' % accuracy(test_pred, test_labels))
     
+memory.phase('save')
 # Saving results
 if target_data == 1:
-    np.savez("results_ccnn_class_CONVconstFULLconst_inhouse.npz", \
+    np.savez(output_name("results_ccnn_class_CONVconstFULLconst_inhouse.npz"), \
         labels=test_labels, predictions=test_pred)
 elif target_data == 2:
-    np.savez("results_ccnn_class_CONVconstFULLconst_NKI-RS_subset.npz", \
-        labels=test_labels, predictions=test_pred)
\ No newline at end of file
+    np.savez(output_name("results_ccnn_class_CONVconstFULLconst_NKI-RS_subset.npz"), \
+        labels=test_labels, predictions=test_pred)
+# ... and to the results store (see ccnn_results.py)
+append_results("class_CONVconstFULLconst", dataset_name(target_data), None, labels_csv[:, 0],
+               test_labels, test_pred)
+
+# Memory use of the phases (peaks and optional report, see ccnn_memory.py)
+memory.end()
@@ -43,68 +43,94 @@ initmode = 2 # 1 = Randomly initializing the weights and bias terms of the fully
 target_data = 1   # 1 = in-house dataset
                   # 2 = NKI-RS subset
                   
+# The column convolution (second layer) can be factorized into two convolutions
+# of lower rank, initialized by truncated SVD of the pretrained weights (see
+# ccnn_compress.py), which makes the transfer runs faster and lighter.
+layer2_rank = None  # None = full column convolution
+                    # k = rank-k factorization (e.g. 32)
+
+# The column convolution and the first fully connected layer can be pruned
+# gradually during training in each fold (the rows of weights of smallest
+# magnitude, see ccnn_prune.py), the pruned weights being stored in a sparse
+# format.
+prune_sparsity = None  # None = no pruning
+                       # s = fraction of the rows pruned (e.g. 0.8)
+
 # %% ############################ Loading data ################################
 
 # Importing necessary libraries
+from ccnn_session import apply_threads, session_config
+apply_threads()   # before NumPy is imported (BLAS threads, see ccnn_session.py)
 import numpy as np
-import tensorflow as tf
-from six.moves import cPickle as pickle
+from ccnn_memory import MemoryMonitor
+from ccnn_options import option, output_name
+from ccnn_batch import adam_optimizer, scale_schedule
+from ccnn_folds import load_folds
+from ccnn_compress import factorize_layer2
+from ccnn_profile import StepProfiler
+from ccnn_prune import GradualPruner, sparse_weights
+from ccnn_results import append_results, dataset_name
+from ccnn_telemetry import Telemetry
+from ccnn_tensor_store import check_subjects, load_normalized_tensor
+from ccnn_weight_bank import bank_weights
+from ccnn_weights import create_archive, save_fold_weights
+
+# The settings selected above can be overridden by the experiment scheduler
+# (see ccnn_scheduler.py and ccnn_options.py)
+initmode = option('initmode', initmode)
+target_data = option('target_data', target_data)
+layer2_rank = option('layer2_rank', layer2_rank)
+prune_sparsity = option('prune_sparsity', prune_sparsity)
+seed = option('seed', None)   # random seed of the run (None = not seeded)
+if seed is not None:
+    np.random.seed(seed)
+
+# Memory use of the phases of the script is written into the run log (see
+# ccnn_memory.py); NaNs are replaced and data are normalized while loading
+memory = MemoryMonitor('ccnn_class_CONVinitFULLtrain_FULLinit')
+memory.phase('load')
 
-# loading the correlation matrices
+# Loading the correlation matrices (see ccnn_tensor_store.py)
 if target_data == 1:
-    picklefile = "CORR_tensor_inhouse.pickle"
+    tensor_store = "CORR_tensor_inhouse"
 elif target_data == 2:
-    picklefile = "CORR_tensor_NKI-RS_subset.pickle"
-    
-with open(picklefile, 'rb') as f:
-    save = pickle.load(f)
-    data_tensor = save['data_tensor']
-    del save
+    tensor_store = "CORR_tensor_NKI-RS_subset"
+
+# NaNs are replaced with 0s and data are normalized using the statistics
+# stored with the dataset (see ccnn_preprocess.py)
+data_tensor, data_stats = load_normalized_tensor(tensor_store)
 
 # Loading labels
 if target_data == 1:
     labels_csv = np.loadtxt("labels_inhouse.txt", delimiter=',')                              
 elif target_data == 2:
     labels_csv = np.loadtxt("labels_NKI-RS_subset.csv", delimiter=',')
+check_subjects(tensor_store, labels_csv[:, 0])   # rows of the store and of the labels file must match
 labels = labels_csv[:, 1]
     
 subjectIDs = labels_csv[:, 0]
 
-# Loading weights
-picklefile = "weights_public.pickle"
-with open(picklefile, 'rb') as f:
-    save = pickle.load(f)
-    layer1_weights_age = save['layer1_weights']
-    layer1_biases_age = save['layer1_biases']
-    layer2_weights_age = save['layer2_weights']
-    layer2_biases_age = save['layer2_biases']
-    if initmode == 2:
-        layer3_weights_age = save['layer3_weights']
-        layer3_biases_age = save['layer3_biases']
-        layer4_weights_age = save['layer4_weights']
-        layer4_biases_age = save['layer4_biases']
-    del save    
+# Loading weights (the fully connected layers are only needed if initmode == 2)
+weights = bank_weights("weights_public")
+layer1_weights_age = weights['layer1_weights']
+layer1_biases_age = weights['layer1_biases']
+layer2_weights_age = weights['layer2_weights']
+layer2_biases_age = weights['layer2_biases']
+if initmode == 2:
+    layer3_weights_age = weights['layer3_weights']
+    layer3_biases_age = weights['layer3_biases']
+    layer4_weights_age = weights['layer4_weights']
+    layer4_biases_age = weights['layer4_biases']
+del weights
+
+# Low-rank factors of the column convolution
+if layer2_rank is not None:
+    layer2_weights_u_age, layer2_weights_v_age = factorize_layer2(layer2_weights_age, layer2_rank)
 
 # %% ####################### Function definitions #############################
 # Define functions for cross-validation, tensor randomization and normalization 
 # and performance calculation
 
-# create_train_and_test_folds randomly divides subjectIDs stored in subjects to 
-# num_folds sets
-# INPUT: num_folds: number of folds in cross-validation (integer)
-#        subjects: list of unique subject IDs
-# OUTPUT: IDs: array storing unique subject IDs with num_folds columns: 
-#              each column contains IDs of test subjects of the given fold
-def create_train_and_test_folds(num_folds, subjects):                          
-    n = np.ceil(len(subjects)/num_folds).astype(np.int)
-    np.random.shuffle(subjects)
-    if len(subjects) != n*num_folds:
-        s = np.zeros(n*num_folds)
-        s[:len(subjects)] = subjects
-        subjects = s
-    IDs = subjects.reshape((n, num_folds))
-    return IDs
-
 # normalize_tensor standardizes an n dimesional np.array to have zero mean and 
 # standard deviation of 1
 def normalize_tensor(data_tensor):
@@ -133,9 +159,8 @@ def randomize_tensor(dataset, labels):
 # create_train_and_test_data creates and prepares training and test datasets and 
 # labels for a given fold of cross-validation
 # INPUT: fold: number of the given fold (starting from 0)
-#        IDs: array storing unique subject IDs with num_folds columns: each 
-#             column contains IDs of test subjects of the given fold 
-#             (output of reate_train_and_test_folds)
+#        test_rows: list of the row indices of the test instances of each
+#                   fold (see load_folds in ccnn_folds.py)
 #        subjectIDs: list of subject IDs corresponding to the order of instances 
 #                    stored in the dataset (ID of the same subject might appear 
 #                    more than once)
@@ -151,13 +176,14 @@ def randomize_tensor(dataset, labels):
 #                    test instances of the given fold
 #         test_labels: 2D tensor (np.array), storing labels of instances in 
 #                      test_data in one-hot encoding
-def create_train_and_test_data(fold, IDs, subjectIDs, labels, data_tensor):    
+def create_train_and_test_data(fold, test_rows, subjectIDs, labels, data_tensor):    
     #create one-hot encoding of labels
     num_labels = len(np.unique(labels))
     labels = (np.arange(num_labels) == labels[:,None]).astype(np.float32)
     
-    #identify the IDs of test subjects
-    testIDs = np.in1d(subjectIDs, IDs[:,fold])
+    #select the test instances of the fold
+    testIDs = np.zeros(len(subjectIDs), dtype=bool)
+    testIDs[test_rows[fold]] = True
         
     test_data = normalize_tensor(data_tensor[testIDs,:,:,:]).astype(np.float32)
     test_labels = labels[testIDs]
@@ -182,24 +208,26 @@ def accuracy(predictions, labels):
   
 # %% ####### Preparing the data and initializing network parameters ###########
 
-numROI = 111
+numROI = data_tensor.shape[1]   # number of ROIs of the atlas, read from the dataset
 num_channels = 1
 num_labels = 2
 image_size = numROI
-batch_size = 4
+batch_size = option('batch_size', 4)   # larger batches: see ccnn_batch.py
 patch_size = image_size
 keep_pr = 0.6   # the probability that each element is kept during dropout
-num_folds = 10
 
-# Replacing NaNs with 0s and normalizing data
-data_tensor[np.isnan(data_tensor)] = 0
-data_tensor = normalize_tensor(data_tensor)
+# The pretrained network has to be defined on the same atlas as the dataset
+if layer2_weights_age.shape[0] != numROI:
+    raise ValueError('the pretrained weights are defined on %d ROIs, the dataset has %d ROIs'
+                     % (layer2_weights_age.shape[0], numROI))
 
-# Loading folds
+# Loading folds (the test instances of each fold are looked up once; a repeat
+# of a fold plan is used instead if 'fold_plan' is set, see ccnn_folds.py)
 if target_data == 1:
-    IDs = np.load('folds_inhouse.npy')
+    IDs, test_rows = load_folds('folds_inhouse.npy', subjectIDs)
 elif target_data == 2:
-    IDs = np.load('folds_NKI-RS_subset.npy')
+    IDs, test_rows = load_folds('folds_NKI-RS_subset.npy', subjectIDs)
+num_folds = len(test_rows)   # number of folds in cross-validation
 
 # Variables to store test labels and predictions later on
 test_labs = []
@@ -207,31 +235,54 @@ test_preds = []
 
 # %% ######################### launch TensorFlow ##############################
 
-# Preallocating arrays to save weights & biases
-layer1_weights_save = np.zeros([num_folds, 1, patch_size, num_channels, 64])
-layer2_weights_save = np.zeros([num_folds, patch_size, 1, 64, 256])
-layer3_weights_save = np.zeros([num_folds, 256, 96])
-layer4_weights_save = np.zeros([num_folds, 96, num_labels])
+# TensorFlow is imported only here, where the computational graph is built
+import tensorflow as tf
+
+# Weights & biases are saved into an archive as soon as each fold is finished
+if initmode == 1:
+    weight_filename = "weights_ccnn_class_CONViniFULLtrain"
+elif initmode == 2:
+    weight_filename = "weights_ccnn_class_CONVinitFULLinit"
+
+if target_data == 1:
+    weight_archive = weight_filename + "_inhouse"
+elif target_data == 2:
+    weight_archive = weight_filename + "_NKI-RS_subset"
+weight_archive = output_name(weight_archive)
+# The weights of the folds are stored relative to the pretrained weights
+# (see ccnn_weights.py)
+create_archive(weight_archive, num_folds, base="weights_public")
 
-layer1_biases_save = np.zeros([num_folds, 64])
-layer2_biases_save = np.zeros([num_folds, 256])
-layer3_biases_save = np.zeros([num_folds, 96])
-layer4_biases_save = np.zeros([num_folds, num_labels])
+# Test results of each fold are appended to the results store (see ccnn_results.py)
+if initmode == 1:
+    results_condition = "class_CONVinitFULLtrain"
+elif initmode == 2:
+    results_condition = "class_CONVinitFULLinit"
+results_dataset = dataset_name(target_data)
 
 # Iterating over folds
 for i in range(num_folds):
     
+    memory.phase('fold%d/prep' % (i+1))
+    memory.require(2 * data_tensor.nbytes, 'normalized train and test copies')
+    
     # Creating train and test data for the given fold
     train_data, train_labels, test_data, test_labels = \
-    create_train_and_test_data(i, IDs, subjectIDs, labels, data_tensor)
+    create_train_and_test_data(i, test_rows, subjectIDs, labels, data_tensor)
         
     train_data = train_data[:, :image_size, :image_size, :]
     test_data = test_data[:, :image_size, :image_size, :]
     
+    memory.phase('fold%d/graph' % (i+1))
+    memory.require(2 * test_data.nbytes, 'test set constant of the graph')
+    
     # Defining the computational graph
     graph = tf.Graph()
     
     with graph.as_default():
+        # Graph-level random seed of the fold (initialization, dropout)
+        if seed is not None:
+            tf.set_random_seed(seed + i)
     
         # Input data placeholders
         tf_train_dataset = tf.placeholder(tf.float32, shape=(batch_size, image_size, image_size, num_channels))
@@ -245,7 +296,11 @@ for i in range(num_folds):
         # values.
         layer1_weights = tf.Variable(layer1_weights_age, name="layer1_weights")
         layer1_biases = tf.Variable(layer1_biases_age, name="layer1_biases")
-        layer2_weights = tf.Variable(layer2_weights_age, name="layer2_weights")
+        if layer2_rank is None:
+            layer2_weights = tf.Variable(layer2_weights_age, name="layer2_weights")
+        else:
+            layer2_weights_u = tf.Variable(layer2_weights_u_age, name="layer2_weights_u")
+            layer2_weights_v = tf.Variable(layer2_weights_v_age, name="layer2_weights_v")
         layer2_biases = tf.Variable(layer2_biases_age, name="layer2_biases")
         # Weights and biases of the fully connected layers are trainable: 
         if initmode == 1:
@@ -262,14 +317,30 @@ for i in range(num_folds):
             layer3_biases = tf.Variable(layer3_biases_age, name="layer3_biases")
             layer4_weights = tf.Variable(layer4_weights_age, name="layer4_weights")
             layer4_biases = tf.Variable(layer4_biases_age, name="layer4_biases")
+
+        # The model uses the masked weights of the pruned layers
+        # (see ccnn_prune.py)
+        if prune_sparsity is not None:
+            pruned_layers = {'layer3_weights': layer3_weights}
+            if layer2_rank is None:
+                pruned_layers['layer2_weights'] = layer2_weights
+            pruner = GradualPruner(pruned_layers, prune_sparsity)
+            layer3_weights = pruner.masked['layer3_weights']
+            if layer2_rank is None:
+                layer2_weights = pruner.masked['layer2_weights']
             
         # Convolutional network architecture
         def model(data, keep_pr):
             # First layer: line-by-line convolution with ReLU and dropout
             conv = tf.nn.conv2d(data, layer1_weights, [1, 1, 1, 1], padding='VALID')
             hidden = tf.nn.dropout(tf.nn.relu(conv+layer1_biases), keep_pr)
-            # Second layer: convolution by column with ReLU and dropout
-            conv = tf.nn.conv2d(hidden, layer2_weights, [1, 1, 1, 1], padding='VALID')
+            # Second layer: convolution by column with ReLU and dropout (two thin
+            # convolutions if the layer is factorized)
+            if layer2_rank is None:
+                conv = tf.nn.conv2d(hidden, layer2_weights, [1, 1, 1, 1], padding='VALID')
+            else:
+                conv = tf.nn.conv2d(hidden, layer2_weights_u, [1, 1, 1, 1], padding='VALID')
+                conv = tf.nn.conv2d(conv, layer2_weights_v, [1, 1, 1, 1], padding='VALID')
             hidden = tf.nn.dropout(tf.nn.relu(conv+layer2_biases), keep_pr)
             # Third layer: fully connected hidden layer with dropout and ReLU
             shape = hidden.get_shape().as_list()
@@ -283,21 +354,25 @@ for i in range(num_folds):
         loss = tf.reduce_mean(
                 tf.nn.softmax_cross_entropy_with_logits(labels=tf_train_labels, logits=logits))
         
-        # Optimizer definition
-        learning_rate = 0.001
-        optimizer = tf.train.AdamOptimizer(learning_rate).minimize(loss) 
+        # Optimizer definition (the learning rate and the number of iterations
+        # are scaled to the batch size, see ccnn_batch.py)
+        learning_rate, num_steps, warmup_steps = scale_schedule(0.001, 5001, batch_size)
+        optimizer = adam_optimizer(loss, learning_rate, warmup_steps)
 
         # Calculate predictions from training data
         train_prediction = tf.nn.softmax(logits)
       
         # Calculate predictions from test data (keep_pr of dropout is 1!)
         test_prediction = tf.nn.softmax(model(tf_test_dataset, 1))
-      
-        # Number of iterations
-        num_steps = 5001
     
+    memory.phase('fold%d/train' % (i+1))
+    # Op-level profiling of a window of training steps (see ccnn_profile.py)
+    profiler = StepProfiler(weight_archive.replace('weights_', 'profile_', 1) + '_fold%d' % (i+1), fold=i)
+    # Training metrics are computed only at the steps reported (see ccnn_telemetry.py)
+    telemetry = Telemetry(weight_archive.replace('weights_', '', 1) + '_fold%d' % (i+1), 500)
+
     # Start TensorFlow session
-    with tf.Session(graph=graph) as session:
+    with tf.Session(graph=graph, config=session_config()) as session:
         
         # Initializing variables
         tf.global_variables_initializer().run()
@@ -319,14 +394,25 @@ for i in range(num_folds):
         
             # Feed batch data to the placeholders
             feed_dict = {tf_train_dataset : batch_data, tf_train_labels : batch_labels}
-            _, l, predictions = session.run(
-                    [optimizer, loss, train_prediction], feed_dict=feed_dict)
+            if telemetry.due(step):
+                _, l, predictions = session.run(
+                        [optimizer, loss, train_prediction], feed_dict=feed_dict, **profiler.run_kwargs(step))
+            else:
+                _, l = session.run([optimizer, loss], feed_dict=feed_dict, **profiler.run_kwargs(step))
+            profiler.record(step)
+            telemetry.add(l)
+            if prune_sparsity is not None:
+                pruner.update(session, step, num_steps)
         
             # At every 500. step give some feedback on the progress
-            if (step % 500 == 0):
-                print('Minibatch loss at step %d: %f' % (step, l))
-                print('Minibatch accuracy: %.1f%%' % accuracy(predictions, batch_labels))
+            if telemetry.due(step):
+                train_accuracy = accuracy(predictions, batch_labels)
+                telemetry.report(step, l, accuracy=train_accuracy)
+                print('Minibatch accuracy: %.1f%%' % train_accuracy)
                 
+        profiler.save()
+
+        memory.phase('fold%d/eval' % (i+1))
         # Evaluate the trained model on the test data in the given fold
         test_pred = test_prediction.eval()
         print('Test accuracy at fold %d: %.1f%%' % (i+1, accuracy(test_pred, test_labels)))
@@ -334,25 +420,37 @@ for i in range(num_folds):
         # Save test predictions and labels of this fold to a list
         test_labs.append(test_labels)
         test_preds.append(test_pred)
+        # ... and to the results store
+        test_instances = test_rows[i]
+        append_results(results_condition, results_dataset, i, subjectIDs[test_instances],
+                       test_labels, test_pred, instances=test_instances, seed=seed)
 
+        memory.phase('fold%d/save' % (i+1))
         # Storing weights & biases
-        layer1_weights_save[i, :, :, :, :] = layer1_weights.eval()
-        layer2_weights_save[i, :, :, :, :] = layer2_weights.eval()
-        layer3_weights_save[i, :, :] = layer3_weights.eval()
-        layer4_weights_save[i, :, :] = layer4_weights.eval()
-        
-        layer1_biases_save[i, :] = layer1_biases.eval()
-        layer2_biases_save[i, :] = layer2_biases.eval()
-        layer3_biases_save[i, :] = layer3_biases.eval()
-        layer4_biases_save[i, :] = layer4_biases.eval()
+        fold_weights = {
+                'layer1_weights': layer1_weights.eval(),
+                'layer1_biases': layer1_biases.eval(),
+                'layer2_biases': layer2_biases.eval(),
+                'layer3_weights': layer3_weights.eval(),
+                'layer3_biases': layer3_biases.eval(),
+                'layer4_weights': layer4_weights.eval(),
+                'layer4_biases': layer4_biases.eval(),
+                }
+        # The factors of the column convolution are stored if it is factorized
+        if layer2_rank is None:
+            fold_weights['layer2_weights'] = layer2_weights.eval()
+        else:
+            fold_weights['layer2_weights_u'] = layer2_weights_u.eval()
+            fold_weights['layer2_weights_v'] = layer2_weights_v.eval()
+        # Pruned layers are stored in the sparse format
+        if prune_sparsity is not None:
+            fold_weights = sparse_weights(fold_weights, list(pruner.masks))
+        save_fold_weights(weight_archive, i, fold_weights)
 
+memory.phase('results')
 # Create np.array to store all predictions and labels
-l = test_labs[0]
-p = test_preds[0]   
-# Iterate through the cross-validation folds    
-for i in range(1, num_folds):
-    l = np.vstack((l, test_labs[i]))
-    p = np.vstack((p, test_preds[i]))
+l = np.vstack(test_labs)
+p = np.vstack(test_preds)
     
 # Calculate final accuracy    
 print('\nOverall test accuracy: %.1f%%' % accuracy(p, l))
@@ -364,37 +462,11 @@ elif initmode == 2:
     result_filename = "results_ccnn_class_CONVinitFULLinit.npz"
 
 if target_data == 1:
-    np.savez(result_filename+"_inhouse.npz", \
+    np.savez(output_name(result_filename+"_inhouse.npz"), \
         labels=l, predictions=p, splits=IDs)
 elif target_data == 2:
-    np.savez(result_filename+"_NKI-RS_subset.npz", \
+    np.savez(output_name(result_filename+"_NKI-RS_subset.npz"), \
         labels=l, predictions=p, splits=IDs)
-    
-# Saving weights and biases
-if initmode == 1:
-    weight_filename = "weights_ccnn_class_CONViniFULLtrain"
-elif initmode == 2:
-    weight_filename = "weights_ccnn_class_CONVinitFULLinit"
 
-if target_data == 1:
-    pickle_file = weight_filename + "_inhouse.pickle"
-elif target_data == 2:
-    pickle_file = weight_filename + "_NKI-RS_subset.pickle"
-
-try:
-    f = open(pickle_file, 'wb')
-    save = {
-            'layer1_weights': layer1_weights_save,
-            'layer1_biases': layer1_biases_save,
-            'layer2_weights': layer2_weights_save,
-            'layer2_biases': layer2_biases_save,
-            'layer3_weights': layer3_weights_save,
-            'layer3_biases': layer3_biases_save,
-            'layer4_weights': layer4_weights_save,
-            'layer4_biases': layer4_biases_save,
-            }
-    pickle.dump(save, f, pickle.HIGHEST_PROTOCOL)
-    f.close()
-except Exception as e:
-    print('Unable to save data to', pickle_file, ':', e)
-    raise
\ No newline at end of file
+# Memory use of the phases (peaks and optional report, see ccnn_memory.py)
+memory.end()
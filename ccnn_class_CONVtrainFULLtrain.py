@@ -29,26 +29,47 @@ target_data = 1   # 1 = in-house dataset
 # %% ########################### Loading data #################################
 
 # Importing necessary libraries
+from ccnn_session import apply_threads, session_config
+apply_threads()   # before NumPy is imported (BLAS threads, see ccnn_session.py)
 import numpy as np
-import tensorflow as tf
-from six.moves import cPickle as pickle
+from ccnn_batch import adam_optimizer, scale_schedule
+from ccnn_folds import load_folds
+from ccnn_memory import MemoryMonitor
+from ccnn_options import option, output_name
+from ccnn_profile import StepProfiler
+from ccnn_results import append_results, dataset_name
+from ccnn_telemetry import Telemetry
+from ccnn_tensor_store import check_subjects, load_normalized_tensor
+from ccnn_weights import create_archive, save_fold_weights
+
+# The settings selected above can be overridden by the experiment scheduler
+# (see ccnn_scheduler.py and ccnn_options.py)
+target_data = option('target_data', target_data)
+seed = option('seed', None)   # random seed of the run (None = not seeded)
+if seed is not None:
+    np.random.seed(seed)
+
+# Memory use of the phases of the script is written into the run log (see
+# ccnn_memory.py); NaNs are replaced and data are normalized while loading
+memory = MemoryMonitor('ccnn_class_CONVtrainFULLtrain')
+memory.phase('load')
 
-# loading the correlation matrices
+# Loading the correlation matrices (see ccnn_tensor_store.py)
 if target_data == 1:
-    pickle_file = "CORR_tensor_inhouse.pickle"
+    tensor_store = "CORR_tensor_inhouse"
 elif target_data == 2:
-    pickle_file = "CORR_tensor_NKI-RS_subset.pickle"
-    
-with open(pickle_file, 'rb') as f:
-    save = pickle.load(f)
-    data_tensor = save['data_tensor']
-    del save                                                                     
+    tensor_store = "CORR_tensor_NKI-RS_subset"
+
+# NaNs are replaced with 0s and data are normalized using the statistics
+# stored with the dataset (see ccnn_preprocess.py)
+data_tensor, data_stats = load_normalized_tensor(tensor_store)
 
 # Loading labels and subjects
 if target_data == 1:
     labels_csv = np.loadtxt("labels_inhouse.txt", delimiter=',')                              
 elif target_data == 2:
     labels_csv = np.loadtxt("labels_NKI-RS_subset.csv", delimiter=',')
+check_subjects(tensor_store, labels_csv[:, 0])   # rows of the store and of the labels file must match
 labels = labels_csv[:, 1]
 
 subjectIDs = labels_csv[:, 0]
@@ -57,22 +78,6 @@ subjectIDs = labels_csv[:, 0]
 # Define functions for cross-validation, tensor randomization and normalization 
 # and performance calculation
 
-# create_train_and_test_folds randomly divides subjectIDs stored in subjects to 
-# num_folds sets
-# INPUT: num_folds: number of folds in cross-validation (integer)
-#                   subjects: list of unique subject IDs
-# OUTPUT: IDs: array storing unique subject IDs with num_folds columns: 
-#              each column contains IDs of test subjects of the given fold
-def create_train_and_test_folds(num_folds, subjects):                          
-    n = np.ceil(len(subjects)/num_folds).astype(np.int)
-    np.random.shuffle(subjects)
-    if len(subjects) != n*num_folds:
-        s = np.zeros(n*num_folds)
-        s[:len(subjects)] = subjects
-        subjects = s
-    IDs = subjects.reshape((n, num_folds))
-    return IDs
-
 # normalize_tensor standardizes an n dimesional np.array to have zero mean and 
 # standard deviation of 1
 def normalize_tensor(data_tensor):
@@ -101,9 +106,8 @@ def randomize_tensor(dataset, labels):
 # create_train_and_test_data creates and prepares training and test datasets and 
 # labels for a given fold of cross-validation
 # INPUT: fold: number of the given fold (starting from 0)
-#        IDs: array storing unique subject IDs with num_folds columns: each 
-#             column contains IDs of test subjects of the given fold 
-#             (output of reate_train_and_test_folds)
+#        test_rows: list of the row indices of the test instances of each
+#                   fold (see load_folds in ccnn_folds.py)
 #        subjects: list of subject IDs corresponding to the order of instances 
 #                  stored in the dataset (ID of the same subject might appear 
 #                  more than once)
@@ -119,13 +123,14 @@ def randomize_tensor(dataset, labels):
 #                    test instances of the given fold
 #         test_labels: 2D tensor (np.array), storing labels of instances in 
 #                      test_data in one-hot encoding
-def create_train_and_test_data(fold, IDs, subjects, labels, data_tensor):
+def create_train_and_test_data(fold, test_rows, subjects, labels, data_tensor):
     #create one-hot encoding of labels
     num_labels = len(np.unique(labels))
     labels = (np.arange(num_labels) == labels[:,None]).astype(np.float32)
     
-    #identify the IDs of test subjects
-    testIDs = np.in1d(subjects, IDs[:,fold])
+    #select the test instances of the fold
+    testIDs = np.zeros(len(subjects), dtype=bool)
+    testIDs[test_rows[fold]] = True
         
     test_data = normalize_tensor(data_tensor[testIDs,:,:,:]).astype(np.float32)
     test_labels = labels[testIDs]
@@ -150,24 +155,21 @@ def accuracy(predictions, labels):
 
 # %% ####### Preparing the data and initializing network parameters ###########
 
-numROI = 111
+numROI = data_tensor.shape[1]   # number of ROIs of the atlas, read from the dataset
 num_channels = 1
 num_labels = 2
 image_size = numROI
-batch_size = 4
+batch_size = option('batch_size', 4)   # larger batches: see ccnn_batch.py
 patch_size = image_size
 keep_pr = 0.6    # the probability that each element is kept during dropout
-num_folds = 10
 
-# Replacing NaNs with 0s and normalizing data
-data_tensor[np.isnan(data_tensor)] = 0
-data_tensor = normalize_tensor(data_tensor)
-
-# Loading folds
+# Loading folds (the test instances of each fold are looked up once; a repeat
+# of a fold plan is used instead if 'fold_plan' is set, see ccnn_folds.py)
 if target_data == 1:
-    IDs = np.load('folds_inhouse.npy')
+    IDs, test_rows = load_folds('folds_inhouse.npy', subjectIDs)
 elif target_data == 2:
-    IDs = np.load('folds_NKI-RS_subset.npy')
+    IDs, test_rows = load_folds('folds_NKI-RS_subset.npy', subjectIDs)
+num_folds = len(test_rows)   # number of folds in cross-validation
 
 # Variables to store test labels and predictions later on
 test_labs = []
@@ -175,30 +177,43 @@ test_preds = []
 
 # %% ###################### launching TensorFlow ##############################
 
-# Preallocating arrays to save weights & biases
-layer1_weights_save = np.zeros([num_folds, 1, patch_size, num_channels, 64])
-layer2_weights_save = np.zeros([num_folds, patch_size, 1, 64, 256])
-layer3_weights_save = np.zeros([num_folds, 256, 96])
-layer4_weights_save = np.zeros([num_folds, 96, num_labels])
+# TensorFlow is imported only here, where the computational graph is built
+import tensorflow as tf
+
+# Weights & biases are saved into an archive as soon as each fold is finished
+if target_data == 1:
+    weight_archive = "weights_ccnn_class_CONVtrainFULLtrain_inhouse"
+elif target_data == 2:
+    weight_archive = "weights_ccnn_class_CONVtrainFULLtrain_NKI-RS_subset"
+weight_archive = output_name(weight_archive)
+create_archive(weight_archive, num_folds)
 
-layer1_biases_save = np.zeros([num_folds, 64])
-layer2_biases_save = np.zeros([num_folds, 256])
-layer3_biases_save = np.zeros([num_folds, 96])
-layer4_biases_save = np.zeros([num_folds, num_labels])
+# Test results of each fold are appended to the results store (see ccnn_results.py)
+results_condition = "class_CONVtrainFULLtrain"
+results_dataset = dataset_name(target_data)
 
 # Iterating over folds
 for i in range(num_folds):
     
+    memory.phase('fold%d/prep' % (i+1))
+    memory.require(2 * data_tensor.nbytes, 'normalized train and test copies')
+    
     # Creating train and test data for the given fold
-    train_data, train_labels, test_data, test_labels = create_train_and_test_data(i, IDs, subjectIDs, labels, data_tensor)
+    train_data, train_labels, test_data, test_labels = create_train_and_test_data(i, test_rows, subjectIDs, labels, data_tensor)
     
     train_data = train_data[:, :image_size, :image_size, :]
     test_data = test_data[:, :image_size, :image_size, :]
     
+    memory.phase('fold%d/graph' % (i+1))
+    memory.require(2 * test_data.nbytes, 'test set constant of the graph')
+    
     # Defining the computational graph
     graph = tf.Graph()
     
     with graph.as_default():
+        # Graph-level random seed of the fold (initialization, dropout)
+        if seed is not None:
+            tf.set_random_seed(seed + i)
     
         # Input data placeholders
         tf_train_dataset = tf.placeholder(tf.float32, shape=(batch_size, image_size, image_size, num_channels))
@@ -242,21 +257,25 @@ for i in range(num_folds):
         loss = tf.reduce_mean(
                 tf.nn.softmax_cross_entropy_with_logits(labels=tf_train_labels, logits=logits))
             
-        # Optimizer definition
-        learning_rate = 0.001
-        optimizer = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+        # Optimizer definition (the learning rate and the number of iterations
+        # are scaled to the batch size, see ccnn_batch.py)
+        learning_rate, num_steps, warmup_steps = scale_schedule(0.001, 5001, batch_size)
+        optimizer = adam_optimizer(loss, learning_rate, warmup_steps)
           
         # Calculate predictions from training data
         train_prediction = tf.nn.softmax(logits)
       
-        # Number of iterations
-        num_steps = 5001
-      
         # Calculate predictions from test data (keep_pr of dropout is 1!)
         test_prediction = tf.nn.softmax(model(tf_test_dataset, 1))
 
+    memory.phase('fold%d/train' % (i+1))
+    # Op-level profiling of a window of training steps (see ccnn_profile.py)
+    profiler = StepProfiler(weight_archive.replace('weights_', 'profile_', 1) + '_fold%d' % (i+1), fold=i)
+    # Training metrics are computed only at the steps reported (see ccnn_telemetry.py)
+    telemetry = Telemetry(weight_archive.replace('weights_', '', 1) + '_fold%d' % (i+1), 500)
+
     # Start TensorFlow session
-    with tf.Session(graph=graph) as session:
+    with tf.Session(graph=graph, config=session_config()) as session:
         
         
         tf.global_variables_initializer().run()
@@ -277,14 +296,23 @@ for i in range(num_folds):
             
             # Feed batch data to the placeholders
             feed_dict = {tf_train_dataset : batch_data, tf_train_labels : batch_labels}
-            _, l, predictions = session.run(
-                    [optimizer, loss, train_prediction], feed_dict=feed_dict)
+            if telemetry.due(step):
+                _, l, predictions = session.run(
+                        [optimizer, loss, train_prediction], feed_dict=feed_dict, **profiler.run_kwargs(step))
+            else:
+                _, l = session.run([optimizer, loss], feed_dict=feed_dict, **profiler.run_kwargs(step))
+            profiler.record(step)
+            telemetry.add(l)
                 
             # At every 500. step give some feedback on the progress
-            if (step % 500 == 0):
-                print('Minibatch loss at step %d: %f' % (step, l))
-                print('Minibatch accuracy: %.1f%%' % accuracy(predictions, batch_labels))
+            if telemetry.due(step):
+                train_accuracy = accuracy(predictions, batch_labels)
+                telemetry.report(step, l, accuracy=train_accuracy)
+                print('Minibatch accuracy: %.1f%%' % train_accuracy)
+
+        profiler.save()
 
+        memory.phase('fold%d/eval' % (i+1))
         # Evaluate the trained model on the test data in the given fold
         test_pred = test_prediction.eval()
         print('Test accuracy for fold %d: %.1f%%' % (i+1, accuracy(test_pred, test_labels)))
@@ -292,55 +320,37 @@ for i in range(num_folds):
         # Save test predictions and labels of this fold to a list
         test_labs.append(test_labels)
         test_preds.append(test_pred)
+        # ... and to the results store
+        test_instances = test_rows[i]
+        append_results(results_condition, results_dataset, i, subjectIDs[test_instances],
+                       test_labels, test_pred, instances=test_instances, seed=seed)
 
+        memory.phase('fold%d/save' % (i+1))
         # Storing weights & biases
-        layer1_weights_save[i, :, :, :, :] = layer1_weights.eval()
-        layer2_weights_save[i, :, :, :, :] = layer2_weights.eval()
-        layer3_weights_save[i, :, :] = layer3_weights.eval()
-        layer4_weights_save[i, :, :] = layer4_weights.eval()
-        
-        layer1_biases_save[i, :] = layer1_biases.eval()
-        layer2_biases_save[i, :] = layer2_biases.eval()
-        layer3_biases_save[i, :] = layer3_biases.eval()
-        layer4_biases_save[i, :] = layer4_biases.eval()
+        save_fold_weights(weight_archive, i, {
+                'layer1_weights': layer1_weights.eval(),
+                'layer1_biases': layer1_biases.eval(),
+                'layer2_weights': layer2_weights.eval(),
+                'layer2_biases': layer2_biases.eval(),
+                'layer3_weights': layer3_weights.eval(),
+                'layer3_biases': layer3_biases.eval(),
+                'layer4_weights': layer4_weights.eval(),
+                'layer4_biases': layer4_biases.eval(),
+                })
 
+memory.phase('results')
 # Create np.array to store all predictions and labels
-l = test_labs[0]
-p = test_preds[0]   
-# Iterate through the cross-validation folds    
-for i in range(1, num_folds):
-    l = np.vstack((l, test_labs[i]))
-    p = np.vstack((p, test_preds[i]))
+l = np.vstack(test_labs)
+p = np.vstack(test_preds)
 
 # Calculate final accuracy    
 print('\nFinal test accuracy: %.1f%%' % accuracy(p, l))
 
 # Saving data
 if target_data == 1:
-    np.savez("results_ccnn_class_CONVtrainFULLtrain_inhouse.npz", labels=l, predictions=p, splits=IDs)
+    np.savez(output_name("results_ccnn_class_CONVtrainFULLtrain_inhouse.npz"), labels=l, predictions=p, splits=IDs)
 elif target_data == 2:
-    np.savez("results_ccnn_class_CONVtrainFULLtrain_NKI-RS_subset.npz", labels=l, predictions=p, splits=IDs)
-    
-# Saving weights and biases
-if target_data == 1:
-    pickle_file = "weights_ccnn_class_CONVtrainFULLtrain_inhouse.pickle"
-elif target_data == 2:
-    pickle_file = "weights_ccnn_class_CONVtrainFULLtrain_NKI-RS_subset.pickle"
-    
-try:
-    f = open(pickle_file, 'wb')
-    save = {
-            'layer1_weights': layer1_weights_save,
-            'layer1_biases': layer1_biases_save,
-            'layer2_weights': layer2_weights_save,
-            'layer2_biases': layer2_biases_save,
-            'layer3_weights': layer3_weights_save,
-            'layer3_biases': layer3_biases_save,
-            'layer4_weights': layer4_weights_save,
-            'layer4_biases': layer4_biases_save,
-            }
-    pickle.dump(save, f, pickle.HIGHEST_PROTOCOL)
-    f.close()
-except Exception as e:
-    print('Unable to save data to', pickle_file, ':', e)
-    raise
\ No newline at end of file
+    np.savez(output_name("results_ccnn_class_CONVtrainFULLtrain_NKI-RS_subset.npz"), labels=l, predictions=p, splits=IDs)
+
+# Memory use of the phases (peaks and optional report, see ccnn_memory.py)
+memory.end()
@@ -19,35 +19,43 @@ https://github.com/tensorflow/tensorflow/blob/master/tensorflow/examples/udacity
 # %% ########################### Loading data #################################
 
 # Importing necessary libraries
+from ccnn_session import apply_threads, session_config
+apply_threads()   # before NumPy is imported (BLAS threads, see ccnn_session.py)
 import numpy as np
-import tensorflow as tf
-from six.moves import cPickle as pickle
-
-# loading the correlation matrices
-picklefile = "CORR_tensor_inhouse.pickle"
-
-with open(picklefile, 'rb') as f:
-    save = pickle.load(f)
-    data_tensor = save['data_tensor']
-    del save
-
-data_tensor = data_tensor.astype(np.float32)
+from ccnn_memory import MemoryMonitor
+from ccnn_options import option
+from ccnn_profile import StepProfiler
+from ccnn_telemetry import Telemetry
+from ccnn_tensor_store import check_subjects, load_normalized_tensor
+from ccnn_weights import save_weights
+
+# The random seed can be set by the experiment scheduler (see ccnn_scheduler.py
+# and ccnn_options.py)
+seed = option('seed', None)   # random seed of the run (None = not seeded)
+if seed is not None:
+    np.random.seed(seed)
+
+# Memory use of the phases of the script is written into the run log (see
+# ccnn_memory.py); NaNs are replaced and data are normalized while loading
+memory = MemoryMonitor('ccnn_class_inhousetrain')
+memory.phase('load')
+
+# Loading the correlation matrices (see ccnn_tensor_store.py)
+tensor_store = "CORR_tensor_inhouse"
+
+# NaNs are replaced with 0s and data are normalized using the statistics
+# stored with the dataset (see ccnn_preprocess.py)
+data_tensor, data_stats = load_normalized_tensor(tensor_store)
 
 # Loading labels
 labels_csv = np.loadtxt("labels_inhouse.txt", delimiter=',')
+check_subjects(tensor_store, labels_csv[:, 0])   # rows of the store and of the labels file must match
 labels = labels_csv[:, 1]
 
 # %% ####################### Function definitions #############################
 # Define functions for tensor randomization, normalization, and performance 
 # calculation
 
-# normalize_tensor standardizes an n dimesional np.array to have zero mean and 
-# standard deviation of 1
-def normalize_tensor(data_tensor):
-    data_tensor -= np.mean(data_tensor)
-    data_tensor /= np.max(np.abs(data_tensor))
-    return data_tensor
-
 # randomize_tensor generates a random permutation of instances and the 
 # corresponding labels before training
 # INPUT: dataset: 4D tensor (np.array), instances are concatenated along the 
@@ -80,7 +88,7 @@ def accuracy(predictions, labels):
   
 # %% ####### Preparing the data and initializing network parameters ###########
 
-numROI = 111
+numROI = data_tensor.shape[1]   # number of ROIs of the atlas, read from the dataset
 num_channels = 1
 num_labels = 2
 image_size = numROI
@@ -88,9 +96,8 @@ batch_size = 4
 patch_size = image_size
 keep_pr = 0.6   # the probability that each element is kept during dropout
 
-# Replacing NaNs with 0s and normalizing data
-data_tensor[np.isnan(data_tensor)] = 0
-train_data = normalize_tensor(data_tensor)
+# NaNs were replaced with 0s and data were normalized at loading time
+train_data = data_tensor
 
 # One-hot encoded train labels
 num_labels = len(np.unique(labels))
@@ -98,14 +105,22 @@ train_labels = (np.arange(num_labels) == labels[:,None]).astype(np.float32)
 
 # %% ###################### launching TensorFlow ##############################
 
+# TensorFlow is imported only here, where the computational graph is built
+import tensorflow as tf
+
 # Adjusting image size
 train_data = train_data[:, :image_size, :image_size, :]
 
+memory.phase('graph')
 # Defining the computational graph    
 graph = tf.Graph()
     
 with graph.as_default():
     
+    # Graph-level random seed (initialization, dropout)
+    if seed is not None:
+        tf.set_random_seed(seed)
+
     # Input data placeholders and constants
     tf_train_dataset = tf.placeholder(tf.float32, shape=(batch_size, image_size, image_size, num_channels))
     tf_train_labels = tf.placeholder(tf.float32, shape=(batch_size, num_labels))
@@ -155,8 +170,14 @@ with graph.as_default():
     # Number of iterations
     num_steps = 5001
     
+memory.phase('train')
+# Op-level profiling of a window of training steps (see ccnn_profile.py)
+profiler = StepProfiler('profile_ccnn_class_inhousetrain')
+# Training metrics are computed only at the steps reported (see ccnn_telemetry.py)
+telemetry = Telemetry('ccnn_class_inhousetrain', 500)
+
 # Start TensorFlow session
-with tf.Session(graph=graph) as session:
+with tf.Session(graph=graph, config=session_config()) as session:
     
     # Initializing variables    
     tf.global_variables_initializer().run()
@@ -178,14 +199,22 @@ with tf.Session(graph=graph) as session:
             
         # Feed batch data to the placeholders
         feed_dict = {tf_train_dataset : batch_data, tf_train_labels : batch_labels}
-        _, l, predictions = session.run(
-                [optimizer, loss, train_prediction], feed_dict=feed_dict)
+        if telemetry.due(step):
+            _, l, predictions = session.run(
+                    [optimizer, loss, train_prediction], feed_dict=feed_dict, **profiler.run_kwargs(step))
+        else:
+            _, l = session.run([optimizer, loss], feed_dict=feed_dict, **profiler.run_kwargs(step))
+        profiler.record(step)
+        telemetry.add(l)
             
         # At every 500. step give some feedback on the progress
-        if (step % 500 == 0):
-            print('Minibatch loss at step %d: %f' % (step, l))
-            print('Minibatch accuracy: %.1f%%' % accuracy(predictions, batch_labels))
+        if telemetry.due(step):
+            train_accuracy = accuracy(predictions, batch_labels)
+            telemetry.report(step, l, accuracy=train_accuracy)
+            print('Minibatch accuracy: %.1f%%' % train_accuracy)
         
+    profiler.save()
+
     # Saving final weights and bias terms
     layer1_weights_final = layer1_weights.eval()
     layer1_biases_final = layer1_biases.eval()
@@ -196,23 +225,19 @@ with tf.Session(graph=graph) as session:
     layer4_weights_final = layer4_weights.eval()
     layer4_biases_final = layer4_biases.eval()
 
-# Saving weights
-pickle_file = "weights_inhouse.pickle"
-    
-try:
-    f = open(pickle_file, 'wb')
-    save = {
-            'layer1_weights': layer1_weights_final,
-            'layer1_biases': layer1_biases_final,
-            'layer2_weights': layer2_weights_final,
-            'layer2_biases': layer2_biases_final,
-            'layer3_weights': layer3_weights_final,
-            'layer3_biases': layer3_biases_final,
-            'layer4_weights': layer4_weights_final,
-            'layer4_biases': layer4_biases_final,
-            }
-    pickle.dump(save, f, pickle.HIGHEST_PROTOCOL)
-    f.close()
-except Exception as e:
-    print('Unable to save data to', pickle_file, ':', e)
-    raise
\ No newline at end of file
+memory.phase('save')
+# Saving weights and biases
+weight_archive = "weights_inhouse"
+save_weights(weight_archive, {
+        'layer1_weights': layer1_weights_final,
+        'layer1_biases': layer1_biases_final,
+        'layer2_weights': layer2_weights_final,
+        'layer2_biases': layer2_biases_final,
+        'layer3_weights': layer3_weights_final,
+        'layer3_biases': layer3_biases_final,
+        'layer4_weights': layer4_weights_final,
+        'layer4_biases': layer4_biases_final,
+        })
+
+# Memory use of the phases (peaks and optional report, see ccnn_memory.py)
+memory.end()
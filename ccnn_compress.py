@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the low-rank factorization of the second (column
+convolution) layer of the connectome-convolutional neural network. The weights
+of this layer ([numROI, 1, 64, 256]) are the largest block of parameters and
+the most expensive convolution of the network. Reshaped into a
+[numROI*64, 256] matrix (ROI and channel axes merged), they are approximated by
+the product of two rank-k matrices, stored as the weights of two convolutions:
+'layer2_weights_u' ([numROI, 1, 64, k], convolution by column into k channels)
+and 'layer2_weights_v' ([1, 1, k, 256], mixing the k channels into the 256
+features of the layer). The factorized layer is used in the transfer scripts
+if 'layer2_rank' is set, and in the NumPy forward pass ('ccnn_inference.py')
+whenever the weights hold the two factors.
+
+Running this module as a script compresses the weights of an archive by
+truncated SVD for the given ranks, and reports the size of the weights, the
+approximation error, the agreement of the predictions with the original network
+(on the given dataset, or on synthetic data) and the speedup of inference.
+Optionally, the compressed weights of one rank are saved into a new archive
+(e.g. 'weights_public_rank32'):
+
+    python ccnn_compress.py weights_public [--dataset CORR_tensor_inhouse --labels labels_inhouse.txt] [--ranks 8 16 32 64] [--save 32]
+"""
+# Importing necessary libraries
+import argparse
+import time
+
+import numpy as np
+
+# %% ####################### Function definitions #############################
+
+# factorize_layer2 approximates the weights of the column convolution by two
+# rank-k factors (truncated SVD, the singular values are split evenly between
+# the factors so that both are well scaled for further training)
+# INPUT: layer2_weights: 4D tensor (np.array) [numROI, 1, 64, 256]
+#        rank: number of singular values kept (k)
+# OUTPUT: layer2_weights_u: 4D tensor (np.array) [numROI, 1, 64, k]
+#         layer2_weights_v: 4D tensor (np.array) [1, 1, k, 256]
+def factorize_layer2(layer2_weights, rank):
+    shape = layer2_weights.shape
+    u, s, vt = np.linalg.svd(np.asarray(layer2_weights, dtype=np.float64).reshape(-1, shape[3]),
+                             full_matrices=False)
+    rank = min(int(rank), s.shape[0])
+    scale = np.sqrt(s[:rank])
+    layer2_weights_u = (u[:, :rank] * scale).reshape(shape[0], shape[1], shape[2], rank)
+    layer2_weights_v = (scale[:, None] * vt[:rank]).reshape(1, 1, rank, shape[3])
+    return layer2_weights_u.astype(np.float32), layer2_weights_v.astype(np.float32)
+
+# expand_layer2 computes the full weights of the column convolution from the
+# two factors
+# OUTPUT: 4D tensor (np.array) [numROI, 1, 64, 256]
+def expand_layer2(layer2_weights_u, layer2_weights_v):
+    shape = layer2_weights_u.shape
+    rank = shape[3]
+    full = np.dot(np.reshape(layer2_weights_u, (-1, rank)), np.reshape(layer2_weights_v, (rank, -1)))
+    return full.reshape(shape[0], shape[1], shape[2], -1)
+
+# compress_weights replaces the weights of the column convolution with their
+# rank-k factors in a dictionary of weights (see ccnn_weights.py)
+# OUTPUT: new dictionary of weights and biases
+def compress_weights(weights, rank):
+    compressed = dict((name, value) for name, value in weights.items() if name != 'layer2_weights')
+    compressed['layer2_weights_u'], compressed['layer2_weights_v'] = \
+        factorize_layer2(weights['layer2_weights'], rank)
+    return compressed
+
+# retained_energy returns the fraction of the squared Frobenius norm of the
+# weights of the column convolution kept by the first k singular values
+def retained_energy(layer2_weights, rank):
+    s = np.linalg.svd(np.reshape(layer2_weights, (-1, layer2_weights.shape[3])), compute_uv=False)
+    return np.sum(s[:rank]**2) / np.sum(s**2)
+
+def _num_params(weights):
+    return sum(int(np.prod(np.shape(value))) for value in weights.values())
+
+def _timed_predict(data, weights, repeats):
+    from ccnn_inference import predict
+    predictions = predict(data, weights)
+    start = time.time()
+    for _ in range(repeats):
+        predict(data, weights)
+    return predictions, (time.time() - start) / repeats
+
+# %% ####################### Compressing weights ##############################
+
+if __name__ == '__main__':
+    from ccnn_transfer_matrix import label_column
+    from ccnn_weights import load_weights, save_weights
+
+    parser = argparse.ArgumentParser(description='Low-rank compression of the column convolution layer.')
+    parser.add_argument('weights', help='weights archive (or old pickle file)')
+    parser.add_argument('--fold', type=int, default=None, help='fold of a cross-validation archive')
+    parser.add_argument('--ranks', type=int, nargs='+', default=[8, 16, 32, 64])
+    parser.add_argument('--dataset', default=None, help='tensor store used to compare predictions')
+    parser.add_argument('--labels', default=None, help='labels file of the dataset')
+    parser.add_argument('--label-column', type=int, default=None,
+                        help='column of the labels in the labels file (default: the column of the '
+                             'task, see label_columns in ccnn_transfer_matrix.py)')
+    parser.add_argument('--repeats', type=int, default=5, help='repetitions of the timed inference')
+    parser.add_argument('--save', type=int, default=None, metavar='RANK',
+                        help='save the weights compressed to RANK into WEIGHTS_rankRANK')
+    args = parser.parse_args()
+
+    weights = load_weights(args.weights, fold=args.fold, mmap=False)
+    num_roi = weights['layer2_weights'].shape[0]
+    if args.dataset is not None:
+        from ccnn_tensor_store import check_subjects, load_normalized_tensor
+        data, data_stats = load_normalized_tensor(args.dataset)
+    else:
+        data = np.random.RandomState(0).randn(64, num_roi, num_roi, 1).astype(np.float32)
+    labels = None
+    if args.labels is not None:
+        labels_csv = np.loadtxt(args.labels, delimiter=',')
+        if args.dataset is not None:
+            check_subjects(args.dataset, labels_csv[:, 0])
+        task = 'class' if weights['layer4_weights'].shape[-1] > 1 else 'regr'
+        labels = labels_csv[:, label_column(args.labels, task) if args.label_column is None else args.label_column]
+
+    full_pred, full_time = _timed_predict(data, weights, args.repeats)
+    classification = full_pred.shape[1] > 1
+    print('%6s %9s %9s %10s %9s %11s %9s' % ('rank', 'params', 'size', 'rel error', 'energy',
+                                             'agreement' if classification else 'max diff',
+                                             'speedup'))
+    print('%6s %9.0f %8.1fM %10s %9s %11s %9s' % ('full', _num_params(weights),
+                                                 4 * _num_params(weights) / 1024.0**2, '-', '-', '-', '1.00'))
+    for rank in args.ranks:
+        compressed = compress_weights(weights, rank)
+        error = (np.linalg.norm(expand_layer2(compressed['layer2_weights_u'], compressed['layer2_weights_v'])
+                                - weights['layer2_weights']) / np.linalg.norm(weights['layer2_weights']))
+        pred, pred_time = _timed_predict(data, compressed, args.repeats)
+        if classification:
+            match = '%10.1f%%' % (100.0 * np.mean(np.argmax(pred, 1) == np.argmax(full_pred, 1)))
+        else:
+            match = '%11.4f' % np.max(np.abs(pred - full_pred))
+        print('%6d %9.0f %8.1fM %10.4f %9.4f %s %9.2f' % (
+            rank, _num_params(compressed), 4 * _num_params(compressed) / 1024.0**2, error,
+            retained_energy(weights['layer2_weights'], rank), match, full_time / pred_time))
+        if labels is not None and classification:
+            print('       accuracy: %.1f%% (full network: %.1f%%)' % (
+                100.0 * np.mean(np.argmax(pred, 1) == labels), 100.0 * np.mean(np.argmax(full_pred, 1) == labels)))
+        elif labels is not None:
+            print('       MAE: %.2f (full network: %.2f)' % (
+                np.mean(np.abs(pred[:, 0] - labels)), np.mean(np.abs(full_pred[:, 0] - labels))))
+
+    if args.save is not None:
+        path = args.weights.replace('.pickle', '') + '_rank%d' % args.save
+        save_weights(path, compress_weights(weights, args.save))
+        print('Weights compressed to rank %d saved into %s' % (args.save, path))
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements fold plans for repeated cross-validation. A fold plan
+holds R repeats of a K-fold split of the subjects of a dataset: all instances of
+a subject are in the same fold, and the folds can be stratified by label (class
+labels, or ages for regression), so that each fold has about the same label
+distribution. The test instances of every fold of every repeat are computed once
+when the plan is made and stored as row indices (positions of the instances in
+the dataset), thus the scripts select the train and test data of a fold by
+indexing, without looking up the subject IDs of the instances again.
+
+A plan is an .npz file holding:
+
+- 'subjects': subject IDs of the instances of the dataset (to check that the
+  plan is used with the dataset it was made for),
+- 'rows': [num_repeats, num_instances] row indices, sorted by fold (and by row
+  within each fold),
+- 'offsets': [num_repeats, num_folds + 1] start of each fold in 'rows',
+- 'stratified', 'seed': how the plan was made.
+
+The cross-validation scripts read their folds with load_folds: from the folds
+file of the script ('folds_inhouse.npy' / 'folds_NKI-RS_subset.npy') or, if the
+setting 'fold_plan' is given (see 'ccnn_options.py'), from the repeat 'repeat'
+of a plan. Running this module as a script makes a plan, shows its folds, or
+runs a script for each repeat of a plan and reports the mean and standard
+deviation of the performance over the repeats (read from the results store,
+see 'ccnn_results.py'):
+
+    python ccnn_folds.py plan labels_inhouse.txt [--folds 10] [--repeats 5] [--stratify 1] [--seed 0] [--out folds_plan_inhouse.npz]
+    python ccnn_folds.py show folds_plan_inhouse.npz
+    python ccnn_folds.py run ccnn_class_CONVtrainFULLtrain.py folds_plan_inhouse.npz [--repeats 0 1 2] [--set target_data=1]
+"""
+# Importing necessary libraries
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+from ccnn_options import ENV_PREFIX, option, option_env
+
+PLAN_FORMAT = 'ccnn-folds'
+# Label columns with more distinct values than this are treated as continuous
+# (ages) when stratifying
+MAX_CLASSES = 10
+
+# %% ####################### Function definitions #############################
+
+# assign_folds assigns the subjects to folds in each repeat: the subjects are
+# ordered by label (randomly within the same label, or randomly if not
+# stratified) and dealt to the folds in turn (in a random order of the folds),
+# so that the folds have the same number of subjects (+-1), and of subjects of
+# each label (+-1)
+# INPUT: strata: 1D vector (np.array) of the stratification key of each unique
+#                subject (None = not stratified)
+#        num_subjects, num_folds, num_repeats: sizes of the plan
+#        seed: random seed of the plan
+# OUTPUT: 2D tensor (np.array) [num_repeats, num_subjects] of fold numbers
+def assign_folds(strata, num_subjects, num_folds, num_repeats, seed=0):
+    if num_subjects < num_folds:
+        raise ValueError('%d subjects cannot be split into %d folds' % (num_subjects, num_folds))
+    random = np.random.RandomState(seed)
+    assignment = np.zeros((num_repeats, num_subjects), dtype=np.int16)
+    for r in range(num_repeats):
+        order = random.permutation(num_subjects)
+        if strata is not None:
+            order = order[np.argsort(strata[order], kind='stable')]
+        assignment[r, order] = random.permutation(num_folds)[np.arange(num_subjects) % num_folds]
+    return assignment
+
+# fold_rows computes the row indices of the test instances of each fold
+# INPUT: fold_of_row: 1D vector (np.array) of the fold of each instance (-1 =
+#                     never tested)
+#        num_folds: number of folds
+# OUTPUT: rows: row indices sorted by fold (np.array, int32)
+#         offsets: start of each fold in rows (num_folds + 1 entries)
+def fold_rows(fold_of_row, num_folds):
+    tested = np.nonzero(fold_of_row >= 0)[0]
+    rows = tested[np.argsort(fold_of_row[tested], kind='stable')].astype(np.int32)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(fold_of_row[tested], minlength=num_folds))])
+    return rows, offsets
+
+# make_plan makes a fold plan for a dataset
+# INPUT: subjects: subject IDs of the instances of the dataset
+#        labels: labels of the instances used for stratification (None = not
+#                stratified); subjects are stratified by the label of their
+#                first instance, continuous labels by their rank
+#        num_folds, num_repeats, seed: see assign_folds
+# OUTPUT: dictionary of the arrays of the plan (see the top of the module)
+def make_plan(subjects, labels=None, num_folds=10, num_repeats=1, seed=0):
+    subjects = np.asarray(subjects, dtype=np.float64)
+    unique, first, subject_of_row = np.unique(subjects, return_index=True, return_inverse=True)
+    strata = None
+    if labels is not None:
+        strata = np.asarray(labels)[first]
+        if len(np.unique(strata)) > MAX_CLASSES:
+            strata = np.argsort(np.argsort(strata, kind='stable'))
+    assignment = assign_folds(strata, len(unique), num_folds, num_repeats, seed)
+    rows, offsets = zip(*[fold_rows(assignment[r][subject_of_row], num_folds) for r in range(num_repeats)])
+    return {'format': np.array(PLAN_FORMAT), 'subjects': subjects, 'rows': np.stack(rows),
+            'offsets': np.stack(offsets), 'stratified': np.array(labels is not None), 'seed': np.array(seed)}
+
+# save_plan saves a fold plan into an .npz file
+def save_plan(path, plan):
+    np.savez_compressed(path, **plan)
+
+# load_plan reads a fold plan
+def load_plan(path):
+    with np.load(path) as data:
+        plan = dict((name, data[name]) for name in data.files)
+    if str(plan.get('format')) != PLAN_FORMAT:
+        raise ValueError('%s is not a fold plan' % path)
+    return plan
+
+# plan_rows returns the row indices of the test instances of each fold of a
+# repeat of a plan
+# OUTPUT: list of 1D vectors (np.array), one per fold
+def plan_rows(plan, repeat=0):
+    if not 0 <= repeat < plan['rows'].shape[0]:
+        raise IndexError('the fold plan has %d repeats, not repeat %d' % (plan['rows'].shape[0], repeat))
+    rows, offsets = plan['rows'][repeat], plan['offsets'][repeat]
+    return [rows[offsets[k]:offsets[k + 1]] for k in range(len(offsets) - 1)]
+
+# fold_table returns the test subject IDs of each fold in a column, padded with
+# 0s (format of the folds files and of the 'splits' saved by the scripts)
+def fold_table(subjects, test_rows):
+    fold_subjects = [np.unique(subjects[rows]) for rows in test_rows]
+    IDs = np.zeros((max(len(s) for s in fold_subjects), len(fold_subjects)))
+    for k, s in enumerate(fold_subjects):
+        IDs[:len(s), k] = s
+    return IDs
+
+# load_folds reads the folds of a cross-validation script: from the repeat
+# 'repeat' of the fold plan 'fold_plan' if this setting is given, from the
+# folds file of the script otherwise
+# INPUT: folds_file: folds file of the script (array of test subject IDs, one
+#                    column per fold)
+#        subjects: subject IDs of the instances of the dataset
+# OUTPUT: IDs: test subject IDs of each fold in a column (as in folds_file)
+#         test_rows: list of the row indices of the test instances of each fold
+def load_folds(folds_file, subjects):
+    subjects = np.asarray(subjects, dtype=np.float64)
+    plan_file = option('fold_plan', None)
+    if plan_file is None:
+        IDs = np.load(folds_file)
+        fold_of_row = np.full(len(subjects), -1, dtype=np.int64)
+        for k in range(IDs.shape[1]):
+            fold_of_row[np.in1d(subjects, IDs[:, k])] = k
+        rows, offsets = fold_rows(fold_of_row, IDs.shape[1])
+        return IDs, [rows[offsets[k]:offsets[k + 1]] for k in range(IDs.shape[1])]
+    plan = load_plan(plan_file)
+    if plan['subjects'].shape != subjects.shape or np.any(plan['subjects'] != subjects):
+        raise ValueError('the fold plan %s was made for another dataset' % plan_file)
+    test_rows = plan_rows(plan, option('repeat', 0))
+    return fold_table(subjects, test_rows), test_rows
+
+# run_repeat runs a cross-validation script on a repeat of a fold plan (output
+# written into a log file), and reads its results from the results store
+# INPUT: script: name of the script
+#        plan_file: fold plan
+#        repeat: number of the repeat
+#        options: other settings of the script (e.g. {'target_data': 2})
+# OUTPUT: dictionary of the run tag, the wall time, the performance (accuracy
+#         in % or mean absolute error) and the performance of each fold
+def run_repeat(script, plan_file, repeat, options=None):
+    from ccnn_results import performance, query
+    settings = dict(options or {}, fold_plan=plan_file, repeat=repeat)
+    run_tag = '%s_r%d_%d' % (os.path.splitext(os.path.basename(plan_file))[0], repeat, int(time.time()))
+    env = dict(os.environ)
+    env.update(option_env(settings))
+    env[ENV_PREFIX + 'RUN_TAG'] = run_tag
+    log_file = 'ccnn_folds_%s.log' % run_tag
+    start = time.time()
+    with open(log_file, 'w') as log:
+        returncode = subprocess.call([sys.executable, script], env=env, stdout=log, stderr=subprocess.STDOUT)
+    seconds = time.time() - start
+    if returncode != 0:
+        raise RuntimeError('%s failed on repeat %d (see %s)' % (script, repeat, log_file))
+    rows = query(run_tag=run_tag)
+    folds = np.unique(rows['fold'])
+    return {'repeat': repeat, 'run_tag': run_tag, 'seconds': seconds,
+            'classification': bool(rows['prediction'].shape[1] > 1),
+            'performance': float(performance(rows['label'], rows['prediction'])),
+            'folds': [float(performance(rows['label'][rows['fold'] == k], rows['prediction'][rows['fold'] == k]))
+                      for k in folds]}
+
+# %% ################### Making and running fold plans #########################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fold plans of repeated cross-validation.')
+    parser.add_argument('command', choices=['plan', 'show', 'run'])
+    parser.add_argument('arguments', nargs='+',
+                        help='plan: LABELS_FILE, show: PLAN, run: SCRIPT PLAN')
+    parser.add_argument('--folds', type=int, default=10, help='plan: number of folds')
+    parser.add_argument('--repeats', type=int, nargs='+', default=None,
+                        help='plan: number of repeats (default 5), run: repeats run (default all)')
+    parser.add_argument('--stratify', type=int, default=None, metavar='COLUMN',
+                        help='plan: column of the labels file stratified (1 = class, 2 = age)')
+    parser.add_argument('--seed', type=int, default=0, help='plan: random seed')
+    parser.add_argument('--out', default=None, help='plan: plan file (default: folds_plan_LABELS.npz)')
+    parser.add_argument('--set', nargs='+', default=[], metavar='NAME=VALUE',
+                        help='run: other settings of the script (JSON values)')
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        labels_file = args.arguments[0]
+        labels_csv = np.loadtxt(labels_file, delimiter=',')
+        num_repeats = 5 if args.repeats is None else args.repeats[0]
+        strata = None if args.stratify is None else labels_csv[:, args.stratify]
+        plan = make_plan(labels_csv[:, 0], strata, args.folds, num_repeats, args.seed)
+        out = args.out or 'folds_plan_%s.npz' % os.path.splitext(os.path.basename(labels_file))[0].replace('labels_', '')
+        save_plan(out, plan)
+        print('%d repeats of %d folds of %d subjects (%d instances) saved into %s' % (
+            num_repeats, args.folds, len(np.unique(plan['subjects'])), len(plan['subjects']), out))
+
+    elif args.command == 'show':
+        plan = load_plan(args.arguments[0])
+        subjects = plan['subjects']
+        print('%d repeats of %d folds, %s, seed %d' % (
+            plan['rows'].shape[0], plan['offsets'].shape[1] - 1,
+            'stratified' if plan['stratified'] else 'not stratified', plan['seed']))
+        for repeat in range(plan['rows'].shape[0]):
+            test_rows = plan_rows(plan, repeat)
+            print('repeat %d: subjects per fold %s, instances per fold %s' % (
+                repeat, ' '.join('%d' % len(np.unique(subjects[rows])) for rows in test_rows),
+                ' '.join('%d' % len(rows) for rows in test_rows)))
+
+    else:
+        if len(args.arguments) != 2:
+            parser.error('run needs SCRIPT PLAN')
+        script, plan_file = args.arguments
+        num_repeats = load_plan(plan_file)['rows'].shape[0]
+        options = dict((item.split('=', 1)[0], json.loads(item.split('=', 1)[1])) for item in args.set)
+        runs = []
+        for repeat in (range(num_repeats) if args.repeats is None else args.repeats):
+            print('Running %s on repeat %d of %s ...' % (script, repeat, plan_file))
+            runs.append(run_repeat(script, plan_file, repeat, options))
+            print('  %s %.2f (%.0f s)' % ('accuracy' if runs[-1]['classification'] else 'MAE',
+                                          runs[-1]['performance'], runs[-1]['seconds']))
+        values = np.array([run['performance'] for run in runs])
+        fold_values = np.concatenate([run['folds'] for run in runs])
+        print('\n%s over %d repeats: %.2f +- %.2f (SD over repeats), SD over folds %.2f' % (
+            'Accuracy' if runs[0]['classification'] else 'MAE', len(runs), np.mean(values),
+            np.std(values, ddof=1) if len(runs) > 1 else 0.0, np.std(fold_values, ddof=1)))
+        report_file = 'ccnn_folds_%s_%s.json' % (os.path.splitext(os.path.basename(script))[0],
+                                                 os.path.splitext(os.path.basename(plan_file))[0])
+        with open(report_file, 'w') as f:
+            json.dump({'script': script, 'plan': plan_file, 'options': options, 'runs': runs},
+                      f, indent=1, sort_keys=True)
+        print('Report saved into %s' % report_file)
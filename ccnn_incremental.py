@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+This module updates the weights of a connectome-convolutional neural network
+trained on the target dataset (e.g. 'weights_ccnn_class_CONVinitFULLinit_inhouse'
+written by 'ccnn_class_CONVinitFULLtrain_FULLinit.py', or
+'weights_ccnn_regr_transfer_inhouse' written by 'ccnn_regr_transfer.py') when
+new subjects are added to the cohort, instead of rerunning the transfer from
+the source weights on all data. Starting from the last saved weights, the
+network is trained for a bounded number of steps on the new subjects plus a
+replay sample of the subjects it has already been trained on, which keeps it
+from forgetting them. The weights of every fold of a cross-validation archive
+are updated separately, the replay samples being drawn from the training
+subjects of the fold, so that the test subjects of the fold stay held out: the
+performance on them before and after the update is reported.
+
+The updated weights are saved into a new archive (by default the name of the
+parent archive with '_update<generation>' appended), together with their
+lineage ('lineage.json' in the archive directory): the parent archive and its
+checksum, the new subjects, the settings of the update, the subjects each fold
+has been trained on (used to find the new subjects at the next update) and the
+lineage of the parent. The first update of an archive written by a
+cross-validation script needs the folds file of the script ('--folds'); later
+updates read the subjects from the lineage.
+
+    python ccnn_incremental.py weights_ccnn_class_CONVinitFULLinit_inhouse --task class --dataset CORR_tensor_inhouse --labels labels_inhouse.txt --folds folds_inhouse.npy [--steps 500] [--replay 1.0]
+    python ccnn_incremental.py weights_ccnn_regr_transfer_inhouse --task regr --train-layers dense ...
+    python ccnn_incremental.py --lineage weights_ccnn_class_CONVinitFULLinit_inhouse_update1
+"""
+# Importing necessary libraries
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+LINEAGE_FILE = 'lineage.json'
+
+# Settings of the scripts the archives are written by
+BATCH_SIZE = 4
+KEEP_PR = 0.6
+LEARNING_RATE = {'class': 0.001, 'regr': 0.0005}
+CONV_LAYERS = ['layer1_weights', 'layer1_biases', 'layer2_weights',
+               'layer2_weights_u', 'layer2_weights_v', 'layer2_biases']
+
+# %% ####################### Function definitions #############################
+
+# lineage_file returns the name of the lineage file of a weights archive
+def lineage_file(path):
+    from ccnn_weights import archive_path
+    return os.path.join(archive_path(path), LINEAGE_FILE)
+
+# read_lineage returns the lineage of a weights archive (a dictionary), or None
+# for an archive written by one of the scripts
+def read_lineage(path):
+    if not os.path.isfile(lineage_file(path)):
+        return None
+    with open(lineage_file(path), 'r') as f:
+        return json.load(f)
+
+def _write_lineage(path, lineage):
+    tmp_file = lineage_file(path) + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(lineage, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, lineage_file(path))
+
+# trained_subjects returns the subjects the weights of each fold of an archive
+# have been trained on, and the subjects held out from each fold
+# INPUT: path: weights archive (string)
+#        folds: list of fold numbers of the archive (None for a single set)
+#        IDs: folds file of the cross-validation script (array with one column
+#             of test subject IDs per fold), needed if the archive has no
+#             lineage
+#        subjects: subject IDs of the dataset (used for a single set of weights
+#                  without lineage together with new_subjects)
+#        new_subjects: IDs of the new subjects, if given explicitly
+# OUTPUT: dictionary mapping fold numbers (None for a single set) to
+#         (trained subject IDs, held-out subject IDs) pairs
+def trained_subjects(path, folds, IDs=None, subjects=None, new_subjects=None):
+    lineage = read_lineage(path)
+    if lineage is not None:
+        return dict((None if key == 'all' else int(key),
+                     (np.array(entry['trained_subjects']), np.array(entry['heldout_subjects'])))
+                    for key, entry in lineage['folds'].items())
+    if folds is None:
+        if new_subjects is None:
+            raise ValueError('%s has no lineage: give the new subjects (--new-subjects)' % path)
+        return {None: (np.setdiff1d(subjects, new_subjects), np.array([]))}
+    if IDs is None:
+        raise ValueError('%s has no lineage: give the folds file of the cross-validation (--folds)' % path)
+    known = IDs[IDs != 0]
+    return dict((fold, (np.setdiff1d(known, IDs[:, fold]), IDs[:, fold][IDs[:, fold] != 0]))
+                for fold in folds)
+
+# replay_sample draws subjects the network has already been trained on, until
+# their instances reach replay times the number of new instances
+# INPUT: old_subjects: IDs of the subjects the network has been trained on
+#        subjectIDs: subject IDs of the instances of the dataset
+#        num_new: number of new instances
+#        replay: ratio of replayed to new instances
+# OUTPUT: IDs of the replayed subjects
+def replay_sample(old_subjects, subjectIDs, num_new, replay):
+    if replay <= 0:
+        return np.array([])
+    old_subjects = np.random.permutation(np.intersect1d(old_subjects, subjectIDs))
+    counts = np.array([np.sum(subjectIDs == s) for s in old_subjects])
+    num_replayed = np.searchsorted(np.cumsum(counts), replay * num_new) + 1
+    return old_subjects[:num_replayed]
+
+# normalize_tensor standardizes an n dimesional np.array to have zero mean and
+# maximal absolute value of 1 (as in the cross-validation scripts)
+def normalize_tensor(data_tensor):
+    data_tensor -= np.mean(data_tensor)
+    data_tensor /= np.max(np.abs(data_tensor))
+    return data_tensor
+
+# encode_labels returns the labels as fed to the network: one-hot encoding for
+# classification, a column vector for regression
+def encode_labels(labels, task, num_labels):
+    if task == 'class':
+        return (np.arange(num_labels) == labels[:, None]).astype(np.float32)
+    return np.reshape(labels, (-1, 1)).astype(np.float32)
+
+# score returns the accuracy (in %) of a classifier or the mean absolute error
+# of a regression
+def score(predictions, labels, task):
+    if task == 'class':
+        return 100.0 * np.mean(np.argmax(predictions, 1) == labels)
+    return np.mean(np.abs(predictions[:, 0] - labels))
+
+# fine_tune trains the network for a given number of steps starting from the
+# given weights
+# INPUT: weights: dictionary of weights and biases (see ccnn_weights.py)
+#        train_data: 4D tensor (np.array) of normalized training instances
+#        train_labels: 2D tensor (np.array) of encoded labels
+#        task: 'class' (cross-entropy) or 'regr' (mean squared error)
+#        num_steps: number of training steps
+#        learning_rate: learning rate of the Adam optimizer
+#        train_layers: 'all', or 'dense' to keep the convolutional layers
+#                      constant (as in ccnn_regr_transfer.py)
+#        seed: graph-level random seed (None = not seeded)
+# OUTPUT: dictionary of the updated weights and biases
+def fine_tune(weights, train_data, train_labels, task, num_steps, learning_rate,
+              train_layers='all', seed=None):
+    import tensorflow as tf
+    from ccnn_model import model
+    from ccnn_session import session_config
+    if train_labels.shape[0] <= BATCH_SIZE:
+        raise ValueError('%d training instances, at least %d are needed'
+                         % (train_labels.shape[0], BATCH_SIZE + 1))
+    image_size = train_data.shape[1]
+    graph = tf.Graph()
+    with graph.as_default():
+        if seed is not None:
+            tf.set_random_seed(seed)
+        tf_train_dataset = tf.placeholder(tf.float32, shape=(BATCH_SIZE, image_size, image_size, 1))
+        tf_train_labels = tf.placeholder(tf.float32, shape=(BATCH_SIZE, train_labels.shape[1]))
+        variables = {}
+        for name, value in weights.items():
+            if train_layers == 'dense' and name in CONV_LAYERS:
+                variables[name] = tf.constant(np.asarray(value), name=name)
+            else:
+                variables[name] = tf.Variable(np.asarray(value), name=name)
+        logits = model(tf_train_dataset, variables, KEEP_PR)
+        if task == 'class':
+            loss = tf.reduce_mean(
+                    tf.nn.softmax_cross_entropy_with_logits(labels=tf_train_labels, logits=logits))
+        else:
+            loss = tf.losses.mean_squared_error(labels=tf_train_labels, predictions=logits)
+        optimizer = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+
+    with tf.Session(graph=graph, config=session_config()) as session:
+        tf.global_variables_initializer().run()
+        for step in range(num_steps):
+            offset = (step * BATCH_SIZE) % (train_labels.shape[0] - BATCH_SIZE)
+            if offset == 0:
+                permutation = np.random.permutation(train_labels.shape[0])
+                train_data, train_labels = train_data[permutation], train_labels[permutation]
+            feed_dict = {tf_train_dataset: train_data[offset:(offset + BATCH_SIZE)],
+                         tf_train_labels: train_labels[offset:(offset + BATCH_SIZE)]}
+            _, l = session.run([optimizer, loss], feed_dict=feed_dict)
+            if step % 100 == 0:
+                print('    Minibatch loss at step %d: %f' % (step, l))
+        return dict((name, session.run(value)) for name, value in variables.items())
+
+# update_archive updates the weights of every fold of an archive on the new
+# subjects of a dataset (see the description of the module)
+# INPUT: path: parent weights archive (string)
+#        out: archive the updated weights are saved into (string)
+#        dataset: tensor store (or old pickle file) of the target dataset
+#        labels_file: labels file of the dataset
+#        task: 'class' or 'regr'
+#        num_steps: number of training steps per fold
+#        replay: ratio of replayed to new instances
+#        IDs, new_subjects: see trained_subjects
+#        learning_rate: learning rate (default: that of the scripts)
+#        train_layers: see fine_tune
+#        seed: random seed of the update (None = not seeded)
+# OUTPUT: the lineage of the updated archive (dictionary)
+def update_archive(path, out, dataset, labels_file, task, num_steps=500, replay=1.0,
+                   IDs=None, new_subjects=None, learning_rate=None, train_layers='all', seed=None):
+    from ccnn_inference import predict
+    from ccnn_tensor_store import check_subjects, load_normalized_instances
+    from ccnn_transfer_matrix import label_column
+    from ccnn_weight_bank import checksum
+    from ccnn_weights import (archive_base, archive_folds, create_archive, load_weights,
+                              save_fold_weights, save_weights)
+
+    if learning_rate is None:
+        learning_rate = LEARNING_RATE[task]
+    if seed is not None:
+        np.random.seed(seed)
+    labels_csv = np.loadtxt(labels_file, delimiter=',')
+    subjectIDs = labels_csv[:, 0]
+    check_subjects(dataset, subjectIDs)
+    labels = labels_csv[:, label_column(labels_file, task)]
+    num_labels = len(np.unique(labels)) if task == 'class' else 1
+
+    folds = archive_folds(path)
+    fold_subjects = trained_subjects(path, folds, IDs, np.unique(subjectIDs), new_subjects)
+    parent = read_lineage(path)
+
+    start = time.time()
+    create_archive(out, None if folds is None else len(folds), archive_base(path))
+    lineage = {'archive': out, 'parent': path, 'parent_checksum': checksum(path),
+               'generation': 1 if parent is None else parent['generation'] + 1,
+               'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'task': task,
+               'dataset': dataset, 'labels': labels_file, 'steps': num_steps, 'replay': replay,
+               'learning_rate': learning_rate, 'train_layers': train_layers, 'seed': seed,
+               'new_subjects': [], 'folds': {},
+               'history': [] if parent is None else [dict((key, value) for key, value in parent.items()
+                                                          if key not in ('folds', 'history'))] + parent['history']}
+    all_new = set()
+    for fold in sorted(fold_subjects, key=lambda k: -1 if k is None else k):
+        old_subjects, heldout = fold_subjects[fold]
+        if new_subjects is not None:
+            new = np.intersect1d(new_subjects, subjectIDs)
+        else:
+            new = np.setdiff1d(np.unique(subjectIDs), np.union1d(old_subjects, heldout))
+        all_new.update(new.tolist())
+        name = 'all' if fold is None else str(fold)
+        weights = load_weights(path, fold=fold, mmap=False)
+        if len(new) == 0:
+            print('Fold %s: no new subjects, weights are copied' % name)
+            updated = weights
+            replayed = np.array([])
+        else:
+            new_instances = np.nonzero(np.in1d(subjectIDs, new))[0]
+            replayed = replay_sample(old_subjects, subjectIDs, len(new_instances), replay)
+            train_instances = np.concatenate([new_instances, np.nonzero(np.in1d(subjectIDs, replayed))[0]])
+            print('Fold %s: %d new subjects (%d instances), %d replayed subjects, %d steps'
+                  % (name, len(new), len(new_instances), len(replayed), num_steps))
+            train_data = normalize_tensor(load_normalized_instances(dataset, train_instances))
+            train_labels = encode_labels(labels[train_instances], task, num_labels)
+            updated = fine_tune(weights, train_data, train_labels, task, num_steps, learning_rate,
+                                train_layers, None if seed is None else seed + (fold or 0))
+            del train_data
+        entry = {'trained_subjects': np.union1d(old_subjects, new).tolist(),
+                 'heldout_subjects': np.asarray(heldout).tolist(),
+                 'new_subjects': len(new), 'replayed_subjects': len(replayed)}
+        heldout_instances = np.nonzero(np.in1d(subjectIDs, heldout))[0]
+        if len(heldout_instances):
+            heldout_data = normalize_tensor(load_normalized_instances(dataset, heldout_instances))
+            entry['heldout_before'] = float(score(predict(heldout_data, weights), labels[heldout_instances], task))
+            entry['heldout_after'] = float(score(predict(heldout_data, updated), labels[heldout_instances], task))
+            print('Fold %s: held-out %s %.2f before, %.2f after the update'
+                  % (name, 'accuracy' if task == 'class' else 'MAE', entry['heldout_before'], entry['heldout_after']))
+        lineage['folds'][name] = entry
+        if fold is None:
+            save_weights(out, updated)
+        else:
+            save_fold_weights(out, fold, updated)
+
+    lineage['new_subjects'] = sorted(all_new)
+    lineage['seconds'] = time.time() - start
+    _write_lineage(out, lineage)
+    return lineage
+
+# default_output returns the name of the archive an update is saved into: the
+# name of the root archive of the lineage with '_update<generation>' appended
+def default_output(path):
+    from ccnn_weights import archive_path
+    parent = read_lineage(path)
+    if parent is None:
+        return archive_path(path) + '_update1'
+    root = parent['history'][-1]['parent'] if parent['history'] else parent['parent']
+    return archive_path(root) + '_update%d' % (parent['generation'] + 1)
+
+# print_lineage prints the chain of updates leading to an archive
+def print_lineage(path):
+    lineage = read_lineage(path)
+    if lineage is None:
+        print('%s has no lineage (written by a training script)' % path)
+        return
+    for entry in [lineage] + lineage['history']:
+        print('%s (generation %d, %s): %d new subjects, %d steps, replay %.2f, from %s (%s)' % (
+            entry['archive'], entry['generation'], entry['created'], len(entry['new_subjects']),
+            entry['steps'], entry['replay'], entry['parent'], entry['parent_checksum'][:12]))
+
+# %% ######################## Updating the weights ############################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Incremental update of target weights on new subjects.')
+    parser.add_argument('weights', help='weights archive to update (or to show the lineage of)')
+    parser.add_argument('--lineage', action='store_true', help='show the lineage of the archive')
+    parser.add_argument('--task', choices=['class', 'regr'], default='class')
+    parser.add_argument('--dataset', default='CORR_tensor_inhouse', help='tensor store of the target dataset')
+    parser.add_argument('--labels', default='labels_inhouse.txt', help='labels file of the dataset')
+    parser.add_argument('--folds', default=None,
+                        help='folds file of the cross-validation script (first update of its archive)')
+    parser.add_argument('--new-subjects', default=None,
+                        help='text file of the IDs of the new subjects (default: subjects not trained on yet)')
+    parser.add_argument('--steps', type=int, default=500, help='training steps per fold')
+    parser.add_argument('--replay', type=float, default=1.0, help='ratio of replayed to new instances')
+    parser.add_argument('--learning-rate', type=float, default=None)
+    parser.add_argument('--train-layers', choices=['all', 'dense'], default='all',
+                        help="'dense' keeps the convolutional layers constant")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--out', default=None, help='archive the updated weights are saved into')
+    args = parser.parse_args()
+
+    if args.lineage:
+        print_lineage(args.weights)
+    else:
+        IDs = None if args.folds is None else np.load(args.folds)
+        new_subjects = None if args.new_subjects is None else np.loadtxt(args.new_subjects, delimiter=',', ndmin=1)
+        out = args.out if args.out is not None else default_output(args.weights)
+        lineage = update_archive(args.weights, out, args.dataset, args.labels, args.task, args.steps,
+                                 args.replay, IDs, new_subjects, args.learning_rate, args.train_layers,
+                                 args.seed)
+        print('Updated weights (%d new subjects) saved into %s in %.1f s'
+              % (len(lineage['new_subjects']), out, lineage['seconds']))
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the forward pass of the connectome-convolutional neural
+network in NumPy, so that trained (or transferred) networks can be evaluated on
+resting-state functional connectivity matrices without importing TensorFlow.
+Dropout is not applied (keep_pr of dropout is 1 at test time), thus the
+predictions are identical to those computed by the TensorFlow graphs of the
+training scripts.
+
+Running this module as a script computes the predictions of the network stored
+in a weights archive for the connectivity matrices of a dataset (tensor store
+or pickle file, see 'ccnn_tensor_store.py'), and saves them into an .npz file:
+
+    python ccnn_inference.py weights_public CORR_tensor_inhouse predictions_inhouse.npz [fold]
+
+For the archive of a cross-validation script, the networks of all folds are
+evaluated together as an ensemble unless a fold is given (see ensemble_predict),
+and the mean prediction of the folds is saved with the prediction of each fold
+and the dispersion of the predictions.
+"""
+# Importing necessary libraries
+import sys
+
+if __name__ == '__main__':
+    # Run as a script: threads are set before NumPy is imported (BLAS threads,
+    # see ccnn_session.py); importing the module leaves them to the caller
+    from ccnn_session import apply_threads
+    apply_threads()
+import numpy as np
+from ccnn_tensor_store import load_normalized_tensor
+from ccnn_weights import SparseRows, archive_folds, load_weights
+
+# %% ####################### Function definitions #############################
+
+# softmax computes the soft-max of logits along the second (1.) dimension
+def softmax(logits):
+    e = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    return e / np.sum(e, axis=1, keepdims=True)
+
+# _scaled multiplies the output of a layer by the per-channel scales of its
+# weights if these are quantized to int8 (see ccnn_quantize.py); the scales
+# of the networks of an ensemble have a leading (fold) dimension
+def _scaled(output, weights, name):
+    scale = weights.get(name + '_scale')
+    if scale is None:
+        return output
+    return output * scale.reshape(scale.shape[:-1] + (1,) * (output.ndim - scale.ndim) + scale.shape[-1:])
+
+# _as_float32 converts weights (np.array or SparseRows) to float32, except
+# int8 weights, which are kept in memory as they are (see _float)
+def _as_float32(value):
+    if isinstance(value, SparseRows):
+        if value.values.dtype == np.int8:
+            return value
+        return SparseRows(value.shape, value.rows, np.asarray(value.values, dtype=np.float32))
+    value = np.asarray(value)
+    if value.dtype == np.int8:
+        return value
+    return np.asarray(value, dtype=np.float32)
+
+# _float returns the weights of a layer in float32 for its matrix product: a
+# float32 copy of int8 weights that only lives during the product of the layer
+# (NumPy has no int8 matrix product), the weights themselves otherwise
+def _float(weights):
+    return weights.astype(np.float32, copy=False)
+
+# _dot multiplies the inputs of a layer by its weights reshaped into a matrix
+# [inputs, outputs]; for weights pruned by rows (SparseRows, see
+# ccnn_prune.py) only the inputs of the remaining rows are multiplied
+def _dot(inputs, weights):
+    if isinstance(weights, SparseRows):
+        return np.dot(inputs[:, weights.rows], _float(weights.values))
+    return np.dot(inputs, _float(weights.reshape(-1, weights.shape[-1])))
+
+# conv_features computes the output of the two convolutional layers
+# INPUT: data: 4D tensor (np.array) of connectivity matrices, instances are
+#              concatenated along the first (0.) dimension
+#        weights: dictionary of weights and biases (see ccnn_weights.py); the
+#                 column convolution is given either by 'layer2_weights' or by
+#                 its low-rank factors 'layer2_weights_u' and 'layer2_weights_v'
+#                 (see ccnn_compress.py); the weights may be quantized to
+#                 int8 with per-channel scales (see ccnn_quantize.py), or
+#                 pruned by rows (SparseRows, see ccnn_prune.py)
+# OUTPUT: 2D tensor (np.array) of the 256 features of each instance
+def conv_features(data, weights):
+    w1 = weights['layer1_weights']
+    w2 = weights.get('layer2_weights', weights.get('layer2_weights_u'))
+    num_instances, num_roi = data.shape[0], data.shape[1]
+    if w1.shape[1] != num_roi or w2.shape[0] != num_roi:
+        raise ValueError('the weights are defined on %d ROIs, the connectivity matrices have %d ROIs'
+                         % (w2.shape[0], num_roi))
+    # First layer: line-by-line convolution with ReLU (a matrix product over
+    # the columns of each connectivity matrix)
+    hidden = _scaled(np.dot(data[:, :, :, 0], _float(w1[0, :, 0, :])), weights, 'layer1_weights')
+    hidden = np.maximum(hidden + weights['layer1_biases'], 0)
+    # Second layer: convolution by column with ReLU (a matrix product over the
+    # rows and the channels of the first layer, or two thin products if the
+    # layer is factorized)
+    hidden = _dot(hidden.reshape(num_instances, -1), w2)
+    if 'layer2_weights' in weights:
+        hidden = _scaled(hidden, weights, 'layer2_weights')
+    else:
+        hidden = _scaled(hidden, weights, 'layer2_weights_u')
+        w2_v = weights['layer2_weights_v']
+        hidden = _scaled(np.dot(hidden, _float(w2_v.reshape(-1, w2_v.shape[3]))), weights, 'layer2_weights_v')
+    return np.maximum(hidden + weights['layer2_biases'], 0)
+
+# dense_output computes the output (logits) of the fully connected layers
+# INPUT: features: 2D tensor (np.array), output of conv_features
+#        weights: dictionary of weights and biases (see ccnn_weights.py)
+# OUTPUT: 2D tensor (np.array) of logits
+def dense_output(features, weights):
+    hidden = _scaled(_dot(features, weights['layer3_weights']), weights, 'layer3_weights')
+    hidden = np.maximum(hidden + weights['layer3_biases'], 0)
+    return _scaled(np.dot(hidden, _float(weights['layer4_weights'])), weights, 'layer4_weights') + weights['layer4_biases']
+
+# predict computes the predictions of the network in batches of instances
+# INPUT: data: 4D tensor (np.array) of normalized connectivity matrices
+#        weights: dictionary of weights and biases (see ccnn_weights.py)
+#        batch_size: number of instances processed at once
+# OUTPUT: 2D tensor (np.array) of predictions: soft-max of the logits for
+#         classification (more than one output unit), the output itself for
+#         regression
+def predict(data, weights, batch_size=256):
+    weights = dict((name, _as_float32(value)) for name, value in weights.items())
+    outputs = []
+    for offset in range(0, data.shape[0], batch_size):
+        batch = np.asarray(data[offset:(offset + batch_size)], dtype=np.float32)
+        outputs.append(dense_output(conv_features(batch, weights), weights))
+    logits = np.vstack(outputs)
+    if logits.shape[1] > 1:
+        return softmax(logits)
+    return logits
+
+# ensemble_output computes the outputs (logits) of the networks of all folds of
+# a cross-validation archive in a single pass, the weights of the folds being
+# stacked along a leading dimension (as returned by load_weights with
+# fold=None); the layers are evaluated as batched matrix products over the folds
+# INPUT: data: 4D tensor (np.array) of normalized connectivity matrices
+#        weights: dictionary of stacked weights and biases
+# OUTPUT: 3D tensor (np.array) [num_folds, num_instances, num_labels] of logits
+def ensemble_output(data, weights):
+    w1 = weights['layer1_weights']
+    w2 = weights.get('layer2_weights', weights.get('layer2_weights_u'))
+    num_folds, num_instances, num_roi = w1.shape[0], data.shape[0], data.shape[1]
+    if w1.shape[2] != num_roi or w2.shape[1] != num_roi:
+        raise ValueError('the weights are defined on %d ROIs, the connectivity matrices have %d ROIs'
+                         % (w2.shape[1], num_roi))
+    # First layer: line-by-line convolution with ReLU for every fold at once
+    hidden = _scaled(np.einsum('nrc,fck->fnrk', data[:, :, :, 0], _float(w1[:, 0, :, 0, :])), weights, 'layer1_weights')
+    hidden += weights['layer1_biases'][:, None, None, :]
+    hidden = np.maximum(hidden, 0)
+    # Second layer: convolution by column with ReLU (batched matrix products
+    # over the folds, two if the layer is factorized)
+    hidden = np.matmul(hidden.reshape(num_folds, num_instances, -1),
+                       _float(w2.reshape(num_folds, -1, w2.shape[4])))
+    if 'layer2_weights' in weights:
+        hidden = _scaled(hidden, weights, 'layer2_weights')
+    else:
+        hidden = _scaled(hidden, weights, 'layer2_weights_u')
+        w2_v = weights['layer2_weights_v']
+        hidden = _scaled(np.matmul(hidden, _float(w2_v.reshape(num_folds, -1, w2_v.shape[4]))), weights, 'layer2_weights_v')
+    hidden = np.maximum(hidden + weights['layer2_biases'][:, None, :], 0)
+    # Fully connected layers
+    hidden = _scaled(np.matmul(hidden, _float(weights['layer3_weights'])), weights, 'layer3_weights')
+    hidden = np.maximum(hidden + weights['layer3_biases'][:, None, :], 0)
+    return (_scaled(np.matmul(hidden, _float(weights['layer4_weights'])), weights, 'layer4_weights')
+            + weights['layer4_biases'][:, None, :])
+
+# ensemble_predict computes the predictions of the networks of all folds of a
+# cross-validation archive in batches of instances, and aggregates them
+# INPUT: data: 4D tensor (np.array) of normalized connectivity matrices
+#        weights: dictionary of stacked weights and biases (see ensemble_output)
+#        batch_size: number of instances processed at once
+# OUTPUT: dictionary of
+#         'models': predictions of each fold [num_folds, num_instances, num_labels]
+#                   (as returned by predict for the weights of the fold)
+#         'mean': mean of the predictions of the folds
+#         'std': standard deviation of the predictions of the folds
+#         and, for classification:
+#         'vote': fraction of the folds voting for each class
+#         'agreement': fraction of the folds voting for the class of the
+#                      highest mean probability
+def ensemble_predict(data, weights, batch_size=256):
+    weights = dict((name, _as_float32(value)) for name, value in weights.items())
+    outputs = []
+    for offset in range(0, data.shape[0], batch_size):
+        batch = np.asarray(data[offset:(offset + batch_size)], dtype=np.float32)
+        outputs.append(ensemble_output(batch, weights))
+    logits = np.concatenate(outputs, axis=1)
+    num_labels = logits.shape[2]
+    if num_labels > 1:
+        e = np.exp(logits - np.max(logits, axis=2, keepdims=True))
+        models = e / np.sum(e, axis=2, keepdims=True)
+    else:
+        models = logits
+    result = {'models': models, 'mean': np.mean(models, axis=0), 'std': np.std(models, axis=0)}
+    if num_labels > 1:
+        votes = np.argmax(models, axis=2)
+        result['vote'] = np.mean(votes[:, :, None] == np.arange(num_labels), axis=0)
+        result['agreement'] = np.mean(votes == np.argmax(result['mean'], axis=1), axis=0)
+    return result
+
+# %% ####################### Scoring connectivity data ########################
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('usage: python ccnn_inference.py WEIGHTS DATASET OUTPUT_NPZ [FOLD]')
+        sys.exit(1)
+    weight_archive, tensor_store, output_file = sys.argv[1:4]
+    fold = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    # NaNs are replaced with 0s and data are normalized at loading time
+    data_tensor, data_stats = load_normalized_tensor(tensor_store)
+
+    if fold is None and archive_folds(weight_archive) is not None:
+        # Ensemble of the networks of the folds
+        ensemble = ensemble_predict(data_tensor, load_weights(weight_archive))
+        predictions = ensemble.pop('mean')
+        np.savez(output_file, predictions=predictions, **ensemble)
+    else:
+        predictions = predict(data_tensor, load_weights(weight_archive, fold=fold))
+        np.savez(output_file, predictions=predictions)
+    print('Predictions of %d instances saved into %s' % (predictions.shape[0], output_file))
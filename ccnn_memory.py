@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the memory accounting of the scripts. The scripts are
+divided into phases (loading the data, preparing the data of a fold, building
+the graph, training, evaluation, saving the weights), and at the end of each
+phase the resident set size (RSS) of the process, its peak during the phase
+and, optionally, the peak of the memory allocated by Python and NumPy during
+the phase (tracemalloc) are written into the run log (standard output).
+
+A memory budget can be set (in MB). The scripts announce large allocations
+before making them (e.g. the normalized copies of the data of a fold, the test
+set held as a constant of the graph), and the run stops with a MemoryError
+before the allocation if it would exceed the budget; the run also stops if the
+peak RSS of a phase exceeds the budget.
+
+Settings (see 'ccnn_options.py'): 'memory_budget_mb' (e.g.
+CCNN_MEMORY_BUDGET_MB=8000), 'memory_trace' (CCNN_MEMORY_TRACE=true switches
+tracemalloc on) and 'memory_report' (name of a JSON file the phases are saved
+into).
+"""
+# Importing necessary libraries
+import json
+import os
+import time
+import tracemalloc
+
+from ccnn_options import option
+
+MB = 1024.0**2
+
+# %% ####################### Function definitions #############################
+
+def _status_bytes(field):
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+# current_rss returns the resident set size of the process (bytes)
+def current_rss():
+    rss = _status_bytes('VmRSS')
+    if rss is None:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return rss
+
+# peak_rss returns the peak resident set size of the process (bytes) since the
+# last call of reset_peak_rss (or since the start of the process)
+def peak_rss():
+    peak = _status_bytes('VmHWM')
+    if peak is None:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak
+
+# reset_peak_rss resets the peak resident set size of the process (Linux only;
+# elsewhere the peak since the start of the process is reported)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+class MemoryMonitor(object):
+    """Records the memory use of the phases of a script.
+
+    phase(name) ends the current phase (writing its memory use into the run
+    log) and starts the next one; require(nbytes, what) checks a planned
+    allocation against the budget; end() ends the last phase and saves the
+    report.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        budget = option('memory_budget_mb', None)
+        self.budget = None if budget is None else float(budget) * MB
+        self.trace = bool(option('memory_trace', False))
+        self.report_file = option('memory_report', None)
+        self.phases = []
+        self.current = None
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _start(self, name):
+        reset_peak_rss()
+        if self.trace:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # Python < 3.9: restarting the trace resets the peak, but also
+                # forgets the memory allocated in the previous phases
+                tracemalloc.stop()
+                tracemalloc.start()
+        self.current = {'phase': name, 'start': time.time(), 'rss_start': current_rss()}
+
+    def _finish(self):
+        phase = self.current
+        self.current = None
+        phase['seconds'] = time.time() - phase.pop('start')
+        phase['rss'] = current_rss()
+        phase['rss_peak'] = max(peak_rss(), phase['rss'])
+        line = '[memory] %s %s: %.1f s, RSS %.1f MB (start %.1f MB, peak %.1f MB)' % (
+            self.name, phase['phase'], phase['seconds'], phase['rss'] / MB,
+            phase['rss_start'] / MB, phase['rss_peak'] / MB)
+        if self.trace:
+            phase['traced'], phase['traced_peak'] = tracemalloc.get_traced_memory()
+            line += ', traced peak %.1f MB' % (phase['traced_peak'] / MB)
+        print(line)
+        self.phases.append(phase)
+        if self.budget is not None and phase['rss_peak'] > self.budget:
+            raise MemoryError('%s: peak RSS of phase %s (%.1f MB) exceeded the memory budget (%.1f MB)'
+                              % (self.name, phase['phase'], phase['rss_peak'] / MB, self.budget / MB))
+
+    # phase ends the current phase and starts a new one
+    def phase(self, name):
+        if self.current is not None:
+            self._finish()
+        self._start(name)
+
+    # require stops the run if an allocation of nbytes (described by what)
+    # would exceed the memory budget
+    def require(self, nbytes, what):
+        if self.budget is None:
+            return
+        rss = current_rss()
+        if rss + nbytes > self.budget:
+            raise MemoryError('%s: %s (%.1f MB) would exceed the memory budget (%.1f MB, RSS %.1f MB)'
+                              % (self.name, what, nbytes / MB, self.budget / MB, rss / MB))
+
+    # end ends the last phase, writes the peak of each phase into the run log
+    # and saves them into the report file (if given)
+    def end(self):
+        if self.current is not None:
+            self._finish()
+        if not self.phases:
+            return
+        worst = max(self.phases, key=lambda phase: phase['rss_peak'])
+        print('[memory] %s: highest peak RSS %.1f MB in phase %s' % (
+            self.name, worst['rss_peak'] / MB, worst['phase']))
+        if self.report_file:
+            with open(self.report_file, 'w') as f:
+                json.dump({'name': self.name, 'pid': os.getpid(), 'budget': self.budget,
+                           'phases': self.phases}, f, indent=1)
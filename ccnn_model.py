@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the architecture of the connectome-convolutional neural
+network as a TensorFlow graph, for tools that build the network for an
+arbitrary number of ROIs (e.g. 'ccnn_sizing.py'). TensorFlow is imported only
+when a graph is built.
+
+This module is partially based on code from Deep learning course by Udacity:
+https://github.com/tensorflow/tensorflow/blob/master/tensorflow/examples/udacity/4_convolutions.ipynb
+"""
+# %% ####################### Function definitions #############################
+
+# layer_shapes returns the shapes of the weights and bias terms of the network
+# INPUT: num_roi: number of ROIs of the atlas
+#        num_labels: number of output units (2 for classification of age
+#                    category, 1 for regression of chronological age)
+#        num_channels: number of input channels
+#        layer2_rank: if given, the column convolution is factorized into two
+#                     convolutions of rank layer2_rank (see ccnn_compress.py)
+# OUTPUT: dictionary mapping layer names to shapes (lists)
+def layer_shapes(num_roi, num_labels, num_channels=1, layer2_rank=None):
+    shapes = {'layer1_weights': [1, num_roi, num_channels, 64], 'layer1_biases': [64],
+              'layer2_weights': [num_roi, 1, 64, 256], 'layer2_biases': [256],
+              'layer3_weights': [256, 96], 'layer3_biases': [96],
+              'layer4_weights': [96, num_labels], 'layer4_biases': [num_labels]}
+    if layer2_rank is not None:
+        del shapes['layer2_weights']
+        shapes['layer2_weights_u'] = [num_roi, 1, 64, layer2_rank]
+        shapes['layer2_weights_v'] = [1, 1, layer2_rank, 256]
+    return shapes
+
+# xavier_weights creates trainable weights (Xavier initialization for better
+# convergence in deep layers) and bias terms in the default graph
+# OUTPUT: dictionary mapping layer names to tf.Variables
+def xavier_weights(num_roi, num_labels, num_channels=1, layer2_rank=None):
+    import tensorflow as tf
+    shapes = layer_shapes(num_roi, num_labels, num_channels, layer2_rank)
+    weights = {}
+    for name, shape in shapes.items():
+        if '_weights' in name:
+            weights[name] = tf.get_variable(name, shape=shape,
+                                            initializer=tf.contrib.layers.xavier_initializer())
+        else:
+            bias = 0.001 if name in ('layer1_biases', 'layer2_biases') else 0.01
+            weights[name] = tf.Variable(tf.constant(bias, shape=shape), name=name)
+    return weights
+
+# model computes the output (logits) of the network
+# INPUT: data: 4D tensor [instances, numROI, numROI, num_channels]
+#        weights: dictionary mapping layer names to tensors
+#        keep_pr: the probability that each element is kept during dropout
+def model(data, weights, keep_pr):
+    import tensorflow as tf
+    # First layer: line-by-line convolution with ReLU and dropout
+    conv = tf.nn.conv2d(data, weights['layer1_weights'], [1, 1, 1, 1], padding='VALID')
+    hidden = tf.nn.dropout(tf.nn.relu(conv+weights['layer1_biases']), keep_pr)
+    # Second layer: convolution by column with ReLU and dropout (two thin
+    # convolutions if the layer is factorized)
+    if 'layer2_weights' in weights:
+        conv = tf.nn.conv2d(hidden, weights['layer2_weights'], [1, 1, 1, 1], padding='VALID')
+    else:
+        conv = tf.nn.conv2d(hidden, weights['layer2_weights_u'], [1, 1, 1, 1], padding='VALID')
+        conv = tf.nn.conv2d(conv, weights['layer2_weights_v'], [1, 1, 1, 1], padding='VALID')
+    hidden = tf.nn.dropout(tf.nn.relu(conv+weights['layer2_biases']), keep_pr)
+    # Third layer: fully connected hidden layer with dropout and ReLU
+    shape = hidden.get_shape().as_list()
+    reshape = tf.reshape(hidden, [-1, shape[1] * shape[2] * shape[3]])
+    hidden = tf.nn.dropout(tf.nn.relu(tf.matmul(reshape, weights['layer3_weights']) + weights['layer3_biases']), keep_pr)
+    # Fourth (output) layer: fully connected layer with logits as output
+    return tf.matmul(hidden, weights['layer4_weights']) + weights['layer4_biases']
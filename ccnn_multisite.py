@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+This script pretrains the connectome-convolutional neural network on several
+datasets (sites) at once, e.g. the public dataset, the NKI-RS subset, the
+in-house dataset and future cohorts, to build source weights for the transfer
+learning scripts. 'ccnn_class_publictrain.py' holds the whole public dataset in
+memory; here the training batches are streamed from the tensor stores of the
+sites (see 'ccnn_tensor_store.py'): the chunks of every store are memory-mapped,
+and only the instances of the current batch are read and normalized (with the
+statistics of their own dataset), thus the datasets are never concatenated and
+their combined size may exceed the memory.
+
+The site of each instance of a batch is drawn with the sampling weights of the
+sites (if no weight is given, proportional to their sizes, i.e. as if the
+datasets were concatenated; equal weights balance small and large cohorts;
+sites without a weight get 1 if the others have one), and the instances of a
+site are drawn in a random order, reshuffled whenever all instances of the site
+have been seen (as the scripts do with their training data). All sites must
+have the same number of ROIs, and the same labels (age category in the labels
+column of the task).
+
+    python ccnn_multisite.py --task class --sites public inhouse=0.5 NKI-RS_subset=0.5 [--steps 5001] [--out weights_multisite]
+    python ccnn_multisite.py --task regr --sites public_regr NKI-RS_subset CORR_tensor_new:labels_new.csv=2 --init weights_multisite
+
+A site is given by its dataset name (see DATASETS in 'ccnn_transfer_matrix.py')
+or as TENSOR_STORE:LABELS_FILE, optionally followed by =WEIGHT. The weights are
+saved into 'weights_multisite' ('weights_multisite_regr' for regression, or the
+archive given by --out).
+
+This script is partially based on code from Deep learning course by Udacity:
+https://github.com/tensorflow/tensorflow/blob/master/tensorflow/examples/udacity/4_convolutions.ipynb
+"""
+# Importing necessary libraries
+import argparse
+import time
+
+if __name__ == '__main__':
+    # Run as a script: threads are set before NumPy is imported (BLAS threads,
+    # see ccnn_session.py); importing the module leaves them to the caller
+    from ccnn_session import apply_threads
+    apply_threads()
+import numpy as np
+from ccnn_preprocess import normalize_chunk
+from ccnn_tensor_store import is_store, iter_chunks, read_index, store_path
+
+# Learning rate and number of iterations of the pretraining scripts
+# ('ccnn_class_publictrain.py', 'ccnn_regr_public.py')
+LEARNING_RATE = {'class': 0.001, 'regr': 0.0005}
+NUM_STEPS = {'class': 5001, 'regr': 10001}
+KEEP_PR = 0.6   # the probability that each element is kept during dropout
+
+# %% ####################### Function definitions #############################
+
+class SiteStream(object):
+    """Streams the instances of a dataset from its tensor store.
+
+    The chunks of the store are memory-mapped; read(indices) reads the given
+    instances (positions in the dataset) and normalizes them with the
+    statistics of the dataset, and draw(n) returns the positions of the next n
+    instances of a random order of the dataset, reshuffled whenever all
+    instances have been drawn.
+    """
+
+    def __init__(self, name, tensor_store, labels, random):
+        path = store_path(tensor_store)
+        if not is_store(path) or 'statistics' not in read_index(path):
+            raise ValueError('%s is not a tensor store with statistics (old pickle files can be converted '
+                             'with ccnn_preprocess.py)' % tensor_store)
+        index = read_index(path)
+        self.name = name
+        self.num_roi = index['num_roi']
+        self.stats = index['statistics']
+        self.chunks = [data for chunk, data in iter_chunks(path)]
+        self.offsets = np.cumsum([0] + [data.shape[0] for data in self.chunks])
+        self.size = int(self.offsets[-1])
+        if len(labels) != self.size:
+            raise ValueError('%s has %d instances, its labels file %d rows' % (tensor_store, self.size, len(labels)))
+        self.labels = labels
+        self.random = random
+        self.order = random.permutation(self.size)
+        self.cursor = 0
+        self.epochs = 0
+
+    # draw returns the positions of the next n instances
+    def draw(self, n):
+        drawn = []
+        while n > 0:
+            if self.cursor == self.size:
+                self.order = self.random.permutation(self.size)
+                self.cursor = 0
+                self.epochs += 1
+            taken = self.order[self.cursor:(self.cursor + n)]
+            self.cursor += len(taken)
+            n -= len(taken)
+            drawn.append(taken)
+        return np.concatenate(drawn)
+
+    # read reads and normalizes the given instances, in the order of indices;
+    # each chunk is read once, in increasing order of the instances
+    def read(self, indices):
+        data = np.empty((len(indices), self.num_roi, self.num_roi, 1), dtype=np.float32)
+        chunk_of = np.searchsorted(self.offsets, indices, side='right') - 1
+        for k in np.unique(chunk_of):
+            selected = np.nonzero(chunk_of == k)[0]
+            selected = selected[np.argsort(indices[selected])]
+            data[selected] = normalize_chunk(self.chunks[k][indices[selected] - self.offsets[k]], self.stats)
+        return data
+
+class MultiSiteSampler(object):
+    """Draws training batches from several sites with sampling weights.
+
+    The site of each instance of a batch is drawn with probabilities
+    proportional to the sampling weights; the instances of each site are drawn
+    by its SiteStream. counts holds the number of instances drawn from each
+    site.
+    """
+
+    def __init__(self, streams, weights, batch_size, seed=None):
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(weights) != len(streams) or np.any(weights < 0) or not np.sum(weights) > 0:
+            raise ValueError('the sampling weights must be non-negative, one per site, and not all 0')
+        if len(set(stream.num_roi for stream in streams)) > 1:
+            raise ValueError('the sites have different numbers of ROIs: %s'
+                             % ', '.join('%s %d' % (s.name, s.num_roi) for s in streams))
+        self.streams = streams
+        self.probabilities = weights / np.sum(weights)
+        self.batch_size = batch_size
+        self.random = np.random.RandomState(seed)
+        self.counts = np.zeros(len(streams), dtype=np.int64)
+
+    # next_batch returns the connectivity matrices, labels and sites of the
+    # instances of the next batch
+    def next_batch(self):
+        sites = self.random.choice(len(self.streams), self.batch_size, p=self.probabilities)
+        data = np.empty((self.batch_size, self.streams[0].num_roi, self.streams[0].num_roi, 1), dtype=np.float32)
+        labels = np.empty((self.batch_size,) + self.streams[0].labels.shape[1:], dtype=np.float32)
+        for site in np.unique(sites):
+            selected = np.nonzero(sites == site)[0]
+            indices = self.streams[site].draw(len(selected))
+            data[selected] = self.streams[site].read(indices)
+            labels[selected] = self.streams[site].labels[indices]
+        self.counts += np.bincount(sites, minlength=len(self.streams))
+        return data, labels, sites
+
+# parse_site returns the dataset and the sampling weight (None = not given) of
+# a site given as DATASET[=WEIGHT]
+def parse_site(site):
+    if '=' in site:
+        dataset, weight = site.rsplit('=', 1)
+        return dataset, float(weight)
+    return site, None
+
+# open_sites opens the streams of the sites of a task
+# INPUT: sites: list of DATASET[=WEIGHT] (see parse_site)
+#        task: 'class' or 'regr'
+#        random: np.random.RandomState of the order of the instances
+# OUTPUT: streams: list of SiteStreams, labels encoded as in the scripts
+#         weights: list of the sampling weights of the sites (the sizes of the
+#                  datasets if no weight is given, 1 for the sites without
+#                  weight otherwise)
+def open_sites(sites, task, random):
+    from ccnn_tensor_store import check_subjects
+    from ccnn_transfer_matrix import dataset_spec
+    streams, weights = [], []
+    for site in sites:
+        dataset, weight = parse_site(site)
+        name, tensor_store, labels_file, columns = dataset_spec(dataset)
+        if task not in columns:
+            raise ValueError('%s has no labels for the task %s' % (name, task))
+        labels_csv = np.loadtxt(labels_file, delimiter=',')
+        check_subjects(tensor_store, labels_csv[:, 0])
+        labels = labels_csv[:, columns[task]]
+        if task == 'class':
+            labels = (np.arange(2) == labels[:, None]).astype(np.float32)
+        else:
+            labels = labels[:, None].astype(np.float32)
+        stream = SiteStream(name, tensor_store, labels, random)
+        streams.append(stream)
+        weights.append(weight)
+    if all(weight is None for weight in weights):
+        return streams, [stream.size for stream in streams]
+    return streams, [1.0 if weight is None else weight for weight in weights]
+
+# initial_weights reads the weights a pretraining run starts from (the layers
+# of the archive whose shapes match those of the network, e.g. all but the
+# output layer of a classification network for regression)
+# OUTPUT: dictionary of np.arrays (layers not given are initialized randomly)
+def initial_weights(path, num_roi, num_labels):
+    from ccnn_model import layer_shapes
+    from ccnn_weight_bank import bank_weights
+    shapes = layer_shapes(num_roi, num_labels)
+    return dict((name, np.asarray(value)) for name, value in bank_weights(path).items()
+                if name in shapes and list(np.shape(value)) == shapes[name])
+
+# %% ###################### Multi-site pretraining #############################
+
+if __name__ == '__main__':
+    from ccnn_batch import adam_optimizer, scale_schedule
+    from ccnn_options import option, output_name
+    from ccnn_profile import StepProfiler
+    from ccnn_session import session_config
+    from ccnn_telemetry import Telemetry
+    from ccnn_weights import save_weights
+
+    parser = argparse.ArgumentParser(description='Multi-site pretraining streamed from tensor stores.')
+    parser.add_argument('--task', choices=['class', 'regr'], default='class')
+    parser.add_argument('--sites', nargs='+', required=True,
+                        help='DATASET[=WEIGHT]: dataset name or TENSOR_STORE:LABELS_FILE, sampling weight '
+                             '(default: sizes of the datasets if no weight is given, 1 otherwise)')
+    parser.add_argument('--steps', type=int, default=None, help='training steps (default: as the scripts)')
+    parser.add_argument('--init', default=None, help='weights archive the network starts from')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--out', default=None, help='weights archive (default: weights_multisite[_regr])')
+    args = parser.parse_args()
+
+    start = time.time()
+    random = np.random.RandomState(args.seed)
+    streams, site_weights = open_sites(args.sites, args.task, random)
+    batch_size = option('batch_size', 4)   # larger batches: see ccnn_batch.py
+    sampler = MultiSiteSampler(streams, site_weights, batch_size, seed=args.seed)
+    num_roi = streams[0].num_roi
+    num_labels = 2 if args.task == 'class' else 1
+    for stream, p in zip(streams, sampler.probabilities):
+        print('%-24s %7d instances (%.1f GB on disk), sampled with probability %.3f' % (
+            stream.name, stream.size, stream.size * num_roi**2 * 4 / 1024.0**3, p))
+
+    # TensorFlow is imported only here, where the computational graph is built
+    import tensorflow as tf
+    from ccnn_model import model, xavier_weights
+
+    graph = tf.Graph()
+    with graph.as_default():
+        if args.seed is not None:
+            tf.set_random_seed(args.seed)
+        tf_train_dataset = tf.placeholder(tf.float32, shape=(batch_size, num_roi, num_roi, 1))
+        tf_train_labels = tf.placeholder(tf.float32, shape=(batch_size, num_labels))
+        variables = xavier_weights(num_roi, num_labels)
+        initial = {} if args.init is None else initial_weights(args.init, num_roi, num_labels)
+        logits = model(tf_train_dataset, variables, KEEP_PR)
+        if args.task == 'class':
+            loss = tf.reduce_mean(
+                    tf.nn.softmax_cross_entropy_with_logits(labels=tf_train_labels, logits=logits))
+            train_prediction = tf.nn.softmax(logits)
+        else:
+            loss = tf.losses.mean_squared_error(labels=tf_train_labels, predictions=logits)
+            train_prediction = logits
+        # Optimizer definition (the learning rate and the number of iterations
+        # are scaled to the batch size, see ccnn_batch.py)
+        learning_rate, num_steps, warmup_steps = scale_schedule(
+                LEARNING_RATE[args.task], args.steps or NUM_STEPS[args.task], batch_size)
+        optimizer = adam_optimizer(loss, learning_rate, warmup_steps)
+
+    name = 'ccnn_multisite' if args.task == 'class' else 'ccnn_multisite_regr'
+    # Op-level profiling of a window of training steps (see ccnn_profile.py)
+    profiler = StepProfiler('profile_' + name)
+    # Training metrics are computed only at the steps reported (see ccnn_telemetry.py)
+    telemetry = Telemetry(name, 500)
+    read_time = 0.0
+
+    with tf.Session(graph=graph, config=session_config()) as session:
+        tf.global_variables_initializer().run()
+        for layer, value in initial.items():
+            variables[layer].load(value, session)
+        print('\nVariables initialized (%d layers from %s) ...' % (len(initial), args.init))
+
+        for step in range(num_steps):
+            read_start = time.time()
+            batch_data, batch_labels, _ = sampler.next_batch()
+            read_time += time.time() - read_start
+            feed_dict = {tf_train_dataset: batch_data, tf_train_labels: batch_labels}
+            if telemetry.due(step):
+                _, l, predictions = session.run(
+                        [optimizer, loss, train_prediction], feed_dict=feed_dict, **profiler.run_kwargs(step))
+            else:
+                _, l = session.run([optimizer, loss], feed_dict=feed_dict, **profiler.run_kwargs(step))
+            profiler.record(step)
+            telemetry.add(l)
+
+            # At every 500. step give some feedback on the progress
+            if telemetry.due(step):
+                if args.task == 'class':
+                    train_accuracy = 100.0 * np.mean(np.argmax(predictions, 1) == np.argmax(batch_labels, 1))
+                    telemetry.report(step, l, accuracy=train_accuracy)
+                    print('Minibatch accuracy: %.1f%%' % train_accuracy)
+                else:
+                    train_mae = np.mean(np.abs(predictions - batch_labels))
+                    telemetry.report(step, l, mae=train_mae)
+                    print('Minibatch MAE: %.2f' % train_mae)
+
+        profiler.save()
+        final_weights = dict((layer, variable.eval()) for layer, variable in variables.items())
+
+    print('\n%d steps in %.0f s (%.0f s reading batches)' % (num_steps, time.time() - start, read_time))
+    for stream, count in zip(streams, sampler.counts):
+        print('%-24s %8d instances drawn (%.1f epochs)' % (stream.name, count, count / float(stream.size)))
+    out = output_name(args.out or ('weights_multisite' if args.task == 'class' else 'weights_multisite_regr'))
+    save_weights(out, final_weights)
+    print('Weights saved into %s' % out)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+This module lets the experiment scheduler (see 'ccnn_scheduler.py') override the
+settings selected at the top of the scripts (e.g. 'initmode', 'target_data')
+through environment variables, so that the scripts can be run for every
+condition of a grid without being edited. A setting 'name' is overridden by the
+variable CCNN_NAME (JSON value, e.g. CCNN_INITMODE=1, CCNN_LAYER2_RANK=null);
+the values written in the scripts are used when the variables are not set, i.e.
+when a script is run by hand.
+
+Runs that differ only in settings not reflected in the output file names (e.g.
+the random seed) are told apart by the run tag in CCNN_RUN_TAG, which is
+appended to the names of the results and weights files.
+"""
+# Importing necessary libraries
+import json
+import os
+
+ENV_PREFIX = 'CCNN_'
+
+# %% ####################### Function definitions #############################
+
+# option returns the value of a setting, overridden by the environment
+# INPUT: name: name of the setting (string)
+#        value: value selected in the script
+# OUTPUT: value of the setting
+def option(name, value):
+    text = os.environ.get(ENV_PREFIX + name.upper())
+    if text is None:
+        return value
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+# option_env returns the environment variables setting the given options
+# INPUT: options: dictionary mapping setting names to values
+# OUTPUT: dictionary of environment variables
+def option_env(options):
+    return dict((ENV_PREFIX + name.upper(), json.dumps(value)) for name, value in options.items())
+
+# output_name appends the run tag (if any) to the name of a results file or
+# weights archive
+def output_name(name):
+    tag = os.environ.get(ENV_PREFIX + 'RUN_TAG')
+    if not tag:
+        return name
+    if name.endswith('.npz'):
+        return '%s_%s.npz' % (name[:-len('.npz')], tag)
+    return '%s_%s' % (name, tag)
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements a pipeline runner that runs the scripts of the
+experiments (stages) in the order given by their inputs and outputs, and only
+reruns the stages whose inputs have changed. The stages (STAGES below) declare
+the files they read (datasets, labels, folds, weights of other stages) and the
+files they write (weights archives, results files). For example
+'ccnn_class_publictrain.py' writes 'weights_public', which is read by
+'ccnn_regr_public.py', whose 'weights_public_regr' is read by
+'ccnn_regr_transfer.py', and the results files are read by the statistics
+scripts.
+
+The content hashes (SHA-1) of the inputs and outputs of each stage, including
+the code of the script and of the modules it imports, are recorded in
+'ccnn_pipeline.json' when the stage has been run. A stage is stale (and run
+again) if it has not been run yet, if the hash of any of its inputs or its
+settings differ from the recorded ones, or if any of its outputs is missing or
+has been modified. Stages whose inputs are ready are run concurrently, each on
+its share of the cores (see 'ccnn_session.py'). Usage:
+
+    python ccnn_pipeline.py [STAGE ...] [--jobs 4] [--dry-run] [--force STAGE ...]
+
+Without stage names, every stage is brought up to date; given stage names, only
+those stages and the stages they depend on.
+"""
+# Importing necessary libraries
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from ccnn_options import option_env
+from ccnn_session import thread_env
+
+STATE_FILE = 'ccnn_pipeline.json'
+
+DATASETS = {1: {'name': 'inhouse', 'tensor': 'CORR_tensor_inhouse',
+                'labels': 'labels_inhouse.txt', 'folds': 'folds_inhouse.npy'},
+            2: {'name': 'NKI-RS_subset', 'tensor': 'CORR_tensor_NKI-RS_subset',
+                'labels': 'labels_NKI-RS_subset.csv', 'folds': 'folds_NKI-RS_subset.npy'}}
+
+# %% ########################### Stage definitions ############################
+
+def _stage(name, script, inputs, outputs, options=None, args=None, stdout=None):
+    return {'name': name, 'script': script, 'inputs': inputs, 'outputs': outputs,
+            'options': options or {}, 'args': args or [], 'stdout': stdout}
+
+# _stages declares the stages of the experiments of the manuscript (file names
+# as written by the scripts)
+def _stages():
+    stages = [
+        _stage('class_publictrain', 'ccnn_class_publictrain.py',
+               ['CORR_tensor_public', 'labels_public.csv'], ['weights_public']),
+        _stage('class_inhousetrain', 'ccnn_class_inhousetrain.py',
+               ['CORR_tensor_inhouse', 'labels_inhouse.txt'], ['weights_inhouse']),
+        _stage('regr_public', 'ccnn_regr_public.py',
+               ['CORR_tensor_public_regr', 'labels_public_regr.csv', 'weights_public'],
+               ['weights_public_regr']),
+        _stage('class_backtransfer', 'ccnn_class_backtransfer.py',
+               ['CORR_tensor_public', 'labels_public.csv', 'weights_inhouse'],
+               ['results_ccnn_class_backtransfer.npz'])]
+    for target_data, dataset in sorted(DATASETS.items()):
+        data = [dataset['tensor'], dataset['labels']]
+        folds = data + [dataset['folds']]
+        suffix = '_' + dataset['name']
+        baseline = 'results_ccnn_class_CONVtrainFULLtrain%s.npz' % suffix
+        stages += [
+            _stage('class_CONVtrainFULLtrain' + suffix, 'ccnn_class_CONVtrainFULLtrain.py', folds,
+                   [baseline, 'weights_ccnn_class_CONVtrainFULLtrain' + suffix],
+                   {'target_data': target_data}),
+            _stage('class_CONVconstFULLconst' + suffix, 'ccnn_class_CONVconstFULLconst.py',
+                   data + ['weights_public'], ['results_ccnn_class_CONVconstFULLconst%s.npz' % suffix],
+                   {'target_data': target_data})]
+        transfer = {'CONVconstFULLconst': 'results_ccnn_class_CONVconstFULLconst%s.npz' % suffix}
+        for script, condition, weights, initmode in [
+                ('ccnn_class_CONVconstFULLtrain_FULLinit.py', 'CONVconstFULLtrain', 'CONVconstFULLtrain', 1),
+                ('ccnn_class_CONVconstFULLtrain_FULLinit.py', 'CONVconstFULLinit', 'CONVconstFULLinit', 2),
+                ('ccnn_class_CONVinitFULLtrain_FULLinit.py', 'CONVinitFULLtrain', 'CONViniFULLtrain', 1),
+                ('ccnn_class_CONVinitFULLtrain_FULLinit.py', 'CONVinitFULLinit', 'CONVinitFULLinit', 2)]:
+            transfer[condition] = 'results_ccnn_class_%s.npz%s.npz' % (condition, suffix)
+            stages.append(_stage('class_%s%s' % (condition, suffix), script, folds + ['weights_public'],
+                                 [transfer[condition], 'weights_ccnn_class_%s%s' % (weights, suffix)],
+                                 {'initmode': initmode, 'target_data': target_data}))
+        # Closed-form readout on the frozen features (see ccnn_readout.py)
+        transfer['CONVconstREADOUT'] = 'results_ccnn_class_CONVconstREADOUT%s.npz' % suffix
+        stages.append(_stage('class_CONVconstREADOUT' + suffix, 'ccnn_readout.py', folds + ['weights_public'],
+                             [transfer['CONVconstREADOUT']],
+                             args=['--task', 'class', '--target-data', str(target_data)]))
+        # Transfer learning conditions compared with the baseline condition
+        for condition, results in sorted(transfer.items()):
+            stages.append(_stage('stat_class_%s%s' % (condition, suffix), 'ccnn_stat_compare_class_binom.py',
+                                 [results, baseline, dataset['labels']], [], args=[results, baseline],
+                                 stdout='stat_class_%s%s.txt' % (condition, suffix)))
+        regr = dict((condition, 'results_ccnn_regr_%s%s.npz' % (condition, suffix))
+                    for condition in ['baseline', 'transfer', 'readout'])
+        stages += [
+            _stage('regr_baseline' + suffix, 'ccnn_regr_baseline.py', folds,
+                   [regr['baseline'], 'weights_ccnn_regr_baseline' + suffix], {'target_data': target_data}),
+            _stage('regr_transfer' + suffix, 'ccnn_regr_transfer.py', folds + ['weights_public_regr'],
+                   [regr['transfer'], 'weights_ccnn_regr_transfer' + suffix], {'target_data': target_data}),
+            _stage('stat_regr' + suffix, 'ccnn_stat_compare_regression_ttest.py',
+                   [regr['baseline'], regr['transfer']], [], args=[regr['baseline'], regr['transfer']],
+                   stdout='stat_regr%s.txt' % suffix),
+            _stage('regr_readout' + suffix, 'ccnn_readout.py', folds + ['weights_public_regr'],
+                   [regr['readout']], args=['--task', 'regr', '--target-data', str(target_data)]),
+            _stage('stat_regr_readout' + suffix, 'ccnn_stat_compare_regression_ttest.py',
+                   [regr['baseline'], regr['readout']], [], args=[regr['baseline'], regr['readout']],
+                   stdout='stat_regr_readout%s.txt' % suffix)]
+    for stage in stages:
+        if stage['stdout'] is not None:
+            stage['outputs'].append(stage['stdout'])
+    return stages
+
+STAGES = _stages()
+
+# %% ####################### Function definitions #############################
+
+# _resolve returns the file or directory holding a dataset or weights: stores
+# and archives fall back to the old pickle files (see ccnn_tensor_store.py and
+# ccnn_weights.py)
+def _resolve(path):
+    if not os.path.exists(path) and os.path.isfile(path + '.pickle'):
+        return path + '.pickle'
+    return path
+
+def _file_hash(path, cache):
+    stat = os.stat(path)
+    key = '%s:%d:%d' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in cache:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        cache[key] = sha.hexdigest()
+    return cache[key]
+
+# content_hash computes the SHA-1 hash of a file or of a directory (relative
+# paths and contents of all files); hashes of unchanged files (same size and
+# modification time) are taken from the cache
+# OUTPUT: hash (string), or None if the path does not exist
+def content_hash(path, cache):
+    path = _resolve(path)
+    if os.path.isfile(path):
+        return _file_hash(path, cache)
+    if not os.path.isdir(path):
+        return None
+    sha = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.tmp'):
+                continue
+            sha.update(os.path.relpath(os.path.join(root, name), path).encode('utf-8'))
+            sha.update(_file_hash(os.path.join(root, name), cache).encode('utf-8'))
+    return sha.hexdigest()
+
+# code_files lists the script of a stage and the ccnn_* modules it imports
+# (recursively), whose code is an input of the stage
+def code_files(script, code_dir):
+    files, queue = [], [script]
+    while queue:
+        name = queue.pop()
+        if name in files or not os.path.isfile(os.path.join(code_dir, name)):
+            continue
+        files.append(name)
+        with open(os.path.join(code_dir, name), 'r', encoding='utf-8') as f:
+            queue += ['%s.py' % module for module in re.findall(r'^\s*(?:from|import) (ccnn_\w+)', f.read(), re.M)]
+    return sorted(files)
+
+# producers maps each stage to the stages writing its inputs
+def producers(stages):
+    writers = dict((output, stage['name']) for stage in stages for output in stage['outputs'])
+    return dict((stage['name'], sorted(set(writers[path] for path in stage['inputs'] if path in writers)))
+                for stage in stages)
+
+def _fingerprint(stage, code_dir, cache):
+    inputs = dict((path, content_hash(path, cache)) for path in stage['inputs'])
+    inputs.update((name, content_hash(os.path.join(code_dir, name), cache))
+                  for name in code_files(stage['script'], code_dir))
+    return {'inputs': inputs, 'options': stage['options'], 'args': stage['args']}
+
+# stale_reason tells why a stage has to be run
+# OUTPUT: reason (string), or None if the stage is up to date
+def stale_reason(stage, record, fingerprint, cache):
+    if record is None:
+        return 'not run yet'
+    missing = [path for path, digest in fingerprint['inputs'].items() if digest is None]
+    if missing:
+        return 'missing input: ' + ', '.join(missing)
+    if record['options'] != fingerprint['options'] or record['args'] != fingerprint['args']:
+        return 'settings changed'
+    changed = [path for path, digest in fingerprint['inputs'].items() if record['inputs'].get(path) != digest]
+    if changed:
+        return 'changed input: ' + ', '.join(sorted(changed))
+    for path in stage['outputs']:
+        if content_hash(path, cache) != record['outputs'].get(path):
+            return 'missing or modified output: ' + path
+    return None
+
+# _prune_cache removes the hashes of files that have been removed or rewritten
+# since they were computed, so that the cache does not grow with every run
+def _prune_cache(cache):
+    for key in list(cache):
+        path, size, mtime = key.rsplit(':', 2)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            del cache[key]
+            continue
+        if stat.st_size != int(size) or stat.st_mtime_ns != int(mtime):
+            del cache[key]
+
+def _read_state():
+    if not os.path.isfile(STATE_FILE):
+        return {'stages': {}, 'hash_cache': {}}
+    with open(STATE_FILE, 'r') as f:
+        return json.load(f)
+
+def _write_state(state):
+    with open(STATE_FILE + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(STATE_FILE + '.tmp', STATE_FILE)
+
+# run_stage runs the script of a stage (output written into the log file, or
+# into the stdout file of the stage)
+# INPUT: threads: environment setting the threads of the stage (see thread_env
+#                 in ccnn_session.py)
+# OUTPUT: return code of the script
+def run_stage(stage, code_dir, threads=None):
+    env = dict(os.environ)
+    env.update(threads or {})
+    env.update(option_env(stage['options']))
+    log_file = stage['stdout'] or 'ccnn_pipeline_%s.log' % stage['name']
+    with open(log_file, 'w') as log:
+        return subprocess.call([sys.executable, os.path.join(code_dir, stage['script'])] + stage['args'],
+                               env=env, stdout=log, stderr=subprocess.STDOUT)
+
+# selected returns the names of the given stages and of all stages they depend on
+def selected(stages, names):
+    deps = producers(stages)
+    unknown = [name for name in names if name not in deps]
+    if unknown:
+        raise KeyError('unknown stage(s): ' + ', '.join(unknown))
+    result, queue = set(), list(names)
+    while queue:
+        name = queue.pop()
+        if name not in result:
+            result.add(name)
+            queue += deps[name]
+    return result
+
+# run_pipeline brings the stages up to date, running independent stages
+# concurrently
+# INPUT: stages: list of stage dictionaries (see _stage)
+#        names: names of the stages to bring up to date (default: all)
+#        jobs: maximal number of stages running at the same time
+#        force: names of the stages run even if they are up to date
+#        dry_run: if True, the stages are only listed with the reason of
+#                 running them
+# OUTPUT: dictionary mapping stage names to 'skipped', 'done', 'failed',
+#         'blocked' (an upstream stage failed) or 'stale' (dry run)
+def run_pipeline(stages, names=None, jobs=1, force=(), dry_run=False):
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    if names:
+        keep = selected(stages, names)
+        stages = [stage for stage in stages if stage['name'] in keep]
+    deps = producers(stages)
+    by_name = dict((stage['name'], stage) for stage in stages)
+    state = _read_state()
+    cache = state['hash_cache']
+    _prune_cache(cache)
+    lock = threading.Lock()
+    status, reran = {}, set()
+    # Concurrent stages run on their own share of the cores (slots)
+    slots = list(range(jobs)) if jobs > 1 else []
+
+    def finish(stage, fingerprint, returncode, start):
+        with lock:
+            if returncode != 0:
+                return 'failed'
+            record = dict(fingerprint)
+            record['outputs'] = dict((path, content_hash(path, cache)) for path in stage['outputs'])
+            record['duration'] = time.time() - start
+            state['stages'][stage['name']] = record
+            _write_state(state)
+            return 'done'
+
+    def execute(stage, fingerprint):
+        start = time.time()
+        if jobs <= 1:
+            return finish(stage, fingerprint, run_stage(stage, code_dir), start)
+        with lock:
+            slot = slots.pop(0)
+        try:
+            returncode = run_stage(stage, code_dir, thread_env(jobs, slot))
+        finally:
+            with lock:
+                slots.append(slot)
+        return finish(stage, fingerprint, returncode, start)
+
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while len(status) < len(stages):
+            progress = False
+            for stage in stages:
+                name = stage['name']
+                if name in status or name in running.values():
+                    continue
+                if any(dep not in status for dep in deps[name]):
+                    continue
+                progress = True
+                if any(status[dep] in ('failed', 'blocked') for dep in deps[name]):
+                    status[name] = 'blocked'
+                    print('%-45s blocked (upstream stage failed)' % name)
+                    continue
+                with lock:
+                    fingerprint = _fingerprint(stage, code_dir, cache)
+                    reason = stale_reason(stage, state['stages'].get(name), fingerprint, cache)
+                if name in force:
+                    reason = 'forced'
+                elif dry_run and reason is None and any(dep in reran for dep in deps[name]):
+                    reason = 'upstream stage rerun'
+                if reason is None:
+                    status[name] = 'skipped'
+                    print('%-45s up to date' % name)
+                elif dry_run:
+                    status[name] = 'stale'
+                    reran.add(name)
+                    print('%-45s stale (%s)' % (name, reason))
+                else:
+                    print('%-45s running (%s)' % (name, reason))
+                    running[pool.submit(execute, stage, fingerprint)] = name
+            if not running:
+                if not progress:
+                    raise ValueError('the stages depend on each other in a cycle')
+                continue
+            finished, pending = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                status[name] = future.result()
+                print('%-45s %s (%.0f s)' % (name, status[name],
+                                             state['stages'].get(name, {}).get('duration', 0)))
+    return status
+
+# %% ######################## Running the pipeline ############################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the stale stages of the experiments.')
+    parser.add_argument('stages', nargs='*', help='stages to bring up to date (default: all)')
+    parser.add_argument('--jobs', type=int, default=1, help='number of stages run concurrently')
+    parser.add_argument('--force', nargs='+', default=[], help='stages run even if up to date')
+    parser.add_argument('--dry-run', action='store_true', help='only list the stale stages')
+    parser.add_argument('--list', action='store_true', help='list the stages and their inputs')
+    args = parser.parse_args()
+
+    if args.list:
+        deps = producers(STAGES)
+        for stage in STAGES:
+            print('%s: %s -> %s (after: %s)' % (stage['name'], ', '.join(stage['inputs']),
+                                                ', '.join(stage['outputs']), ', '.join(deps[stage['name']]) or '-'))
+        sys.exit(0)
+    status = run_pipeline(STAGES, args.stages, args.jobs, args.force, args.dry_run)
+    counts = dict((result, list(status.values()).count(result)) for result in set(status.values()))
+    print(', '.join('%s: %d' % item for item in sorted(counts.items())))
+    sys.exit(1 if counts.get('failed') or counts.get('blocked') else 0)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the preprocessing of the connectivity matrices, i.e.
+replacing NaNs with 0s and normalizing the data to have zero mean and a maximal
+absolute value of 1 (see normalize_tensor in the scripts). Both steps are fused
+into a single pass over chunks of instances: NaNs are replaced in place, and the
+sum, minimum and maximum of each chunk are recorded together with a NaN report
+(number of NaNs, affected subjects and ROIs). Combining the statistics of the
+chunks gives the mean and the maximal absolute deviation from the mean of the
+whole dataset, thus the normalization constants are known without rescanning
+the data.
+
+The tensor stores (see 'ccnn_tensor_store.py') record these statistics when
+chunks are appended. Old 'CORR_tensor_*.pickle' files are converted into
+sanitized tensor stores by running this module as a script, optionally with
+the labels file holding the subject IDs of the instances:
+
+    python ccnn_preprocess.py CORR_tensor_inhouse.pickle [labels_inhouse.txt]
+"""
+# Importing necessary libraries
+import sys
+
+import numpy as np
+
+chunk_size = 64   # number of instances processed at once
+
+# %% ####################### Function definitions #############################
+
+# sanitize_chunk replaces NaNs with 0s in a chunk of connectivity matrices (in
+# place) and computes its statistics
+# INPUT: data: 4D tensor (np.array), instances are concatenated along the first
+#              (0.) dimension
+#        subjects: subject IDs of the instances in data
+# OUTPUT: dictionary of statistics: 'count', 'sum', 'min', 'max', and the NaN
+#         report: 'nan_count', 'nan_subjects', 'nan_rois'
+def sanitize_chunk(data, subjects):
+    nans = np.isnan(data)
+    nan_count = int(np.count_nonzero(nans))
+    stats = {'count': int(data.size), 'nan_count': nan_count,
+             'nan_subjects': [], 'nan_rois': []}
+    if nan_count:
+        stats['nan_subjects'] = [float(subjects[k]) for k in np.where(np.any(nans.reshape(data.shape[0], -1), axis=1))[0]]
+        stats['nan_rois'] = [int(k) for k in np.where(np.any(nans, axis=(0, 2, 3)))[0]]
+        data[nans] = 0
+    del nans
+    stats['sum'] = float(np.sum(data, dtype=np.float64))
+    stats['min'] = float(np.min(data))
+    stats['max'] = float(np.max(data))
+    return stats
+
+# combine_statistics combines the statistics of chunks into the statistics of
+# the dataset
+# INPUT: chunk_stats: list of dictionaries returned by sanitize_chunk
+# OUTPUT: dictionary with the normalization constants 'mean' and 'max_abs'
+#         (maximal absolute deviation from the mean) and the NaN report
+def combine_statistics(chunk_stats):
+    count = sum(s['count'] for s in chunk_stats)
+    mean = sum(s['sum'] for s in chunk_stats) / count
+    max_abs = max(max(s['max'] for s in chunk_stats) - mean, mean - min(s['min'] for s in chunk_stats))
+    return {'mean': mean, 'max_abs': max_abs, 'count': count,
+            'nan_count': sum(s['nan_count'] for s in chunk_stats),
+            'nan_subjects': [k for s in chunk_stats for k in s['nan_subjects']],
+            'nan_rois': sorted(set(k for s in chunk_stats for k in s['nan_rois']))}
+
+# normalize_chunk normalizes a chunk of (sanitized) connectivity matrices with
+# the normalization constants of the dataset (a constant dataset, i.e.
+# max_abs = 0, is only centred)
+# INPUT: data: 4D tensor (np.array)
+#        stats: dictionary returned by combine_statistics
+#        out: array the result is written into (default: a new array)
+def normalize_chunk(data, stats, out=None):
+    out = np.subtract(data, np.float32(stats['mean']), out=out, dtype=np.float32)
+    if stats['max_abs'] > 0:
+        out /= np.float32(stats['max_abs'])
+    return out
+
+# sanitize_and_normalize replaces NaNs with 0s and normalizes a dataset held in
+# memory, processing it in chunks (in place)
+# INPUT: data_tensor: 4D tensor (np.array), instances are concatenated along
+#                     the first (0.) dimension
+#        subjects: subject IDs of the instances (default: instance numbers)
+# OUTPUT: data_tensor: the sanitized and normalized data
+#         stats: dictionary returned by combine_statistics
+def sanitize_and_normalize(data_tensor, subjects=None):
+    if subjects is None:
+        subjects = np.arange(data_tensor.shape[0])
+    chunk_stats = [sanitize_chunk(data_tensor[k:(k + chunk_size)], subjects[k:(k + chunk_size)])
+                   for k in range(0, data_tensor.shape[0], chunk_size)]
+    stats = combine_statistics(chunk_stats)
+    for k in range(0, data_tensor.shape[0], chunk_size):
+        normalize_chunk(data_tensor[k:(k + chunk_size)], stats, out=data_tensor[k:(k + chunk_size)])
+    return data_tensor, stats
+
+# nan_report returns a short description of the NaNs found in a dataset
+def nan_report(stats):
+    if not stats['nan_count']:
+        return 'no NaNs'
+    return '%d NaNs replaced with 0s in %d instances (ROIs: %s)' % (
+        stats['nan_count'], len(stats['nan_subjects']),
+        ', '.join(str(k) for k in stats['nan_rois']))
+
+# %% ####################### Converting old files ############################
+
+if __name__ == '__main__':
+    from six.moves import cPickle as pickle
+    from ccnn_tensor_store import append_chunk, create_store, read_index, store_path
+
+    picklefile = sys.argv[1]
+    with open(picklefile, 'rb') as f:
+        save = pickle.load(f)
+        data_tensor = save['data_tensor']
+        del save
+    # The old files do not hold subject IDs: they are read from the labels file
+    # (first column), or the instances are numbered
+    if len(sys.argv) > 2:
+        subjects = np.loadtxt(sys.argv[2], delimiter=',')[:, 0]
+    else:
+        subjects = np.arange(data_tensor.shape[0])
+
+    path = store_path(picklefile)
+    create_store(path, data_tensor.shape[1])
+    for k in range(0, data_tensor.shape[0], chunk_size):
+        append_chunk(path, data_tensor[k:(k + chunk_size)], subjects[k:(k + chunk_size)])
+    stats = read_index(path)['statistics']
+    print('%s -> %s: %d instances, mean %g, max abs %g, %s' % (
+        picklefile, path, data_tensor.shape[0], stats['mean'], stats['max_abs'], nan_report(stats)))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the op-level profiling of the training steps of the
+scripts. For a window of training steps, session.run is called with full
+tracing, and the collected run metadata is used to
+
+- aggregate the compute time and memory of each op (and of each op type, e.g.
+  Conv2D, Conv2DBackpropFilter, the ops of dropout) over the profiled steps,
+- export the trace of each profiled step in Chrome trace format (open it at
+  chrome://tracing),
+- write a summary of the top N ops into a text file and a JSON file.
+
+Profiling is switched on by the settings 'profile_steps' (first step and number
+of steps of the window, e.g. CCNN_PROFILE_STEPS="[100, 20]", see
+'ccnn_options.py'), 'profile_fold' (fold of the cross-validation profiled,
+default: the first one) and 'profile_top' (number of ops in the summary). The
+files of a condition are named after its weights archive, e.g.
+'profile_ccnn_class_CONVinitFULLinit_inhouse_fold1_ops.txt'. Without these
+settings the scripts run exactly as before.
+"""
+# Importing necessary libraries
+import json
+import re
+from collections import defaultdict
+
+from ccnn_options import option
+
+# %% ####################### Function definitions #############################
+
+# op_type extracts the type of an op from the timeline label of its node
+# statistics (e.g. 'Conv2D' from 'Conv2D_1 = Conv2D(Placeholder, ...)')
+def op_type(node_stats):
+    match = re.search(r'=\s*([\w>]+)\(', node_stats.timeline_label)
+    if match:
+        return match.group(1)
+    return node_stats.node_name.split(':')[0]
+
+# node_memory returns the memory allocated by a node: the bytes of its outputs
+# and its peak allocation
+def node_memory(node_stats):
+    output_bytes = sum(output.tensor_description.allocation_description.allocated_bytes
+                       for output in node_stats.output)
+    peak_bytes = max([memory.peak_bytes for memory in node_stats.memory] + [0])
+    return output_bytes, peak_bytes
+
+class StepProfiler(object):
+    """Collects the run metadata of a window of training steps.
+
+    In the training loop, the keyword arguments of session.run are extended by
+    run_kwargs(step), and record(step) is called after session.run; save()
+    writes the traces and the summary after the loop.
+    """
+
+    def __init__(self, name, fold=None):
+        self.name = name
+        window = option('profile_steps', None)
+        self.enabled = window is not None and (fold is None or fold == option('profile_fold', 0))
+        if self.enabled:
+            self.first_step, self.num_steps = int(window[0]), int(window[1])
+        self.top = int(option('profile_top', 20))
+        self.run_metadata = None
+        self.steps = []
+        self.ops = defaultdict(lambda: {'calls': 0, 'micros': 0, 'output_bytes': 0, 'peak_bytes': 0})
+
+    def profiled(self, step):
+        return self.enabled and self.first_step <= step < self.first_step + self.num_steps
+
+    # run_kwargs returns the arguments of session.run tracing the given step
+    def run_kwargs(self, step):
+        if not self.profiled(step):
+            return {}
+        import tensorflow as tf
+        self.run_metadata = tf.RunMetadata()
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                'run_metadata': self.run_metadata}
+
+    # record aggregates the run metadata of a traced step and exports its trace
+    def record(self, step):
+        if not self.profiled(step):
+            return
+        from tensorflow.python.client import timeline
+        step_stats = self.run_metadata.step_stats
+        start, end = None, None
+        for device in step_stats.dev_stats:
+            for node in device.node_stats:
+                if node.node_name == '_SOURCE':
+                    continue
+                output_bytes, peak_bytes = node_memory(node)
+                for key in [('op', node.node_name), ('type', op_type(node))]:
+                    entry = self.ops[key]
+                    entry['calls'] += 1
+                    entry['micros'] += node.all_end_rel_micros
+                    entry['output_bytes'] += output_bytes
+                    entry['peak_bytes'] = max(entry['peak_bytes'], peak_bytes)
+                node_end = node.all_start_micros + node.all_end_rel_micros
+                start = node.all_start_micros if start is None else min(start, node.all_start_micros)
+                end = node_end if end is None else max(end, node_end)
+        self.steps.append({'step': step, 'micros': (end - start) if start is not None else 0})
+        trace = timeline.Timeline(step_stats).generate_chrome_trace_format(show_memory=True)
+        with open('%s_step%d.json' % (self.name, step), 'w') as f:
+            f.write(trace)
+        self.run_metadata = None
+
+    # summary returns the top N ops and op types ranked by their compute time
+    def summary(self):
+        total = sum(entry['micros'] for (kind, name), entry in self.ops.items() if kind == 'op')
+        result = {'name': self.name, 'steps': self.steps, 'total_micros': total}
+        for kind in ['type', 'op']:
+            ranked = sorted(((name, entry) for (k, name), entry in self.ops.items() if k == kind),
+                            key=lambda item: -item[1]['micros'])[:self.top]
+            result[kind] = [dict(entry, name=name, share=entry['micros'] / float(max(total, 1)),
+                                 micros_per_step=entry['micros'] / float(max(len(self.steps), 1)))
+                            for name, entry in ranked]
+        return result
+
+    # save writes the summary of the profiled steps ('<name>_ops.json' and
+    # '<name>_ops.txt')
+    def save(self):
+        if not self.steps:
+            return
+        result = self.summary()
+        with open(self.name + '_ops.json', 'w') as f:
+            json.dump(result, f, indent=1)
+        with open(self.name + '_ops.txt', 'w') as f:
+            f.write('%s: %d profiled steps, %.1f ms per step (op time %.1f ms)\n' % (
+                self.name, len(self.steps),
+                sum(s['micros'] for s in self.steps) / 1000.0 / len(self.steps),
+                result['total_micros'] / 1000.0 / len(self.steps)))
+            for kind, title in [('type', 'op type'), ('op', 'op')]:
+                f.write('\n%-50s %8s %12s %7s %14s %12s\n' % (title, 'calls', 'ms/step', 'share',
+                                                              'output MB/step', 'peak MB'))
+                for entry in result[kind]:
+                    f.write('%-50s %8d %12.3f %6.1f%% %14.3f %12.3f\n' % (
+                        entry['name'][:50], entry['calls'], entry['micros_per_step'] / 1000.0,
+                        100 * entry['share'], entry['output_bytes'] / 1024.0**2 / len(self.steps),
+                        entry['peak_bytes'] / 1024.0**2))
+        print('Profile of %d steps saved into %s_ops.txt' % (len(self.steps), self.name))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the magnitude pruning of the column convolution (second
+layer, [numROI, 1, 64, 256]) and of the first fully connected layer (third
+layer, [256, 96]) of the connectome-convolutional neural network. The weights
+are pruned by rows: a row holds the weights of one input unit of the layer (a
+channel of the first layer at one ROI, or one of the 256 features of the second
+layer) to all output units, and the rows of smallest L2 norm are set to 0 until
+the target sparsity is reached. Pruned layers are stored in the sparse format of
+the weights archive (the remaining rows, see SparseRows in 'ccnn_weights.py'),
+and the forward pass ('ccnn_inference.py') multiplies only the inputs of the
+remaining rows, with a dense matrix product of proportionally smaller size.
+(Pruning single weights leaves no structure a dense matrix product could skip,
+and the sparse products available in NumPy are much slower than the dense
+product of the full layer.)
+
+The transfer scripts ('ccnn_class_CONVinitFULLtrain_FULLinit.py',
+'ccnn_class_CONVconstFULLtrain_FULLinit.py', 'ccnn_regr_transfer.py') prune
+the trainable layers gradually during training in each fold if 'prune_sparsity'
+is set (see GradualPruner), and store the pruned weights in the sparse format.
+
+Running this module as a script prunes the weights of an archive at once (one
+shot) to the given sparsity levels, and reports the size of the weights, the
+agreement of the predictions with the original network (on the given dataset,
+or on synthetic data) and the throughput of inference at each level.
+Optionally, the weights pruned to one level are saved into a new archive (e.g.
+'weights_public_pruned80'):
+
+    python ccnn_prune.py weights_public [--dataset CORR_tensor_inhouse --labels labels_inhouse.txt] [--sparsities 0.5 0.8 0.9] [--save 0.8]
+"""
+# Importing necessary libraries
+import argparse
+import time
+
+if __name__ == '__main__':
+    # Run as a script: threads are set before NumPy is imported (BLAS threads,
+    # see ccnn_session.py); importing the module leaves them to the caller
+    from ccnn_session import apply_threads
+    apply_threads()
+import numpy as np
+from ccnn_weights import SparseRows, sparse_rows
+
+# Layers pruned by default (the factors of a factorized column convolution, see
+# ccnn_compress.py, are already small and are not pruned)
+PRUNED_LAYERS = ['layer2_weights', 'layer3_weights']
+
+# %% ####################### Function definitions #############################
+
+# row_mask computes the mask (1 = kept, 0 = pruned) of the rows of weights of
+# smallest L2 norm for a given sparsity
+# INPUT: value: np.array of weights, whose last dimension holds the output
+#               units of the layer
+#        sparsity: fraction of the rows pruned (between 0 and 1)
+# OUTPUT: np.array (float32) of the shape of the weights
+def row_mask(value, sparsity):
+    matrix = np.reshape(value, (-1, np.shape(value)[-1]))
+    num_pruned = int(round(sparsity * matrix.shape[0]))
+    kept = np.ones(matrix.shape[0], dtype=np.float32)
+    kept[np.argsort(np.linalg.norm(matrix, axis=1), kind='stable')[:num_pruned]] = 0
+    return np.broadcast_to(kept.reshape(np.shape(value)[:-1] + (1,)), np.shape(value)).astype(np.float32)
+
+# prune_weights prunes the weights of a network at once
+# INPUT: weights: dictionary of weights and biases (see ccnn_weights.py)
+#        sparsity: fraction of the rows pruned in each layer
+#        layers: names of the layers pruned
+# OUTPUT: new dictionary of weights, the pruned layers being SparseRows
+def prune_weights(weights, sparsity, layers=PRUNED_LAYERS):
+    pruned = {}
+    for name, value in weights.items():
+        if name in layers:
+            value = np.asarray(value, dtype=np.float32)
+            pruned[name] = sparse_rows(value * row_mask(value, sparsity))
+        else:
+            pruned[name] = value
+    return pruned
+
+# sparse_weights converts the pruned layers of a dictionary of weights into
+# SparseRows (to be stored in the sparse format)
+def sparse_weights(weights, layers=PRUNED_LAYERS):
+    return dict((name, sparse_rows(value) if name in layers else value) for name, value in weights.items())
+
+class GradualPruner(object):
+    """Prunes layers gradually during training.
+
+    The layers are multiplied by masks in the graph (the masked tensors in
+    'masked' are used by the model instead of the variables), so that pruned
+    weights stay 0 and receive no gradient. From 'start' to 'end' (fractions of
+    the training steps), every 'frequency' steps the masks are recomputed from
+    the current weights, the sparsity following the cubic schedule
+    sparsity * (1 - (1 - t)^3) (t: fraction of the pruning period elapsed), so
+    that the network can adapt to the pruned weights before the next ones are
+    pruned.
+    """
+
+    def __init__(self, variables, sparsity, start=0.2, end=0.8, frequency=100):
+        import tensorflow as tf
+        self.sparsity = float(sparsity)
+        self.start = start
+        self.end = end
+        self.frequency = frequency
+        self.masks = dict((name, tf.Variable(tf.ones(variable.get_shape()), trainable=False,
+                                             name=name + '_mask'))
+                          for name, variable in variables.items())
+        self.masked = dict((name, variable * self.masks[name]) for name, variable in variables.items())
+
+    # target returns the sparsity scheduled at a given step
+    def target(self, step, num_steps):
+        begin, finish = int(self.start * num_steps), int(self.end * num_steps)
+        t = min(max((step - begin) / float(max(finish - begin, 1)), 0.0), 1.0)
+        return self.sparsity * (1 - (1 - t)**3)
+
+    # update recomputes the masks at the pruning steps (called after each
+    # training step)
+    # OUTPUT: the new sparsity, or None if the step is not a pruning step
+    def update(self, session, step, num_steps):
+        begin, finish = int(self.start * num_steps), int(self.end * num_steps)
+        if step < begin or (step - begin) % self.frequency != 0 or step > finish + self.frequency:
+            return None
+        sparsity = self.target(step, num_steps)
+        values = session.run(self.masked)
+        for name, value in values.items():
+            self.masks[name].load(row_mask(value, sparsity), session)
+        return sparsity
+
+def _num_params(weights):
+    return sum(int(np.prod(np.shape(value.values if isinstance(value, SparseRows) else value)))
+               for value in weights.values())
+
+def _timed_predict(data, weights, repeats):
+    from ccnn_inference import predict
+    predictions = predict(data, weights)
+    start = time.time()
+    for _ in range(repeats):
+        predict(data, weights)
+    return predictions, (time.time() - start) / repeats
+
+# %% ######################### Pruning weights ################################
+
+if __name__ == '__main__':
+    from ccnn_transfer_matrix import label_column
+    from ccnn_weights import archive_path, load_weights, save_weights
+
+    parser = argparse.ArgumentParser(description='Magnitude pruning of the column convolution and dense layer.')
+    parser.add_argument('weights', help='weights archive (or old pickle file)')
+    parser.add_argument('--fold', type=int, default=None, help='fold of a cross-validation archive')
+    parser.add_argument('--sparsities', type=float, nargs='+', default=[0.5, 0.7, 0.8, 0.9, 0.95])
+    parser.add_argument('--layers', nargs='+', default=PRUNED_LAYERS, choices=PRUNED_LAYERS)
+    parser.add_argument('--dataset', default=None, help='tensor store used to compare predictions')
+    parser.add_argument('--labels', default=None, help='labels file of the dataset')
+    parser.add_argument('--label-column', type=int, default=None,
+                        help='column of the labels in the labels file (default: the column of the '
+                             'task, see label_columns in ccnn_transfer_matrix.py)')
+    parser.add_argument('--repeats', type=int, default=5, help='repetitions of the timed inference')
+    parser.add_argument('--save', type=float, default=None, metavar='SPARSITY',
+                        help='save the weights pruned to SPARSITY into WEIGHTS_prunedPERCENT')
+    args = parser.parse_args()
+
+    weights = load_weights(args.weights, fold=args.fold, mmap=False)
+    num_roi = weights['layer1_weights'].shape[1]
+    if args.dataset is not None:
+        from ccnn_tensor_store import check_subjects, load_normalized_tensor
+        data, data_stats = load_normalized_tensor(args.dataset)
+    else:
+        data = np.random.RandomState(0).randn(256, num_roi, num_roi, 1).astype(np.float32)
+    labels = None
+    if args.labels is not None:
+        labels_csv = np.loadtxt(args.labels, delimiter=',')
+        if args.dataset is not None:
+            check_subjects(args.dataset, labels_csv[:, 0])
+        task = 'class' if weights['layer4_weights'].shape[-1] > 1 else 'regr'
+        labels = labels_csv[:, label_column(args.labels, task) if args.label_column is None else args.label_column]
+
+    full_pred, full_time = _timed_predict(data, weights, args.repeats)
+    classification = full_pred.shape[1] > 1
+    print('%8s %9s %9s %11s %12s %9s' % ('sparsity', 'params', 'size', 'agreement' if classification else 'max diff',
+                                         'instances/s', 'speedup'))
+    print('%8s %9.0f %8.1fM %11s %12.0f %9s' % ('dense', _num_params(weights), 4 * _num_params(weights) / 1024.0**2,
+                                               '-', data.shape[0] / full_time, '1.00'))
+    for sparsity in args.sparsities:
+        pruned = prune_weights(weights, sparsity, args.layers)
+        pred, pred_time = _timed_predict(data, pruned, args.repeats)
+        if classification:
+            match = '%10.1f%%' % (100.0 * np.mean(np.argmax(pred, 1) == np.argmax(full_pred, 1)))
+        else:
+            match = '%11.4f' % np.max(np.abs(pred - full_pred))
+        print('%8.2f %9.0f %8.1fM %s %12.0f %9.2f' % (
+            sparsity, _num_params(pruned), 4 * _num_params(pruned) / 1024.0**2, match,
+            data.shape[0] / pred_time, full_time / pred_time))
+        if labels is not None and classification:
+            print('         accuracy: %.1f%% (dense network: %.1f%%)' % (
+                100.0 * np.mean(np.argmax(pred, 1) == labels), 100.0 * np.mean(np.argmax(full_pred, 1) == labels)))
+        elif labels is not None:
+            print('         MAE: %.2f (dense network: %.2f)' % (
+                np.mean(np.abs(pred[:, 0] - labels)), np.mean(np.abs(full_pred[:, 0] - labels))))
+
+    if args.save is not None:
+        path = archive_path(args.weights) + '_pruned%d' % int(round(100 * args.save))
+        save_weights(path, prune_weights(weights, args.save, args.layers))
+        print('Weights pruned to sparsity %.2f saved into %s' % (args.save, path))
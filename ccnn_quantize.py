@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the post-training quantization of the weights of the
+connectome-convolutional neural network for scoring large cohorts. The weights
+of each layer are quantized to int8 with one scale per output channel
+(symmetric, the largest absolute weight of the channel being mapped to 127),
+and stored as 'layer*_weights' (int8) with 'layer*_weights_scale' (float32) in
+a weights archive (see 'ccnn_weights.py'); the bias terms are kept in float32.
+The NumPy forward pass ('ccnn_inference.py') evaluates quantized networks
+directly: the weights stay int8 in memory (a quarter of the float weights, also
+on disk), each layer is cast to float32 only for its own matrix product (NumPy
+has no int8 product, thus the products cost as much as with float weights),
+and the outputs are multiplied by the per-channel scales.
+
+Before a quantized network is accepted, its predictions are compared with those
+of the float network on a held-out set (the given dataset, or the test subjects
+of each fold of a cross-validation archive): the accuracy (classification) or
+R^2 (regression) of the quantized network must not drop by more than the
+tolerance, otherwise the quantized weights are not saved:
+
+    python ccnn_quantize.py weights_public --dataset CORR_tensor_inhouse --labels labels_inhouse.txt [--max-accuracy-drop 1.0]
+    python ccnn_quantize.py weights_ccnn_regr_transfer_inhouse --dataset CORR_tensor_inhouse --labels labels_inhouse.txt --folds folds_inhouse.npy [--max-rsq-drop 0.01]
+
+The quantized weights are saved into 'WEIGHTS_int8' (e.g. 'weights_public_int8').
+"""
+# Importing necessary libraries
+import argparse
+import time
+
+if __name__ == '__main__':
+    # Run as a script: threads are set before NumPy is imported (BLAS threads,
+    # see ccnn_session.py); importing the module leaves them to the caller
+    from ccnn_session import apply_threads
+    apply_threads()
+import numpy as np
+
+# Weights quantized to int8 (the bias terms are kept in float32)
+QUANTIZED_LAYERS = ['layer1_weights', 'layer2_weights', 'layer2_weights_u', 'layer2_weights_v',
+                    'layer3_weights', 'layer4_weights']
+
+# %% ####################### Function definitions #############################
+
+# quantize_array quantizes weights to int8 with one scale per output channel
+# (last dimension)
+# INPUT: value: np.array of weights
+# OUTPUT: quantized: np.array (int8) of the same shape
+#         scale: 1D vector (np.array, float32) of the scales of the channels
+def quantize_array(value):
+    value = np.asarray(value, dtype=np.float32)
+    scale = np.max(np.abs(value.reshape(-1, value.shape[-1])), axis=0) / 127.0
+    scale[scale == 0] = 1.0
+    quantized = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+    return quantized, scale.astype(np.float32)
+
+# quantize_weights quantizes the weights of a network (see ccnn_weights.py)
+# OUTPUT: new dictionary of weights, scales and bias terms
+def quantize_weights(weights):
+    quantized = {}
+    for name, value in weights.items():
+        if name in QUANTIZED_LAYERS:
+            quantized[name], quantized[name + '_scale'] = quantize_array(value)
+        else:
+            quantized[name] = np.asarray(value, dtype=np.float32)
+    return quantized
+
+# quantization_error returns the relative error (Frobenius norm) of the
+# quantized weights of each layer
+def quantization_error(weights, quantized):
+    return dict((name, float(np.linalg.norm(quantized[name] * quantized[name + '_scale'] - weights[name])
+                             / max(np.linalg.norm(weights[name]), 1e-12)))
+                for name in QUANTIZED_LAYERS if name in weights)
+
+# r_squared computes the cofficient of determination (R^2) for the predicted
+# chronological age values
+def r_squared(labels, predictions):
+    ss_res = np.mean(np.square(labels - predictions))
+    ss_tot = np.mean(np.square(labels - np.mean(labels)))
+    return 1 - (ss_res / ss_tot)
+
+# check_quantized compares the predictions of the quantized network with those
+# of the float network on a held-out set
+# INPUT: float_pred, quant_pred: predictions of the two networks (see predict
+#                                in ccnn_inference.py)
+#        labels: 1D vector (np.array) of class labels or ages
+#        max_accuracy_drop: tolerated drop of the accuracy (percentage points)
+#        max_rsq_drop: tolerated drop of R^2
+# OUTPUT: dictionary of the metrics of both networks, their difference, and
+#         'accepted' (whether the drop is within the tolerance)
+def check_quantized(float_pred, quant_pred, labels, max_accuracy_drop=1.0, max_rsq_drop=0.01):
+    if float_pred.shape[1] > 1:
+        report = {'metric': 'accuracy',
+                  'float': 100.0 * np.mean(np.argmax(float_pred, 1) == labels),
+                  'quantized': 100.0 * np.mean(np.argmax(quant_pred, 1) == labels),
+                  'agreement': 100.0 * np.mean(np.argmax(float_pred, 1) == np.argmax(quant_pred, 1))}
+        tolerance = max_accuracy_drop
+    else:
+        report = {'metric': 'R^2',
+                  'float': r_squared(labels, float_pred[:, 0]),
+                  'quantized': r_squared(labels, quant_pred[:, 0]),
+                  'max_difference': float(np.max(np.abs(quant_pred - float_pred)))}
+        tolerance = max_rsq_drop
+    report['delta'] = report['quantized'] - report['float']
+    report['accepted'] = bool(-report['delta'] <= tolerance)
+    return report
+
+def _timed_predict(data, weights, repeats):
+    from ccnn_inference import predict
+    predictions = predict(data, weights)
+    start = time.time()
+    for _ in range(repeats):
+        predict(data, weights)
+    return predictions, (time.time() - start) / max(repeats, 1)
+
+def _num_bytes(weights):
+    return sum(np.asarray(value).nbytes for value in weights.values())
+
+# %% ####################### Quantizing weights ###############################
+
+if __name__ == '__main__':
+    from ccnn_folds import load_folds
+    from ccnn_tensor_store import check_subjects, load_normalized_tensor
+    from ccnn_transfer_matrix import label_column
+    from ccnn_weights import archive_folds, archive_path, create_archive, load_weights, save_fold_weights, save_weights
+
+    parser = argparse.ArgumentParser(description='Int8 post-training quantization of CCNN weights.')
+    parser.add_argument('weights', help='weights archive (or old pickle file)')
+    parser.add_argument('--dataset', required=True, help='tensor store of the held-out set')
+    parser.add_argument('--labels', required=True, help='labels file of the dataset')
+    parser.add_argument('--label-column', type=int, default=None,
+                        help='column of the labels in the labels file (default: the column of the '
+                             'task, see label_columns in ccnn_transfer_matrix.py)')
+    parser.add_argument('--folds', default=None,
+                        help='folds file: each fold is checked on its test subjects (or the '
+                             'repeat of the fold plan set by fold_plan, see ccnn_folds.py)')
+    parser.add_argument('--max-accuracy-drop', type=float, default=1.0, help='percentage points')
+    parser.add_argument('--max-rsq-drop', type=float, default=0.01)
+    parser.add_argument('--repeats', type=int, default=3, help='repetitions of the timed inference')
+    parser.add_argument('--out', default=None, help='quantized archive (default: WEIGHTS_int8)')
+    parser.add_argument('--force', action='store_true', help='save even if the check fails')
+    args = parser.parse_args()
+
+    data_tensor, data_stats = load_normalized_tensor(args.dataset)
+    labels_csv = np.loadtxt(args.labels, delimiter=',')
+    subjectIDs = labels_csv[:, 0]
+    check_subjects(args.dataset, subjectIDs)
+    folds = archive_folds(args.weights)
+    test_rows = None
+    if args.folds is not None:
+        test_rows = load_folds(args.folds, subjectIDs)[1]   # or a fold plan, see ccnn_folds.py
+    if test_rows is not None and folds is None:
+        raise ValueError('%s holds a single set of weights, --folds needs a cross-validation archive'
+                         % args.weights)
+
+    quantized_folds = {}
+    accepted = True
+    print('%6s %10s %10s %10s %10s %9s %8s' % ('fold', 'metric', 'float', 'int8', 'delta', 'speedup', 'check'))
+    for fold in ([None] if folds is None else folds):
+        weights = load_weights(args.weights, fold=fold, mmap=False)
+        quantized = quantize_weights(weights)
+        heldout = np.arange(data_tensor.shape[0]) if test_rows is None else test_rows[fold]
+        data = data_tensor[heldout]
+        float_pred, float_time = _timed_predict(data, weights, args.repeats)
+        quant_pred, quant_time = _timed_predict(data, quantized, args.repeats)
+        task = 'class' if float_pred.shape[1] > 1 else 'regr'
+        column = label_column(args.labels, task) if args.label_column is None else args.label_column
+        report = check_quantized(float_pred, quant_pred, labels_csv[heldout, column],
+                                 args.max_accuracy_drop, args.max_rsq_drop)
+        accepted = accepted and report['accepted']
+        quantized_folds[fold] = quantized
+        print('%6s %10s %10.3f %10.3f %+10.3f %9.2f %8s' % (
+            'all' if fold is None else fold, report['metric'], report['float'], report['quantized'],
+            report['delta'], float_time / quant_time, 'ok' if report['accepted'] else 'FAILED'))
+    print('Weights: %.1f MB float32, %.1f MB int8; largest relative error of a layer: %.4f' % (
+        _num_bytes(weights) / 1024.0**2, _num_bytes(quantized) / 1024.0**2,
+        max(quantization_error(weights, quantized).values())))
+
+    if not accepted and not args.force:
+        print('The quantized network is not accepted: the drop exceeds the tolerance (see --force)')
+    else:
+        out = args.out or archive_path(args.weights) + '_int8'
+        if folds is None:
+            save_weights(out, quantized_folds[None])
+        else:
+            create_archive(out, len(folds))
+            for fold in folds:
+                save_fold_weights(out, fold, quantized_folds[fold])
+        print('Quantized weights saved into %s' % out)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+This script is a fast path of the conditions in which the convolutional layers
+transferred from the public dataset are kept constant (CONVconst): instead of
+training the fully connected layers for thousands of steps in each fold, the
+outputs of the frozen convolutional layers (the 256 features of the second
+layer, see conv_features in 'ccnn_inference.py') are computed once for the
+target dataset, and a linear readout is fitted on them in each fold of the
+cross-validation (the folds are stored in 'folds_inhouse.npy' /
+'folds_NKI-RS_subset.npy'):
+
+- regression of chronological age (as in 'ccnn_regr_transfer.py'): ridge
+  regression, in closed form,
+- classification of age category (as in
+  'ccnn_class_CONVconstFULLtrain_FULLinit.py'): L2-regularized logistic
+  regression, fitted by a few Newton iterations.
+
+The regularization strength is selected in each fold from a grid by an inner
+cross-validation on the training subjects of the fold. The features are
+computed from the dataset normalized as a whole (the scripts normalize the train
+and test data of each fold separately, which shifts and scales them slightly).
+The results are saved into 'results_ccnn_class_CONVconstREADOUT_*.npz' /
+'results_ccnn_regr_readout_*.npz' in the format of the scripts, thus they can be
+compared with the results of the trained networks by the statistics scripts.
+
+    python ccnn_readout.py --task class|regr [--target-data 1] [--weights weights_public] [--lambdas 0.01 0.1 1 10 100]
+"""
+# Importing necessary libraries
+import argparse
+import time
+
+if __name__ == '__main__':
+    # Run as a script: threads are set before NumPy is imported (BLAS threads,
+    # see ccnn_session.py); importing the module leaves them to the caller
+    from ccnn_session import apply_threads
+    apply_threads()
+import numpy as np
+
+# Source weights and results file of each task
+SOURCE_WEIGHTS = {'class': 'weights_public', 'regr': 'weights_public_regr'}
+RESULTS_FILE = {'class': 'results_ccnn_class_CONVconstREADOUT_%s.npz',
+                'regr': 'results_ccnn_regr_readout_%s.npz'}
+RESULTS_CONDITION = {'class': 'class_CONVconstREADOUT', 'regr': 'regr_readout'}
+TARGET_DATA = {1: ('inhouse', 'CORR_tensor_inhouse', 'labels_inhouse.txt', 'folds_inhouse.npy'),
+               2: ('NKI-RS_subset', 'CORR_tensor_NKI-RS_subset', 'labels_NKI-RS_subset.csv',
+                   'folds_NKI-RS_subset.npy')}
+LAMBDAS = np.logspace(-3, 3, 13)
+
+# %% ####################### Function definitions #############################
+
+# frozen_features computes the outputs of the frozen convolutional layers for
+# a dataset in batches of instances
+# INPUT: data: 4D tensor (np.array) of normalized connectivity matrices
+#        weights: dictionary of weights and biases (see ccnn_weights.py)
+# OUTPUT: 2D tensor (np.array) [num_instances, 256]
+def frozen_features(data, weights, batch_size=256):
+    from ccnn_inference import conv_features
+    weights = dict((name, np.asarray(value, dtype=np.float32)) for name, value in weights.items())
+    return np.vstack([conv_features(np.asarray(data[offset:(offset + batch_size)], dtype=np.float32), weights)
+                      for offset in range(0, data.shape[0], batch_size)]).astype(np.float64)
+
+# standardize scales the features to zero mean and unit variance using the
+# statistics of the training instances
+def standardize(train_features, test_features):
+    mean = np.mean(train_features, axis=0)
+    std = np.std(train_features, axis=0)
+    std[std == 0] = 1.0
+    return (train_features - mean) / std, (test_features - mean) / std
+
+# fit_ridge fits ridge regression (unpenalized intercept) for a grid of
+# regularization strengths at once, from the eigendecomposition of the Gram
+# matrix of the centered features
+# INPUT: features: 2D tensor (np.array) [num_instances, num_features]
+#        targets: 1D vector (np.array)
+#        lambdas: regularization strengths
+# OUTPUT: weights [num_lambdas, num_features] and intercepts [num_lambdas]
+def fit_ridge(features, targets, lambdas):
+    mean = np.mean(features, axis=0)
+    centered = features - mean
+    eigenvalues, eigenvectors = np.linalg.eigh(np.dot(centered.T, centered))
+    projected = np.dot(eigenvectors.T, np.dot(centered.T, targets - np.mean(targets)))
+    weights = np.dot(projected[None, :] / (eigenvalues[None, :] + np.asarray(lambdas)[:, None]),
+                     eigenvectors.T)
+    return weights, np.mean(targets) - np.dot(weights, mean)
+
+# fit_logistic fits L2-regularized logistic regression (unpenalized intercept)
+# by Newton iterations
+# INPUT: features: 2D tensor (np.array) [num_instances, num_features]
+#        targets: 1D vector (np.array) of binary labels (0 or 1)
+#        lam: regularization strength
+# OUTPUT: weights [num_features] and intercept
+def fit_logistic(features, targets, lam, num_iterations=25, tol=1e-6):
+    design = np.hstack([features, np.ones((features.shape[0], 1))])
+    penalty = np.full(design.shape[1], float(lam))
+    penalty[-1] = 0.0
+    beta = np.zeros(design.shape[1])
+    for _ in range(num_iterations):
+        p = 1.0 / (1.0 + np.exp(-np.dot(design, beta)))
+        gradient = np.dot(design.T, p - targets) + penalty * beta
+        hessian = np.dot(design.T * (p * (1 - p)), design) + np.diag(penalty + 1e-8)
+        step = np.linalg.solve(hessian, gradient)
+        beta -= step
+        if np.max(np.abs(step)) < tol:
+            break
+    return beta[:-1], beta[-1]
+
+# predict_readout computes the predictions of a fitted readout in the format of
+# the scripts: soft-max probabilities of the two classes, or a column of ages
+def predict_readout(features, weights, intercept, task):
+    output = np.dot(features, weights) + intercept
+    if task == 'class':
+        p = 1.0 / (1.0 + np.exp(-output))
+        return np.stack([1 - p, p], axis=1).astype(np.float32)
+    return output[:, None].astype(np.float32)
+
+# select_lambda selects the regularization strength by cross-validation over
+# the training subjects (instances of a subject are kept in the same fold)
+# INPUT: features, targets: training instances and their labels
+#        subjects: subject IDs of the training instances
+#        task: 'class' (log-loss) or 'regr' (mean squared error)
+#        lambdas: grid of regularization strengths
+#        num_folds: number of inner folds
+# OUTPUT: selected regularization strength
+def select_lambda(features, targets, subjects, task, lambdas, num_folds=5):
+    unique = np.unique(subjects)
+    inner = np.random.RandomState(0).permutation(len(unique)) % num_folds
+    fold_of = inner[np.searchsorted(unique, subjects)]
+    errors = np.zeros(len(lambdas))
+    for k in range(num_folds):
+        test = fold_of == k
+        if not np.any(test) or np.all(test):
+            continue
+        train_f, test_f = standardize(features[~test], features[test])
+        if task == 'regr':
+            weights, intercepts = fit_ridge(train_f, targets[~test], lambdas)
+            errors += np.sum((np.dot(test_f, weights.T) + intercepts - targets[test, None])**2, axis=0)
+        else:
+            for j, lam in enumerate(lambdas):
+                weights, intercept = fit_logistic(train_f, targets[~test], lam)
+                p = np.clip(predict_readout(test_f, weights, intercept, task)[:, 1], 1e-7, 1 - 1e-7)
+                errors[j] -= np.sum(targets[test] * np.log(p) + (1 - targets[test]) * np.log(1 - p))
+    return lambdas[int(np.argmin(errors))]
+
+# readout_cv fits and evaluates the readout in each fold of the cross-validation
+# INPUT: features: 2D tensor (np.array) of the frozen features of the dataset
+#        targets: 1D vector (np.array) of labels (class labels 0/1 or ages)
+#        subjectIDs: subject IDs of the instances
+#        test_rows: list of the row indices of the test instances of each fold
+#                   (see load_folds in ccnn_folds.py)
+#        task: 'class' or 'regr'
+#        lambdas: grid of regularization strengths
+# OUTPUT: test_labs, test_preds: lists of the test labels and predictions of
+#         each fold (as in the scripts), selected: regularization strengths
+def readout_cv(features, targets, subjectIDs, test_rows, task, lambdas=LAMBDAS):
+    test_labs, test_preds, selected = [], [], []
+    for i in range(len(test_rows)):
+        testIDs = np.zeros(len(subjectIDs), dtype=bool)
+        testIDs[test_rows[i]] = True
+        lam = select_lambda(features[~testIDs], targets[~testIDs], subjectIDs[~testIDs], task, lambdas)
+        train_f, test_f = standardize(features[~testIDs], features[testIDs])
+        if task == 'regr':
+            weights, intercepts = fit_ridge(train_f, targets[~testIDs], [lam])
+            weights, intercept = weights[0], intercepts[0]
+            test_labels = targets[testIDs][:, None]
+        else:
+            weights, intercept = fit_logistic(train_f, targets[~testIDs], lam)
+            test_labels = (np.arange(2) == targets[testIDs][:, None]).astype(np.float32)
+        test_pred = predict_readout(test_f, weights, intercept, task)
+        if task == 'regr':
+            print('Fold %d (lambda %g): MAE %.2f' % (i+1, lam, np.mean(np.abs(test_pred - test_labels))))
+        else:
+            print('Fold %d (lambda %g): accuracy %.1f%%' % (
+                i+1, lam, 100.0 * np.mean(np.argmax(test_pred, 1) == np.argmax(test_labels, 1))))
+        test_labs.append(test_labels)
+        test_preds.append(test_pred)
+        selected.append(lam)
+    return test_labs, test_preds, selected
+
+# %% ####################### Fitting the readouts ##############################
+
+if __name__ == '__main__':
+    from ccnn_folds import load_folds
+    from ccnn_options import output_name
+    from ccnn_results import append_results
+    from ccnn_tensor_store import check_subjects, load_normalized_tensor
+    from ccnn_transfer_matrix import label_column
+    from ccnn_weights import load_weights
+
+    parser = argparse.ArgumentParser(description='Closed-form linear readout on frozen CCNN features.')
+    parser.add_argument('--task', choices=['class', 'regr'], default='class')
+    parser.add_argument('--target-data', type=int, choices=[1, 2], default=1,
+                        help='1 = in-house dataset, 2 = NKI-RS subset')
+    parser.add_argument('--weights', default=None, help='source weights (default: by task)')
+    parser.add_argument('--lambdas', type=float, nargs='+', default=None, help='regularization strengths')
+    args = parser.parse_args()
+
+    suffix, tensor_store, labels_file, folds_file = TARGET_DATA[args.target_data]
+    start = time.time()
+    data_tensor, data_stats = load_normalized_tensor(tensor_store)
+    labels_csv = np.loadtxt(labels_file, delimiter=',')
+    subjectIDs = labels_csv[:, 0]
+    check_subjects(tensor_store, subjectIDs)
+    targets = labels_csv[:, label_column(labels_file, args.task)]
+    if args.task == 'class' and len(np.unique(targets)) != 2:
+        raise ValueError('the logistic readout needs two classes, %s has %d' % (labels_file, len(np.unique(targets))))
+    IDs, test_rows = load_folds(folds_file, subjectIDs)   # or a fold plan, see ccnn_folds.py
+
+    # The frozen features are computed once for the whole dataset
+    weights = load_weights(args.weights or SOURCE_WEIGHTS[args.task])
+    features = frozen_features(data_tensor, weights)
+    del data_tensor
+    print('Features of %d instances computed in %.1f s' % (features.shape[0], time.time() - start))
+
+    lambdas = LAMBDAS if args.lambdas is None else np.array(args.lambdas)
+    test_labs, test_preds, selected = readout_cv(features, targets, subjectIDs, test_rows, args.task, lambdas)
+
+    l = np.vstack(test_labs)
+    p = np.vstack(test_preds)
+    if args.task == 'regr':
+        print('\nOverall MAE: %.2f' % np.mean(np.abs(p - l)))
+    else:
+        print('\nOverall accuracy: %.1f%%' % (100.0 * np.mean(np.argmax(p, 1) == np.argmax(l, 1))))
+    results_file = output_name(RESULTS_FILE[args.task] % suffix)
+    np.savez(results_file, labels=l, predictions=p, splits=IDs, lambdas=np.array(selected))
+    print('Results saved into %s in %.1f s' % (results_file, time.time() - start))
+
+    # The test results of each fold are appended to the results store as well
+    # (see ccnn_results.py)
+    for i in range(len(test_rows)):
+        test_instances = test_rows[i]
+        append_results(RESULTS_CONDITION[args.task], suffix, i, subjectIDs[test_instances],
+                       test_labs[i], test_preds[i], instances=test_instances)
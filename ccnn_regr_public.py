@@ -27,49 +27,54 @@ https://github.com/tensorflow/tensorflow/blob/master/tensorflow/examples/udacity
 # %% ########################### Loading data #################################
 
 # Importing necessary libraries
+from ccnn_session import apply_threads, session_config
+apply_threads()   # before NumPy is imported (BLAS threads, see ccnn_session.py)
 import numpy as np
-import tensorflow as tf
-from six.moves import cPickle as pickle
+from ccnn_memory import MemoryMonitor
+from ccnn_options import option
+from ccnn_profile import StepProfiler
+from ccnn_telemetry import Telemetry
+from ccnn_tensor_store import check_subjects, load_normalized_tensor
+from ccnn_weight_bank import bank_weights
+from ccnn_weights import save_weights
+
+# The random seed can be set by the experiment scheduler (see ccnn_scheduler.py
+# and ccnn_options.py)
+seed = option('seed', None)   # random seed of the run (None = not seeded)
+if seed is not None:
+    np.random.seed(seed)
+
+# Memory use of the phases of the script is written into the run log (see
+# ccnn_memory.py); NaNs are replaced and data are normalized while loading
+memory = MemoryMonitor('ccnn_regr_public')
+memory.phase('load')
 
 # Loading the connectivity matrices
-picklefile = "CORR_tensor_public_regr.pickle"
+tensor_store = "CORR_tensor_public_regr"
 
-with open(picklefile, 'rb') as f:
-    save = pickle.load(f)
-    data_tensor = save['data_tensor']
-    del save
+# NaNs are replaced with 0s and data are normalized using the statistics
+# stored with the dataset (see ccnn_preprocess.py)
+data_tensor, data_stats = load_normalized_tensor(tensor_store)
 
 # Loading labels
 labels_csv = np.loadtxt("labels_public_regr.csv", delimiter=',')
+check_subjects(tensor_store, labels_csv[:, 0])   # rows of the store and of the labels file must match
 labels = labels_csv[:, 1]
 labels = np.reshape(labels, (labels.shape[0], -1))
 
-# Loading weights
-picklefile = "weights_public.pickle"
-        
-with open(picklefile, 'rb') as f:
-    save = pickle.load(f)
-    layer1_weights_age = save['layer1_weights']
-    layer1_biases_age = save['layer1_biases']
-    layer2_weights_age = save['layer2_weights']
-    layer2_biases_age = save['layer2_biases']
-    layer3_weights_age = save['layer3_weights']
-    layer3_biases_age = save['layer3_biases']
-    layer4_weights_age = save['layer4_weights']
-    layer4_biases_age = save['layer4_biases']
-    del save    
+# Loading weights (only the convolutional layers are needed)
+weights = bank_weights("weights_public", layers=['layer1_weights', 'layer1_biases',
+                                               'layer2_weights', 'layer2_biases'])
+layer1_weights_age = weights['layer1_weights']
+layer1_biases_age = weights['layer1_biases']
+layer2_weights_age = weights['layer2_weights']
+layer2_biases_age = weights['layer2_biases']
+del weights
 
 # %% ####################### Function definitions #############################
 # Define functions for cross-validation, tensor randomization and normalization 
 # and performance calculation
 
-# normalize_tensor standardizes an n dimesional np.array to have zero mean and 
-# standard deviation of 1
-def normalize_tensor(data_tensor):
-    data_tensor -= np.mean(data_tensor)
-    data_tensor /= np.max(np.abs(data_tensor))
-    return data_tensor
-
 # randomize_tensor generates a random permutation of instances and the 
 # corresponding labels before training
 # INPUT: dataset: 4D tensor (np.array), instances are concatenated along the 
@@ -100,7 +105,7 @@ def r_squared(labels, predictions):
   
 # %% ####### Preparing the data and initializing network parameters ###########
 
-numROI = 111
+numROI = data_tensor.shape[1]   # number of ROIs of the atlas, read from the dataset
 num_channels = 1
 num_labels = 1
 image_size = numROI
@@ -108,9 +113,10 @@ batch_size = 4
 patch_size = image_size
 keep_pr = 0.6     # the probability that each element is kept during dropout
 
-# Replacing NaNs with 0s and normalizing data
-data_tensor[np.isnan(data_tensor)] = 0
-data_tensor = normalize_tensor(data_tensor)
+# The pretrained network has to be defined on the same atlas as the dataset
+if layer2_weights_age.shape[0] != numROI:
+    raise ValueError('the pretrained weights are defined on %d ROIs, the dataset has %d ROIs'
+                     % (layer2_weights_age.shape[0], numROI))
 
 # Training data and labels
 train_data = data_tensor.astype(np.float32)
@@ -118,14 +124,22 @@ train_labels = labels
 
 # %% ##################### launching TensorFlow ###############################
 
+# TensorFlow is imported only here, where the computational graph is built
+import tensorflow as tf
+
 # Adjusting image size
 train_data = train_data[:, :image_size, :image_size, :]
 
+memory.phase('graph')
 # Drawing the computational graph    
 graph = tf.Graph()
     
 with graph.as_default():
     
+    # Graph-level random seed (initialization, dropout)
+    if seed is not None:
+        tf.set_random_seed(seed)
+
     # Input data placeholders
     tf_train_dataset = tf.placeholder(tf.float32, shape=(batch_size, image_size, image_size, num_channels))
     tf_train_labels = tf.placeholder(tf.float32, shape=(batch_size, num_labels))
@@ -157,21 +171,26 @@ with graph.as_default():
         # Fourth (output) layer: fully connected layer with logits as output
         return tf.matmul(hidden, layer4_weights) + layer4_biases
 
-    # Calculate loss-function (cross-entropy) in training
-    loss = tf.losses.mean_squared_error(labels=tf_train_labels, predictions=model(tf_train_dataset, keep_pr)) 
+    # Calculate loss-function (mean squared error) in training; the predictions
+    # on the training batch are those of the same forward pass
+    train_prediction = model(tf_train_dataset, keep_pr)
+    loss = tf.losses.mean_squared_error(labels=tf_train_labels, predictions=train_prediction)
             
     # Optimizer definition
     learning_rate = 0.0005
     optimizer = tf.train.AdamOptimizer(learning_rate).minimize(loss) 
-    
-    # Calculate predictions from training data
-    train_prediction = model(tf_train_dataset, keep_pr)
             
     # Number of iterations
     num_steps = 10001
       
+memory.phase('train')
+# Op-level profiling of a window of training steps (see ccnn_profile.py)
+profiler = StepProfiler('profile_ccnn_regr_public')
+# Training metrics are computed only at the steps reported (see ccnn_telemetry.py)
+telemetry = Telemetry('ccnn_regr_public', 500)
+
 # Start TensorFlow session
-with tf.Session(graph=graph) as session:
+with tf.Session(graph=graph, config=session_config()) as session:
     
     # Initializing variables    
     tf.global_variables_initializer().run()
@@ -192,14 +211,22 @@ with tf.Session(graph=graph) as session:
             
         # Feed batch data to the placeholders
         feed_dict = {tf_train_dataset : batch_data, tf_train_labels : batch_labels}
-        _, l, predictions = session.run(
-        [optimizer, loss, train_prediction], feed_dict=feed_dict)
+        if telemetry.due(step):
+            _, l, predictions = session.run(
+                    [optimizer, loss, train_prediction], feed_dict=feed_dict, **profiler.run_kwargs(step))
+        else:
+            _, l = session.run([optimizer, loss], feed_dict=feed_dict, **profiler.run_kwargs(step))
+        profiler.record(step)
+        telemetry.add(l)
             
         # At every 500. step give some feedback on the progress
-        if (step % 500 == 0):
-            print('Minibatch loss at step %d: %f' % (step, l))
-            print('Minibatch R squared: %.2f' % r_squared(labels=batch_labels, predictions=predictions))
+        if telemetry.due(step):
+            train_rsq = r_squared(labels=batch_labels, predictions=predictions)
+            telemetry.report(step, l, r_squared=train_rsq)
+            print('Minibatch R squared: %.2f' % train_rsq)
                     
+    profiler.save()
+
     # Saving final weights and bias terms
     layer1_weights_final = layer1_weights.eval()
     layer1_biases_final = layer1_biases.eval()
@@ -210,23 +237,19 @@ with tf.Session(graph=graph) as session:
     layer4_weights_final = layer4_weights.eval()
     layer4_biases_final = layer4_biases.eval()
 
-# Saving weights
-pickle_file = "weights_public_regr.pickle"
-    
-try:
-    f = open(pickle_file, 'wb')
-    save = {
-            'layer1_weights': layer1_weights_final,
-            'layer1_biases': layer1_biases_final,
-            'layer2_weights': layer2_weights_final,
-            'layer2_biases': layer2_biases_final,
-            'layer3_weights': layer3_weights_final,
-            'layer3_biases': layer3_biases_final,
-            'layer4_weights': layer4_weights_final,
-            'layer4_biases': layer4_biases_final,
-            }
-    pickle.dump(save, f, pickle.HIGHEST_PROTOCOL)
-    f.close()
-except Exception as e:
-    print('Unable to save data to', pickle_file, ':', e)
-    raise
\ No newline at end of file
+memory.phase('save')
+# Saving weights and biases
+weight_archive = "weights_public_regr"
+save_weights(weight_archive, {
+        'layer1_weights': layer1_weights_final,
+        'layer1_biases': layer1_biases_final,
+        'layer2_weights': layer2_weights_final,
+        'layer2_biases': layer2_biases_final,
+        'layer3_weights': layer3_weights_final,
+        'layer3_biases': layer3_biases_final,
+        'layer4_weights': layer4_weights_final,
+        'layer4_biases': layer4_biases_final,
+        })
+
+# Memory use of the phases (peaks and optional report, see ccnn_memory.py)
+memory.end()
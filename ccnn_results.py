@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the results store, which collects the test predictions
+of all runs of the scripts in one place. A store is a directory (by default
+'results_store', or the directory given by the setting 'results_store', see
+'ccnn_options.py') of chunks, each chunk being an .npz file holding the columns
+of the rows of one fold of one run:
+
+- 'instance': position of the instance in the dataset
+- 'subject': subject ID
+- 'label': true label (one-hot encoding for classification, age for regression)
+- 'prediction': prediction of the network (soft-max output, or age)
+
+plus an index ('index.json') listing the chunks with the condition (e.g.
+'class_CONVinitFULLtrain'), dataset ('inhouse' or 'NKI-RS_subset'), random seed,
+run tag, run ID and fold of their rows. The run ID is drawn once per process
+(start time and process ID), so that repeated runs of a script with the same
+settings are kept apart. The scripts append a chunk as soon as a fold is
+finished (the results_*.npz files are written as before), chunks are never
+rewritten, and queries by condition, dataset, seed, run or fold only read the
+chunks selected through the index.
+
+Running this module as a script lists the runs in the store, summarizes their
+performance, or exports a run into a results_*.npz file (format of the
+scripts):
+
+    python ccnn_results.py list [--store results_store]
+    python ccnn_results.py summary [--condition class_CONVinitFULLtrain] [--dataset inhouse] [--run-tag TAG]
+    python ccnn_results.py export CONDITION DATASET OUTPUT_NPZ [--seed 3] [--run-tag TAG] [--run RUN]
+"""
+# Importing necessary libraries
+import argparse
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from ccnn_options import option
+
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'index.lock'
+STORE_FORMAT = 'ccnn-results'
+STORE_VERSION = 1
+DEFAULT_STORE = 'results_store'
+COLUMNS = ['instance', 'subject', 'label', 'prediction']
+
+# ID of the runs of this process (see append_results)
+RUN_ID = '%s_%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+
+# Names of the target datasets selected by 'target_data' in the scripts
+DATASET_NAMES = {1: 'inhouse', 2: 'NKI-RS_subset'}
+
+# %% ####################### Function definitions #############################
+
+# dataset_name returns the name of the target dataset selected by 'target_data'
+def dataset_name(target_data):
+    return DATASET_NAMES[target_data]
+
+# store_path returns the results store used by the scripts
+def store_path(path=None):
+    if path is None:
+        path = option('results_store', DEFAULT_STORE)
+    return path
+
+def _index_file(path):
+    return os.path.join(path, INDEX_FILE)
+
+# read_index returns the index of a results store (a dictionary); an empty
+# index if there is no store
+def read_index(path=None):
+    path = store_path(path)
+    if not os.path.isfile(_index_file(path)):
+        return {'format': STORE_FORMAT, 'version': STORE_VERSION, 'num_rows': 0, 'chunks': []}
+    with open(_index_file(path), 'r') as f:
+        return json.load(f)
+
+# The index is replaced atomically, so that readers never see a chunk that has
+# not been written completely
+def _write_index(path, index):
+    tmp_file = _index_file(path) + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, _index_file(path))
+
+# Runs appending to the same store (e.g. workers of ccnn_scheduler.py) update
+# the index one at a time
+@contextmanager
+def _locked(path):
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+# append_results appends the test results of a fold of a run to the store
+# INPUT: condition: name of the condition (e.g. 'class_CONVtrainFULLtrain')
+#        dataset: name of the dataset (e.g. 'inhouse')
+#        fold: number of the fold (starting from 0), or None without
+#              cross-validation
+#        subjects: subject IDs of the test instances
+#        labels: 2D tensor (np.array) of true labels
+#        predictions: 2D tensor (np.array) of predictions
+#        instances: positions of the test instances in the dataset
+#        seed: random seed of the run (None = not seeded)
+#        path: results store (default: see store_path)
+# OUTPUT: the index entry of the new chunk (dictionary)
+def append_results(condition, dataset, fold, subjects, labels, predictions, instances=None,
+                   seed=None, path=None):
+    path = store_path(path)
+    labels = np.reshape(np.asarray(labels, dtype=np.float32), (len(subjects), -1))
+    predictions = np.reshape(np.asarray(predictions, dtype=np.float32), (len(subjects), -1))
+    if instances is None:
+        instances = np.arange(len(subjects))
+    chunk = {'condition': condition, 'dataset': dataset, 'seed': seed,
+             'run_tag': os.environ.get('CCNN_RUN_TAG'), 'run': RUN_ID, 'fold': -1 if fold is None else int(fold),
+             'num_rows': len(subjects), 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+             'file': 'chunk_%d_%d_%s.npz' % (os.getpid(), int(time.time() * 1e6), dataset)}
+    with _locked(path):
+        np.savez(os.path.join(path, chunk['file']), instance=np.asarray(instances, dtype=np.int64),
+                 subject=np.asarray(subjects, dtype=np.float64), label=labels, prediction=predictions)
+        index = read_index(path)
+        index['chunks'].append(chunk)
+        index['num_rows'] += chunk['num_rows']
+        _write_index(path, index)
+    return chunk
+
+def _matches(chunk, selection):
+    return all(value is None or chunk.get(key) == value for key, value in selection.items())
+
+# select_chunks returns the index entries of the chunks matching a query
+# (arguments left None match every chunk; chunks written before run IDs were
+# kept have no run)
+def select_chunks(condition=None, dataset=None, seed=None, fold=None, run_tag=None, run=None,
+                  path=None):
+    selection = {'condition': condition, 'dataset': dataset, 'seed': seed, 'fold': fold,
+                 'run_tag': run_tag, 'run': run}
+    return [chunk for chunk in read_index(path)['chunks'] if _matches(chunk, selection)]
+
+def _read_chunks(path, chunks):
+    columns = dict((name, []) for name in COLUMNS + ['fold', 'seed', 'condition', 'dataset'])
+    for chunk in chunks:
+        with np.load(os.path.join(path, chunk['file'])) as data:
+            for name in COLUMNS:
+                columns[name].append(data[name])
+        n = chunk['num_rows']
+        columns['fold'].append(np.full(n, chunk['fold'], dtype=np.int16))
+        columns['seed'].append(np.full(n, np.nan if chunk['seed'] is None else chunk['seed']))
+        columns['condition'].append(np.full(n, chunk['condition'], dtype=object))
+        columns['dataset'].append(np.full(n, chunk['dataset'], dtype=object))
+    if not chunks:
+        return dict((name, np.array([])) for name in columns)
+    widths = set(values.shape[1] for values in columns['prediction'])
+    if len(widths) > 1:
+        raise ValueError('the query selects classification and regression results, '
+                         'select a condition or dataset')
+    return dict((name, np.concatenate(values)) for name, values in columns.items())
+
+def _run_key(chunk):
+    return (chunk['condition'], chunk['dataset'], chunk['seed'], chunk['run_tag'], chunk.get('run'))
+
+# query reads the rows matching a query, reading only the selected chunks
+# INPUT: see select_chunks
+# OUTPUT: dictionary of columns (np.arrays): those of COLUMNS, plus 'fold',
+#         'seed' (NaN if not seeded), 'condition' and 'dataset'
+def query(condition=None, dataset=None, seed=None, fold=None, run_tag=None, run=None, path=None):
+    path = store_path(path)
+    return _read_chunks(path, select_chunks(condition, dataset, seed, fold, run_tag, run, path))
+
+# read_run reads the rows of one run listed by runs (unlike in query, a seed,
+# run tag or run left None only matches chunks without them)
+# INPUT: key: (condition, dataset, seed, run tag, run ID)
+# OUTPUT: see query
+def read_run(key, path=None):
+    path = store_path(path)
+    return _read_chunks(path, [chunk for chunk in read_index(path)['chunks'] if _run_key(chunk) == tuple(key)])
+
+# runs lists the runs in the store: (condition, dataset, seed, run tag, run ID)
+# with their number of folds and rows
+def runs(path=None):
+    table = {}
+    for chunk in read_index(path)['chunks']:
+        entry = table.setdefault(_run_key(chunk), {'folds': set(), 'num_rows': 0})
+        entry['folds'].add(chunk['fold'])
+        entry['num_rows'] += chunk['num_rows']
+    return table
+
+# performance returns the accuracy (in %) of classification results or the
+# mean absolute error of regression results
+def performance(labels, predictions):
+    if predictions.shape[1] > 1:
+        return 100.0 * np.mean(np.argmax(predictions, 1) == np.argmax(labels, 1))
+    return np.mean(np.abs(predictions - labels))
+
+# export_results writes the rows of a run into a results_*.npz file in the
+# format of the scripts (rows ordered by fold, then by instance; the splits hold
+# the test subject IDs of each fold in a column, padded with 0s); the selection
+# has to match a single run
+def export_results(output_file, condition, dataset, seed=None, run_tag=None, run=None, path=None):
+    chunks = select_chunks(condition, dataset, seed, run_tag=run_tag, run=run, path=store_path(path))
+    matched = sorted(set(_run_key(chunk) for chunk in chunks), key=str)
+    if len(matched) > 1:
+        raise ValueError('%d runs of %s on %s match, select one with the seed, run tag or run: %s'
+                         % (len(matched), condition, dataset,
+                            ', '.join('seed %s tag %s run %s' % key[2:] for key in matched)))
+    rows = query(condition, dataset, seed, run_tag=run_tag, run=run, path=path)
+    order = np.lexsort((rows['instance'], rows['fold']))
+    folds = np.unique(rows['fold'])
+    fold_subjects = [np.unique(rows['subject'][rows['fold'] == fold]) for fold in folds]
+    splits = np.zeros((max([len(s) for s in fold_subjects] + [0]), len(folds)))
+    for k, subjects in enumerate(fold_subjects):
+        splits[:len(subjects), k] = subjects
+    np.savez(output_file, labels=rows['label'][order], predictions=rows['prediction'][order],
+             splits=splits)
+    return len(order)
+
+# %% ######################## Querying the store ##############################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Results store of the runs of the scripts.')
+    parser.add_argument('command', choices=['list', 'summary', 'export'])
+    parser.add_argument('arguments', nargs='*', help='export: CONDITION DATASET OUTPUT_NPZ')
+    parser.add_argument('--store', default=None)
+    parser.add_argument('--condition', default=None)
+    parser.add_argument('--dataset', default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--run-tag', default=None, help='run tag (CCNN_RUN_TAG of the run)')
+    parser.add_argument('--run', default=None, help='run ID (see list)')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for (condition, dataset, seed, run_tag, run), entry in sorted(runs(args.store).items(), key=str):
+            print('%-32s %-14s seed %-6s %-16s %-22s %2d folds %6d rows' % (
+                condition, dataset, seed, run_tag or '', run or '', len(entry['folds']), entry['num_rows']))
+    elif args.command == 'summary':
+        for (condition, dataset, seed, run_tag, run), entry in sorted(runs(args.store).items(), key=str):
+            if (args.condition not in (None, condition) or args.dataset not in (None, dataset)
+                    or args.seed not in (None, seed) or args.run_tag not in (None, run_tag)
+                    or args.run not in (None, run)):
+                continue
+            rows = read_run((condition, dataset, seed, run_tag, run), args.store)
+            value = performance(rows['label'], rows['prediction'])
+            print('%-32s %-14s seed %-6s %-22s %s %.2f' % (condition, dataset, seed, run or '',
+                                                           'accuracy' if rows['prediction'].shape[1] > 1 else 'MAE',
+                                                           value))
+    else:
+        if len(args.arguments) != 3:
+            parser.error('export needs CONDITION DATASET OUTPUT_NPZ')
+        condition, dataset, output_file = args.arguments
+        num_rows = export_results(output_file, condition, dataset, args.seed, args.run_tag, args.run,
+                                  path=args.store)
+        print('%d rows of %s on %s saved into %s' % (num_rows, condition, dataset, output_file))
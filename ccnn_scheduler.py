@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements a scheduler running the conditions of the experiments
+(scripts with given settings, e.g. 'initmode', 'target_data' and random seed)
+from a job queue kept on a shared filesystem, so that any number of worker
+processes on any number of nodes can run the full grid of conditions.
+
+A grid (JSON file, or DEFAULT_GRID below) lists scripts with the values of
+their settings; every combination of values is a job. Jobs can be run after
+all jobs of other scripts have been done ('after'), e.g. the transfer scripts
+after the scripts producing the pretrained weights. The settings are passed
+to the scripts through environment variables (see 'ccnn_options.py'). The queue
+is a directory with one JSON file per job in the subdirectories 'pending',
+'running', 'done' and 'failed':
+
+- a worker claims a pending job by moving it into 'running' (the move is atomic,
+  thus only one worker can claim a job),
+- while the job runs, the worker touches its heartbeat file, and jobs whose
+  heartbeat is older than the timeout (e.g. because the node went down) are
+  moved back to 'pending' by the other workers,
+- failed jobs are retried (moved back to 'pending') until the number of retries
+  is exhausted, then they are moved into 'failed'.
+
+The output of each attempt is written into the 'logs' subdirectory. The local
+workers split the cores of the node, each running its jobs on its own cores
+(see 'ccnn_session.py'). Usage:
+
+    python ccnn_scheduler.py submit QUEUE [GRID.json]      # add the jobs of a grid
+    python ccnn_scheduler.py worker QUEUE                  # run jobs (on any node)
+    python ccnn_scheduler.py local QUEUE [GRID.json] --workers 4   # both, on this node
+    python ccnn_scheduler.py status QUEUE
+"""
+# Importing necessary libraries
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from ccnn_options import ENV_PREFIX, option_env
+from ccnn_session import thread_env
+
+STATES = ['pending', 'running', 'done', 'failed']
+
+# Settings reflected in the output file names of the scripts; the other
+# settings (e.g. the seed) are added to the run tag of the job
+NAMED_SETTINGS = ('initmode', 'target_data')
+
+# The conditions of the manuscript on both target datasets (the transfer scripts
+# run after the scripts producing their pretrained weights)
+DEFAULT_GRID = {
+    'retries': 2,
+    'jobs': [
+        {'script': 'ccnn_class_publictrain.py'},
+        {'script': 'ccnn_class_inhousetrain.py'},
+        {'script': 'ccnn_regr_public.py', 'after': ['ccnn_class_publictrain.py']},
+        {'script': 'ccnn_class_CONVtrainFULLtrain.py', 'options': {'target_data': [1, 2]}},
+        {'script': 'ccnn_class_CONVconstFULLconst.py', 'options': {'target_data': [1, 2]},
+         'after': ['ccnn_class_publictrain.py']},
+        {'script': 'ccnn_class_CONVconstFULLtrain_FULLinit.py',
+         'options': {'initmode': [1, 2], 'target_data': [1, 2]},
+         'after': ['ccnn_class_publictrain.py']},
+        {'script': 'ccnn_class_CONVinitFULLtrain_FULLinit.py',
+         'options': {'initmode': [1, 2], 'target_data': [1, 2]},
+         'after': ['ccnn_class_publictrain.py']},
+        {'script': 'ccnn_class_backtransfer.py', 'after': ['ccnn_class_inhousetrain.py']},
+        {'script': 'ccnn_regr_baseline.py', 'options': {'target_data': [1, 2]}},
+        {'script': 'ccnn_regr_transfer.py', 'options': {'target_data': [1, 2]},
+         'after': ['ccnn_regr_public.py']},
+    ]}
+
+# %% ####################### Function definitions #############################
+
+# expand_grid creates the jobs of a grid (every combination of setting values)
+# INPUT: grid: dictionary with a list of 'jobs', each with a 'script',
+#              'options' mapping setting names to lists of values, and
+#              optionally the scripts it has to run 'after'
+#        workdir: directory the scripts are run in (data and weights files)
+# OUTPUT: list of job dictionaries
+def expand_grid(grid, workdir):
+    jobs = []
+    for entry in grid['jobs']:
+        options = entry.get('options', {})
+        names = sorted(options)
+        for values in itertools.product(*[options[name] for name in names]):
+            settings = dict(zip(names, values))
+            tag = '_'.join('%s%s' % (name, settings[name]) for name in names
+                           if name not in NAMED_SETTINGS)
+            job_id = '-'.join([_script_name(entry['script'])] +
+                              ['%s%s' % (name, settings[name]) for name in names])
+            jobs.append({'id': job_id, 'script': entry['script'], 'options': settings,
+                         'run_tag': tag, 'workdir': workdir, 'attempts': 0,
+                         'after': [_script_name(script) for script in entry.get('after', [])],
+                         'retries': entry.get('retries', grid.get('retries', 2)), 'history': []})
+    return jobs
+
+def _script_name(script):
+    return os.path.splitext(os.path.basename(script))[0]
+
+def _job_file(queue, state, job_id):
+    return os.path.join(queue, state, job_id + '.json')
+
+def _heartbeat_file(queue, job_id):
+    return os.path.join(queue, 'running', job_id + '.heartbeat')
+
+def _read_job(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# Job files are replaced atomically, so that no worker reads a partial file
+def _write_job(path, job):
+    tmp_file = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(job, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, path)
+
+def _list_jobs(queue, state):
+    return sorted(name[:-len('.json')] for name in os.listdir(os.path.join(queue, state))
+                  if name.endswith('.json'))
+
+# create_queue creates the directories of a queue
+def create_queue(queue):
+    for state in STATES + ['logs']:
+        if not os.path.isdir(os.path.join(queue, state)):
+            os.makedirs(os.path.join(queue, state))
+
+# submit adds jobs to a queue, skipping the jobs that are already queued,
+# running or finished
+# OUTPUT: number of new jobs
+def submit(queue, jobs):
+    create_queue(queue)
+    known = set(job_id for state in STATES for job_id in _list_jobs(queue, state))
+    new_jobs = [job for job in jobs if job['id'] not in known]
+    for job in new_jobs:
+        _write_job(_job_file(queue, 'pending', job['id']), job)
+    return len(new_jobs)
+
+# _ready checks whether all jobs of the scripts a job has to run after are done
+def _ready(queue, job_id):
+    try:
+        after = _read_job(_job_file(queue, 'pending', job_id)).get('after', [])
+    except (OSError, ValueError):
+        return False
+    if not after:
+        return True
+    done = set(_list_jobs(queue, 'done'))
+    return all(other in done for state in STATES for other in _list_jobs(queue, state)
+               if other.split('-')[0] in after)
+
+# claim moves a pending job that is ready to run into 'running'; only one of
+# the workers trying to claim the same job succeeds
+# OUTPUT: the claimed job (dictionary), or None if no job could be claimed
+def claim(queue, worker):
+    for job_id in _list_jobs(queue, 'pending'):
+        if not _ready(queue, job_id):
+            continue
+        try:
+            os.rename(_job_file(queue, 'pending', job_id), _job_file(queue, 'running', job_id))
+        except OSError:
+            continue   # claimed by another worker
+        job = _read_job(_job_file(queue, 'running', job_id))
+        job['attempts'] += 1
+        job['worker'] = worker
+        job['started'] = time.time()
+        _write_job(_job_file(queue, 'running', job_id), job)
+        _touch(_heartbeat_file(queue, job_id))
+        return job
+    return None
+
+def _touch(path):
+    with open(path, 'a'):
+        os.utime(path, None)
+
+# _finish moves a job from 'running' into the given state and records the
+# attempt; if the job has been requeued in the meantime (stale heartbeat), the
+# result is dropped
+def _finish(queue, job, state, record):
+    running = _job_file(queue, 'running', job['id'])
+    if not os.path.isfile(running) or _read_job(running).get('worker') != job['worker']:
+        print('[%s] %s was requeued, result dropped' % (job['worker'], job['id']))
+        return
+    job['history'].append(record)
+    _write_job(running, job)
+    os.rename(running, _job_file(queue, state, job['id']))
+    try:
+        os.remove(_heartbeat_file(queue, job['id']))
+    except OSError:
+        pass
+
+# reap moves running jobs with a stale heartbeat back to 'pending' (or into
+# 'failed' if they have no retries left)
+# INPUT: timeout: age of the heartbeat (s) after which a job is considered lost
+# OUTPUT: number of reaped jobs
+def reap(queue, timeout):
+    reaped = 0
+    for job_id in _list_jobs(queue, 'running'):
+        try:
+            age = time.time() - os.path.getmtime(_heartbeat_file(queue, job_id))
+        except OSError:
+            # Just claimed (moving the job file updates its status change time)
+            try:
+                age = time.time() - os.stat(_job_file(queue, 'running', job_id)).st_ctime
+            except OSError:
+                continue   # finished in the meantime
+        if age < timeout:
+            continue
+        try:
+            job = _read_job(_job_file(queue, 'running', job_id))
+        except (OSError, ValueError):
+            continue
+        job['history'].append({'worker': job.get('worker'), 'result': 'lost', 'time': time.time()})
+        state = 'pending' if job['attempts'] <= job['retries'] else 'failed'
+        _write_job(_job_file(queue, 'running', job_id), job)
+        try:
+            os.rename(_job_file(queue, 'running', job_id), _job_file(queue, state, job_id))
+            reaped += 1
+        except OSError:
+            continue   # reaped by another worker
+        try:
+            os.remove(_heartbeat_file(queue, job_id))
+        except OSError:
+            pass
+    return reaped
+
+# run_job runs the script of a job with its settings, touching the heartbeat
+# file of the job while the script runs
+# INPUT: threads: environment setting the threads of the worker (see
+#                 thread_env in ccnn_session.py)
+# OUTPUT: return code of the script
+def run_job(queue, job, heartbeat, threads=None):
+    env = dict(os.environ)
+    env.update(threads or {})
+    env.update(option_env(job['options']))
+    env[ENV_PREFIX + 'RUN_TAG'] = job['run_tag']
+    log_file = os.path.join(queue, 'logs', '%s.%d.log' % (job['id'], job['attempts']))
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(heartbeat):
+            _touch(_heartbeat_file(queue, job['id']))
+
+    beater = threading.Thread(target=beat)
+    beater.daemon = True
+    beater.start()
+    try:
+        with open(log_file, 'w') as log:
+            return subprocess.call([sys.executable, os.path.abspath(os.path.join(job['workdir'], job['script']))],
+                                   cwd=job['workdir'], env=env, stdout=log, stderr=subprocess.STDOUT)
+    finally:
+        stop.set()
+        beater.join()
+
+# worker claims and runs jobs until the queue is drained
+# INPUT: queue: queue directory (string)
+#        heartbeat: interval (s) of touching the heartbeat file of a running job
+#        timeout: age of the heartbeat (s) after which a job is considered lost
+#        poll: interval (s) of checking the queue while other workers run jobs
+#        num_workers, worker_index: number of workers on the node and index of
+#                                   this worker, whose jobs run on its share of
+#                                   the cores
+def worker(queue, heartbeat=30.0, timeout=300.0, poll=10.0, num_workers=1, worker_index=None):
+    name = '%s:%d' % (socket.gethostname(), os.getpid())
+    threads = thread_env(num_workers, worker_index) if num_workers > 1 else None
+    while True:
+        reap(queue, timeout)
+        job = claim(queue, name)
+        if job is None:
+            # Nothing is left to run (pending jobs waiting for failed jobs are
+            # never ready)
+            if not _list_jobs(queue, 'running'):
+                if _list_jobs(queue, 'pending'):
+                    print('[%s] pending jobs wait for failed jobs' % name)
+                return
+            time.sleep(poll)
+            continue
+        print('[%s] running %s (attempt %d)' % (name, job['id'], job['attempts']))
+        start = time.time()
+        returncode = run_job(queue, job, heartbeat, threads)
+        record = {'worker': name, 'returncode': returncode, 'time': time.time(),
+                  'duration': time.time() - start}
+        if returncode == 0:
+            record['result'] = 'done'
+            _finish(queue, job, 'done', record)
+        else:
+            record['result'] = 'error'
+            _finish(queue, job, 'pending' if job['attempts'] <= job['retries'] else 'failed', record)
+        print('[%s] %s: %s (%.0f s)' % (name, job['id'], record['result'], record['duration']))
+
+# local runs a number of worker processes on this node (stand-in for the
+# workers of a cluster)
+def local(queue, num_workers, **kwargs):
+    processes = [multiprocessing.Process(target=worker, args=(queue,),
+                                         kwargs=dict(kwargs, num_workers=num_workers, worker_index=k))
+                 for k in range(num_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+# status returns the number of jobs in each state of the queue
+def status(queue):
+    return dict((state, len(_list_jobs(queue, state))) for state in STATES)
+
+def _load_grid(grid_file):
+    if grid_file is None:
+        return DEFAULT_GRID
+    with open(grid_file, 'r') as f:
+        return json.load(f)
+
+# %% ####################### Running the scheduler ############################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='File-queue scheduler of the experiment conditions.')
+    parser.add_argument('command', choices=['submit', 'worker', 'local', 'status'])
+    parser.add_argument('queue', help='queue directory (on a filesystem shared by the nodes)')
+    parser.add_argument('grid', nargs='?', default=None, help='grid file (JSON, default: all conditions)')
+    parser.add_argument('--workdir', default=os.getcwd(), help='directory the scripts are run in')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes (local mode)')
+    parser.add_argument('--heartbeat', type=float, default=30.0, help='heartbeat interval (s)')
+    parser.add_argument('--timeout', type=float, default=300.0, help='heartbeat timeout (s)')
+    parser.add_argument('--poll', type=float, default=10.0, help='polling interval (s)')
+    args = parser.parse_args()
+
+    timing = {'heartbeat': args.heartbeat, 'timeout': args.timeout, 'poll': args.poll}
+    if args.command in ('submit', 'local'):
+        jobs = expand_grid(_load_grid(args.grid), os.path.abspath(args.workdir))
+        print('%d of %d jobs submitted to %s' % (submit(args.queue, jobs), len(jobs), args.queue))
+    if args.command == 'worker':
+        worker(args.queue, **timing)
+    elif args.command == 'local':
+        local(args.queue, args.workers, **timing)
+    if args.command in ('status', 'worker', 'local'):
+        counts = status(args.queue)
+        print(', '.join('%s: %d' % (state, counts[state]) for state in STATES))
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+This module sets up the TensorFlow sessions the scripts train the network in.
+The training graph is small and of fixed shape (batches of 4 connectivity
+matrices), thus the time of a training step is dominated by the overhead of
+dispatching its many small ops rather than by the arithmetic. With the setting
+'xla' (CCNN_XLA=true, see 'ccnn_options.py') the graph is JIT-compiled by XLA,
+fusing the forward pass, the backward pass and the Adam update into a few
+compiled kernels. On CPU, XLA compiles the graph only if the flag
+'--tf_xla_cpu_global_jit' is in TF_XLA_FLAGS, which is added to the environment
+when this module is imported (before the scripts import TensorFlow).
+
+The threads of TensorFlow (intra_op/inter_op parallelism) and of the BLAS
+library of NumPy are set from the configuration tuned for this machine (stored
+in 'ccnn_threads.json', or in the file given by the setting 'threads_file'),
+or, if it has not been tuned, to the cores available to the process. Workers
+running concurrently on a node (the local workers of 'ccnn_scheduler.py', or the
+concurrent stages of 'ccnn_pipeline.py') split the cores: each gets
+cores / CCNN_WORKERS of them and, given CCNN_WORKER_INDEX, is pinned to its own
+cores. The BLAS threads are set through the environment when apply_threads is
+called, thus the entry points call it before importing NumPy.
+
+Running this module as a script benchmarks the training step of the conditions
+(the graph of each script, on synthetic data) with and without XLA, and checks
+that the compiled graph computes the same losses as the uncompiled one (from
+the same initial weights on the same batches, without dropout, whose random
+numbers differ between the two):
+
+    python ccnn_session.py [--conditions ccnn_regr_transfer ...] [--rois 111] [--steps 200] [--check-steps 50]
+
+With --tune-threads, the thread configurations are benchmarked instead (each
+in a new process, as TensorFlow and BLAS set up their threads once per process;
+the training step of a condition for intra_op/inter_op, the NumPy forward pass
+for BLAS), for the cores of one of the given number of concurrent workers, and
+the fastest configuration is stored:
+
+    python ccnn_session.py --tune-threads [--workers 4] [--conditions ccnn_class_CONVinitFULLtrain_FULLinit]
+"""
+# Importing necessary libraries
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from ccnn_options import ENV_PREFIX, option, option_env
+
+XLA_CPU_FLAG = '--tf_xla_cpu_global_jit'
+THREADS_FILE = 'ccnn_threads.json'
+# Environment variables setting the threads of the BLAS libraries of NumPy
+BLAS_ENV = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+# Task and trainable layers of the graph of each script ('dense': the weights
+# of the convolutional layers are constants)
+CONDITIONS = {'ccnn_class_publictrain': ('class', 'all'),
+              'ccnn_class_inhousetrain': ('class', 'all'),
+              'ccnn_class_CONVtrainFULLtrain': ('class', 'all'),
+              'ccnn_class_CONVinitFULLtrain_FULLinit': ('class', 'all'),
+              'ccnn_class_CONVconstFULLtrain_FULLinit': ('class', 'dense'),
+              'ccnn_regr_public': ('regr', 'dense'),
+              'ccnn_regr_baseline': ('regr', 'all'),
+              'ccnn_regr_transfer': ('regr', 'dense')}
+
+# %% ####################### Function definitions #############################
+
+# enable_xla_cpu lets XLA compile graphs placed on the CPU
+def enable_xla_cpu():
+    flags = os.environ.get('TF_XLA_FLAGS', '')
+    if XLA_CPU_FLAG not in flags.split():
+        os.environ['TF_XLA_FLAGS'] = (flags + ' ' + XLA_CPU_FLAG).strip()
+
+if option('xla', False):
+    enable_xla_cpu()
+
+def _affinity():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+# worker_cores returns the cores of this process: its share of the cores of
+# the node if several workers run concurrently (settings 'workers' and
+# 'worker_index')
+# OUTPUT: list of core numbers
+def worker_cores(num_workers=None, worker_index=None):
+    cores = _affinity()
+    num_workers = max(1, int(option('workers', 1) if num_workers is None else num_workers))
+    if worker_index is None:
+        worker_index = option('worker_index', None)
+    share = max(1, len(cores) // num_workers)
+    if worker_index is None or num_workers == 1:
+        return cores[:share] if num_workers > 1 else cores
+    first = (int(worker_index) * share) % len(cores)
+    return cores[first:(first + share)]
+
+def _threads_key(num_cores):
+    return '%s/%d' % (socket.gethostname(), num_cores)
+
+def _read_threads(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# thread_settings returns the thread configuration for a number of cores: the
+# tuned one if the machine has been tuned for it, otherwise every core is used
+# by the operations of TensorFlow and by BLAS
+# OUTPUT: dictionary of 'intra_op', 'inter_op' and 'blas' (numbers of threads)
+def thread_settings(num_cores=None):
+    if num_cores is None:
+        num_cores = len(worker_cores())
+    tuned = _read_threads(option('threads_file', THREADS_FILE)).get(_threads_key(num_cores))
+    if tuned is not None:
+        return dict((key, tuned[key]) for key in ('intra_op', 'inter_op', 'blas'))
+    return {'intra_op': num_cores, 'inter_op': 1, 'blas': num_cores}
+
+# apply_threads pins this process to its cores (if it is one of several
+# workers) and sets the BLAS threads, unless they are set in the environment;
+# it has to be called before NumPy is imported
+def apply_threads():
+    cores = worker_cores()
+    if option('worker_index', None) is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    blas = str(thread_settings(len(cores))['blas'])
+    for name in BLAS_ENV:
+        os.environ.setdefault(name, blas)
+
+# thread_env returns the environment of a worker running concurrently with
+# others (see ccnn_scheduler.py and ccnn_pipeline.py)
+# INPUT: num_workers: number of concurrent workers on the node
+#        worker_index: index of the worker (None = not pinned to cores)
+# OUTPUT: dictionary of environment variables
+def thread_env(num_workers, worker_index=None):
+    env = option_env({'workers': num_workers})
+    if worker_index is not None:
+        env[ENV_PREFIX + 'WORKER_INDEX'] = str(worker_index)
+    blas = str(thread_settings(len(worker_cores(num_workers, worker_index)))['blas'])
+    env.update((name, os.environ.get(name, blas)) for name in BLAS_ENV)
+    return env
+
+# session_config returns the configuration of the sessions of the scripts
+# INPUT: xla: JIT-compile the graph with XLA (default: the setting 'xla')
+#        threads: dictionary of numbers of threads (default: see
+#                 thread_settings)
+# OUTPUT: tf.ConfigProto
+def session_config(xla=None, threads=None):
+    import tensorflow as tf
+    if xla is None:
+        xla = bool(option('xla', False))
+    if threads is None:
+        threads = thread_settings()
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads['intra_op'],
+                            inter_op_parallelism_threads=threads['inter_op'])
+    if xla:
+        enable_xla_cpu()
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+# benchmark_step trains the network of a condition on synthetic batches
+# INPUT: task: 'class' (cross-entropy) or 'regr' (mean squared error)
+#        train_layers: 'all', or 'dense' if the convolutional layers are constant
+#        xla: JIT-compile the graph with XLA
+#        num_roi: number of ROIs of the atlas
+#        num_steps: number of training steps
+#        keep_pr: the probability that each element is kept during dropout
+#        warmup: number of steps run before the timing (compilation)
+#        seed: seed of the initial weights and of the batches
+#        batch_size: number of instances in a training batch
+# OUTPUT: losses: loss of each training step (np.array)
+#         seconds per step
+def benchmark_step(task, train_layers, xla, num_roi=111, num_steps=200, keep_pr=0.6,
+                   warmup=20, seed=0, batch_size=4, threads=None):
+    import numpy as np
+    import tensorflow as tf
+    from ccnn_model import layer_shapes, model
+
+    num_labels = 2 if task == 'class' else 1
+    rng = np.random.RandomState(seed)
+    initial = dict((name, (np.sqrt(2.0 / np.prod(shape[:-1])) * rng.randn(*shape) if '_weights' in name
+                           else np.full(shape, 0.01)).astype(np.float32))
+                   for name, shape in layer_shapes(num_roi, num_labels).items())
+    batches = [(rng.randn(batch_size, num_roi, num_roi, 1).astype(np.float32),
+                np.eye(num_labels, dtype=np.float32)[rng.randint(0, num_labels, batch_size)]
+                if task == 'class' else rng.uniform(20, 80, (batch_size, 1)).astype(np.float32))
+               for _ in range(16)]
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.set_random_seed(seed)
+        tf_train_dataset = tf.placeholder(tf.float32, shape=(batch_size, num_roi, num_roi, 1))
+        tf_train_labels = tf.placeholder(tf.float32, shape=(batch_size, num_labels))
+        weights = dict((name, tf.constant(value) if train_layers == 'dense' and name.startswith(('layer1', 'layer2'))
+                        else tf.Variable(value, name=name)) for name, value in initial.items())
+        logits = model(tf_train_dataset, weights, keep_pr)
+        if task == 'class':
+            loss = tf.reduce_mean(
+                    tf.nn.softmax_cross_entropy_with_logits(labels=tf_train_labels, logits=logits))
+            learning_rate = 0.001
+        else:
+            loss = tf.losses.mean_squared_error(labels=tf_train_labels, predictions=logits)
+            learning_rate = 0.0005
+        optimizer = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+
+    losses = np.zeros(num_steps)
+    with tf.Session(graph=graph, config=session_config(xla, threads)) as session:
+        tf.global_variables_initializer().run()
+        feed = lambda step: {tf_train_dataset: batches[step % len(batches)][0],
+                             tf_train_labels: batches[step % len(batches)][1]}
+        # The warmup steps run on a copy of the initial state, so that both
+        # graphs are trained from the same weights
+        saved = session.run(tf.global_variables())
+        for step in range(warmup):
+            session.run(optimizer, feed_dict=feed(step))
+        for variable, value in zip(tf.global_variables(), saved):
+            variable.load(value, session)
+        start = time.time()
+        for step in range(num_steps):
+            _, losses[step] = session.run([optimizer, loss], feed_dict=feed(step))
+        return losses, (time.time() - start) / num_steps
+
+# compare_xla benchmarks a condition with and without XLA and compares the
+# losses of the two graphs
+# OUTPUT: dictionary of steps per second, speedup and the maximal relative
+#         difference of the losses
+def compare_xla(task, train_layers, num_roi=111, num_steps=200, check_steps=50):
+    import numpy as np
+    _, plain_time = benchmark_step(task, train_layers, False, num_roi, num_steps)
+    _, xla_time = benchmark_step(task, train_layers, True, num_roi, num_steps)
+    plain_losses, _ = benchmark_step(task, train_layers, False, num_roi, check_steps, keep_pr=1.0)
+    xla_losses, _ = benchmark_step(task, train_layers, True, num_roi, check_steps, keep_pr=1.0)
+    difference = np.max(np.abs(xla_losses - plain_losses) / np.maximum(np.abs(plain_losses), 1e-8))
+    return {'steps_per_second': 1.0 / plain_time, 'xla_steps_per_second': 1.0 / xla_time,
+            'speedup': plain_time / xla_time, 'max_loss_difference': difference}
+
+# benchmark_inference times the NumPy forward pass (see ccnn_inference.py) on
+# synthetic data
+# OUTPUT: instances per second
+def benchmark_inference(num_roi=111, num_instances=256, repeats=5, num_labels=2):
+    import numpy as np
+    from ccnn_inference import predict
+    from ccnn_model import layer_shapes
+    rng = np.random.RandomState(0)
+    weights = dict((name, rng.randn(*shape).astype(np.float32) * 0.05)
+                   for name, shape in layer_shapes(num_roi, num_labels).items())
+    data = rng.randn(num_instances, num_roi, num_roi, 1).astype(np.float32)
+    predict(data, weights)
+    start = time.time()
+    for _ in range(repeats):
+        predict(data, weights)
+    return num_instances * repeats / (time.time() - start)
+
+# _measure runs a benchmark of tune_threads in a new process, pinned to the
+# cores of the first of the given number of workers, with the given threads
+def _measure(kind, num_workers, threads, condition, num_roi, num_steps):
+    env = dict(os.environ)
+    env.update(thread_env(num_workers, 0))
+    env.update((name, str(threads['blas'])) for name in BLAS_ENV)
+    output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--measure', kind, json.dumps(threads),
+             '--conditions', condition, '--rois', str(num_roi), '--steps', str(num_steps)],
+            env=env, universal_newlines=True)
+    return float(output.strip().splitlines()[-1])
+
+def _thread_counts(num_cores):
+    counts = [1]
+    while counts[-1] * 2 < num_cores:
+        counts.append(counts[-1] * 2)
+    return sorted(set(counts + [num_cores]))
+
+# tune_threads benchmarks the thread configurations for the cores of one of a
+# number of concurrent workers, and stores the fastest one
+# INPUT: num_workers: number of workers running concurrently on the node
+#        condition: script whose training step is benchmarked
+#        num_roi: number of ROIs of the atlas
+#        num_steps: number of timed training steps
+#        path: file the configuration is stored in
+# OUTPUT: the stored configuration (dictionary)
+def tune_threads(num_workers=1, condition='ccnn_class_CONVinitFULLtrain_FULLinit', num_roi=111,
+                 num_steps=200, path=None):
+    cores = worker_cores(num_workers, 0)
+    counts = _thread_counts(len(cores))
+    results = {}
+    for intra_op in counts:
+        for inter_op in sorted(set([1, 2, min(4, len(cores))])):
+            threads = {'intra_op': intra_op, 'inter_op': inter_op, 'blas': 1}
+            results[(intra_op, inter_op)] = _measure('step', num_workers, threads, condition, num_roi, num_steps)
+            print('intra_op %2d, inter_op %d: %8.1f steps/s' % (intra_op, inter_op, results[(intra_op, inter_op)]))
+    intra_op, inter_op = max(results, key=results.get)
+    blas_results = {}
+    for blas in counts:
+        threads = {'intra_op': intra_op, 'inter_op': inter_op, 'blas': blas}
+        blas_results[blas] = _measure('inference', num_workers, threads, condition, num_roi, num_steps)
+        print('BLAS %2d threads: %8.1f instances/s' % (blas, blas_results[blas]))
+    blas = max(blas_results, key=blas_results.get)
+    tuned = {'intra_op': intra_op, 'inter_op': inter_op, 'blas': blas, 'workers': num_workers,
+             'steps_per_second': results[(intra_op, inter_op)],
+             'default_steps_per_second': results.get((len(cores), 1)),
+             'instances_per_second': blas_results[blas], 'condition': condition,
+             'tuned': time.strftime('%Y-%m-%d %H:%M:%S')}
+    path = path or option('threads_file', THREADS_FILE)
+    stored = _read_threads(path)
+    stored[_threads_key(len(cores))] = tuned
+    with open(path + '.tmp', 'w') as f:
+        json.dump(stored, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return tuned
+
+# %% ######################## Benchmarking XLA ################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Training step with and without XLA.')
+    parser.add_argument('--conditions', nargs='+', default=sorted(CONDITIONS), choices=sorted(CONDITIONS))
+    parser.add_argument('--rois', type=int, default=111)
+    parser.add_argument('--steps', type=int, default=200, help='timed training steps')
+    parser.add_argument('--check-steps', type=int, default=50, help='training steps of the equivalence check')
+    parser.add_argument('--rtol', type=float, default=1e-3, help='tolerated relative difference of the losses')
+    parser.add_argument('--tune-threads', action='store_true', help='tune the thread configuration instead')
+    parser.add_argument('--workers', type=int, default=1, help='concurrent workers on the node (--tune-threads)')
+    parser.add_argument('--measure', nargs=2, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        # A single benchmark of tune_threads (run in a new process)
+        apply_threads()
+        threads = json.loads(args.measure[1])
+        if args.measure[0] == 'inference':
+            print(benchmark_inference(args.rois))
+        else:
+            task, train_layers = CONDITIONS[args.conditions[0]]
+            _, seconds = benchmark_step(task, train_layers, False, args.rois, args.steps, threads=threads)
+            print(1.0 / seconds)
+        sys.exit(0)
+    if args.tune_threads:
+        condition = args.conditions[0] if len(args.conditions) == 1 else 'ccnn_class_CONVinitFULLtrain_FULLinit'
+        tuned = tune_threads(args.workers, condition, args.rois, args.steps)
+        print('intra_op %d, inter_op %d, BLAS %d threads for %d workers: %.1f steps/s (%s steps/s with every '
+              'core), %.1f instances/s' % (tuned['intra_op'], tuned['inter_op'], tuned['blas'], args.workers,
+                                           tuned['steps_per_second'], tuned['default_steps_per_second'],
+                                           tuned['instances_per_second']))
+        sys.exit(0)
+
+    enable_xla_cpu()
+    results = {}
+    print('%-42s %10s %10s %8s %12s' % ('condition', 'steps/s', 'XLA', 'speedup', 'loss diff'))
+    for condition in args.conditions:
+        # Scripts with the same graph are benchmarked once
+        if CONDITIONS[condition] not in results:
+            results[CONDITIONS[condition]] = compare_xla(CONDITIONS[condition][0], CONDITIONS[condition][1],
+                                                         args.rois, args.steps, args.check_steps)
+        result = results[CONDITIONS[condition]]
+        print('%-42s %10.1f %10.1f %8.2f %12.2e%s' % (
+            condition, result['steps_per_second'], result['xla_steps_per_second'], result['speedup'],
+            result['max_loss_difference'], '' if result['max_loss_difference'] <= args.rtol else '  MISMATCH'))
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+This script estimates the memory footprint and the running time of the
+connectome-convolutional neural network for atlases of different size (number
+of ROIs), and optionally benchmarks a training step (TensorFlow) and inference
+(NumPy, see 'ccnn_inference.py') on synthetic data. The number of parameters of
+the second (column convolution) layer, the size of the connectivity data and the
+cost of the first two layers grow quadratically with the number of ROIs, so the
+table printed by this script tells which atlas sizes are feasible on a node
+with the given amount of memory. Usage:
+
+    python ccnn_sizing.py [--rois 111 200 400] [--num-instances 600] [--memory-gb 16] [--rank 32] [--benchmark]
+"""
+# Importing necessary libraries
+import argparse
+import time
+
+import numpy as np
+from ccnn_model import layer_shapes
+
+MB = 1024.0**2
+GB = 1024.0**3
+
+# %% ####################### Function definitions #############################
+
+# estimate computes the memory and compute requirements of a cross-validation
+# script for a given configuration
+# INPUT: num_roi: number of ROIs of the atlas
+#        num_instances: number of connectivity matrices in the dataset
+#        num_folds: number of folds in the cross-validation
+#        batch_size: number of instances in a training batch
+#        num_labels: number of output units
+#        layer2_rank: rank of the factorized column convolution (None: full)
+# OUTPUT: dictionary of estimates (bytes, FLOPs)
+def estimate(num_roi, num_instances, num_folds=10, batch_size=4, num_labels=2, layer2_rank=None):
+    shapes = layer_shapes(num_roi, num_labels, layer2_rank=layer2_rank)
+    params = dict((name, int(np.prod(shape))) for name, shape in shapes.items())
+    num_params = sum(params.values())
+    num_test = int(np.ceil(float(num_instances) / num_folds))
+    matrix_bytes = 4 * num_roi * num_roi
+
+    # Forward pass FLOPs of one instance (multiply-adds count as 2 FLOPs)
+    if layer2_rank is None:
+        layer2_flops = num_roi * 64 * 256
+    else:
+        layer2_flops = num_roi * 64 * layer2_rank + layer2_rank * 256
+    forward = 2 * (num_roi * num_roi * 64 + layer2_flops + 256 * 96 + 96 * num_labels)
+    est = {'num_params': num_params,
+           'layer2_bytes': 4 * sum(size for name, size in params.items()
+                                   if name.startswith('layer2_weights')),
+           # parameters, gradients and the two Adam slots
+           'train_state_bytes': 4 * 4 * num_params,
+           'data_bytes': num_instances * matrix_bytes,
+           # normalized train and test copies, created in each fold
+           'fold_copy_bytes': 2 * num_instances * matrix_bytes,
+           # test set held as a tf.constant (graph definition + runtime tensor)
+           'test_constant_bytes': 2 * num_test * matrix_bytes,
+           # activations of the first layer for the whole test set
+           'activation_bytes': 4 * num_test * num_roi * 64 * 2 + 4 * batch_size * num_roi * 64 * 3,
+           'archive_bytes_per_fold': 4 * num_params,
+           'forward_flops': forward,
+           # backward pass costs roughly twice the forward pass
+           'train_step_flops': 3 * batch_size * forward}
+    est['peak_bytes'] = (est['data_bytes'] + est['fold_copy_bytes'] + est['test_constant_bytes']
+                         + est['train_state_bytes'] + est['activation_bytes'])
+    return est
+
+# benchmark_training measures the time of a training step (forward pass,
+# backward pass and Adam update) on synthetic data
+# OUTPUT: seconds per step
+def benchmark_training(num_roi, batch_size=4, num_labels=2, num_steps=200, warmup=20,
+                       layer2_rank=None):
+    import tensorflow as tf
+    from ccnn_model import model, xavier_weights
+    from ccnn_session import session_config
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf_train_dataset = tf.placeholder(tf.float32, shape=(batch_size, num_roi, num_roi, 1))
+        tf_train_labels = tf.placeholder(tf.float32, shape=(batch_size, num_labels))
+        weights = xavier_weights(num_roi, num_labels, layer2_rank=layer2_rank)
+        logits = model(tf_train_dataset, weights, 0.6)
+        loss = tf.reduce_mean(
+                tf.nn.softmax_cross_entropy_with_logits(labels=tf_train_labels, logits=logits))
+        optimizer = tf.train.AdamOptimizer(0.001).minimize(loss)
+
+    rng = np.random.RandomState(0)
+    feed_dict = {tf_train_dataset: rng.randn(batch_size, num_roi, num_roi, 1).astype(np.float32),
+                 tf_train_labels: np.eye(num_labels)[rng.randint(0, num_labels, batch_size)]}
+    with tf.Session(graph=graph, config=session_config()) as session:
+        tf.global_variables_initializer().run()
+        for step in range(warmup):
+            session.run(optimizer, feed_dict=feed_dict)
+        start = time.time()
+        for step in range(num_steps):
+            session.run([optimizer, loss], feed_dict=feed_dict)
+        return (time.time() - start) / num_steps
+
+# benchmark_inference measures the throughput of the NumPy forward pass
+# OUTPUT: instances per second
+def benchmark_inference(num_roi, num_instances=64, num_labels=2, repeats=5, layer2_rank=None):
+    from ccnn_inference import predict
+    rng = np.random.RandomState(0)
+    weights = dict((name, 0.01*rng.randn(*shape).astype(np.float32))
+                   for name, shape in layer_shapes(num_roi, num_labels, layer2_rank=layer2_rank).items())
+    data = rng.randn(num_instances, num_roi, num_roi, 1).astype(np.float32)
+    predict(data, weights)
+    start = time.time()
+    for _ in range(repeats):
+        predict(data, weights)
+    return repeats * num_instances / (time.time() - start)
+
+# %% ####################### Printing the estimates ###########################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory and time estimates of the CCNN per atlas size.')
+    parser.add_argument('--rois', type=int, nargs='+', default=[111, 200, 400])
+    parser.add_argument('--num-instances', type=int, default=600, help='connectivity matrices in the dataset')
+    parser.add_argument('--num-folds', type=int, default=10)
+    parser.add_argument('--num-steps', type=int, default=5001, help='training steps per fold')
+    parser.add_argument('--memory-gb', type=float, default=16.0, help='memory available on a node')
+    parser.add_argument('--gflops', type=float, default=20.0,
+                        help='assumed sustained GFLOP/s for estimates without --benchmark')
+    parser.add_argument('--rank', type=int, default=None,
+                        help='rank of the factorized column convolution (default: full layer)')
+    parser.add_argument('--benchmark', action='store_true', help='time training steps and inference')
+    args = parser.parse_args()
+
+    print('%6s %9s %9s %10s %9s %9s %10s %10s %9s' % (
+        'ROIs', 'params', 'layer2', 'archive/f', 'peak', 'step', 'CV run', 'infer', 'feasible'))
+    print('%6s %9s %9s %10s %9s %9s %10s %10s %9s' % (
+        '', '(M)', '(MB)', '(MB)', '(GB)', '(ms)', '(h)', '(inst/s)', ''))
+    for num_roi in args.rois:
+        est = estimate(num_roi, args.num_instances, args.num_folds, layer2_rank=args.rank)
+        if args.benchmark:
+            step_time = benchmark_training(num_roi, layer2_rank=args.rank)
+            throughput = '%10.0f' % benchmark_inference(num_roi, layer2_rank=args.rank)
+        else:
+            step_time = est['train_step_flops'] / (args.gflops * 1e9)
+            throughput = '%10s' % '-'
+        run_hours = args.num_folds * args.num_steps * step_time / 3600.0
+        print('%6d %9.2f %9.1f %10.1f %9.2f %9.2f %10.2f %s %9s' % (
+            num_roi, est['num_params'] / 1e6, est['layer2_bytes'] / MB,
+            est['archive_bytes_per_fold'] / MB, est['peak_bytes'] / GB, 1000 * step_time,
+            run_hours, throughput, 'yes' if est['peak_bytes'] <= args.memory_gb * GB else 'NO'))
+    if not args.benchmark:
+        print('\nStep times are estimated from FLOPs at %.0f GFLOP/s; use --benchmark to measure them.'
+              % args.gflops)
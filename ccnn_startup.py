@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+This script measures the startup time of the entry points that do not train a
+network, i.e. the conversion of weights ('ccnn_weights.py'), inference in NumPy
+('ccnn_inference.py') and the statistics scripts ('ccnn_stat_compare_*.py'),
+and compares it with the time budget set in 'startup_budget' below. Each entry
+point is run repeatedly in a fresh Python process on a small synthetic workload
+generated in a temporary directory. The script also reports whether any of
+these entry points imported TensorFlow or SciPy, which would blow the budget on
+our nodes, and exits with a non-zero status if a budget was exceeded.
+"""
+# %% ####################### Time budget (seconds) ############################
+startup_budget = {'convert': 1.5,
+                  'infer': 1.5,
+                  'stats_class': 1.5,
+                  'stats_regr': 1.5}
+num_repeats = 5   # the median of this many runs is compared with the budget
+
+# %% ####################### Importing necessary libraries #####################
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from six.moves import cPickle as pickle
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Runs an entry point as __main__ and reports the heavy modules it imported
+runner = ("import runpy, sys\n"
+          "sys.argv = sys.argv[1:]\n"
+          "try:\n"
+          "    runpy.run_path(sys.argv[0], run_name='__main__')\n"
+          "finally:\n"
+          "    print('heavy modules: ' + ','.join(m for m in ('tensorflow', 'scipy') if m in sys.modules))\n")
+
+# %% ####################### Function definitions #############################
+
+# create_workload writes synthetic weights, connectivity matrices and results
+# files into work_dir
+def create_workload(work_dir, num_roi=16, num_instances=40, num_folds=10):
+    rng = np.random.RandomState(0)
+    shapes = {'layer1_weights': [1, num_roi, 1, 64], 'layer1_biases': [64],
+              'layer2_weights': [num_roi, 1, 64, 256], 'layer2_biases': [256],
+              'layer3_weights': [256, 96], 'layer3_biases': [96],
+              'layer4_weights': [96, 2], 'layer4_biases': [2]}
+    save = dict((name, 0.1*rng.randn(*shape).astype(np.float32)) for name, shape in shapes.items())
+    with open(os.path.join(work_dir, 'weights_synthetic.pickle'), 'wb') as f:
+        pickle.dump(save, f, pickle.HIGHEST_PROTOCOL)
+    data_tensor = rng.randn(num_instances, num_roi, num_roi, 1).astype(np.float32)
+    with open(os.path.join(work_dir, 'CORR_tensor_synthetic.pickle'), 'wb') as f:
+        pickle.dump({'data_tensor': data_tensor}, f, pickle.HIGHEST_PROTOCOL)
+
+    splits = np.arange(1, num_instances+1).reshape((-1, num_folds))
+    labels = (np.arange(2) == rng.randint(0, 2, num_instances)[:, None]).astype(np.float32)
+    ages = 20 + 50*rng.rand(num_instances, 1)
+    for k in (1, 2):
+        np.savez(os.path.join(work_dir, 'results_class_%d.npz' % k), labels=labels,
+                 predictions=rng.rand(num_instances, 2), splits=splits)
+        np.savez(os.path.join(work_dir, 'results_regr_%d.npz' % k), labels=ages,
+                 predictions=ages + 5*rng.randn(num_instances, 1), splits=splits)
+
+# time_command runs an entry point num_repeats times and returns the median
+# wall-clock time and the heavy modules imported by the entry point
+def time_command(args, work_dir):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = repo_dir + os.pathsep + env.get('PYTHONPATH', '')
+    times = []
+    heavy = ''
+    for _ in range(num_repeats):
+        start = time.time()
+        output = subprocess.check_output([sys.executable, '-c', runner] + args,
+                                         cwd=work_dir, env=env, universal_newlines=True)
+        times.append(time.time() - start)
+        heavy = output.strip().splitlines()[-1][len('heavy modules: '):]
+    return np.median(times), heavy
+
+# %% ####################### Measuring startup times ##########################
+
+if __name__ == '__main__':
+    commands = {
+        'convert': [os.path.join(repo_dir, 'ccnn_weights.py'), 'weights_synthetic.pickle'],
+        'infer': [os.path.join(repo_dir, 'ccnn_inference.py'), 'weights_synthetic',
+                  'CORR_tensor_synthetic.pickle', 'predictions_synthetic.npz'],
+        'stats_class': [os.path.join(repo_dir, 'ccnn_stat_compare_class_binom.py'),
+                        'results_class_1.npz', 'results_class_2.npz'],
+        'stats_regr': [os.path.join(repo_dir, 'ccnn_stat_compare_regression_ttest.py'),
+                       'results_regr_1.npz', 'results_regr_2.npz'],
+        }
+
+    work_dir = tempfile.mkdtemp(prefix='ccnn_startup_')
+    exceeded = False
+    try:
+        create_workload(work_dir)
+        for name in ['convert', 'infer', 'stats_class', 'stats_regr']:
+            seconds, heavy = time_command(commands[name], work_dir)
+            within = seconds <= startup_budget[name]
+            exceeded = exceeded or not within
+            print('%-12s %6.3f s (budget %.1f s) %s%s' % (
+                name, seconds, startup_budget[name], 'OK' if within else 'EXCEEDED',
+                ', imports ' + heavy if heavy else ''))
+    finally:
+        shutil.rmtree(work_dir)
+    sys.exit(1 if exceeded else 0)
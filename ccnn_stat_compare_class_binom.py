@@ -21,11 +21,22 @@ class_1 = 'results_ccnn_class_CONVinitFULLtrain_inhouse.npz'
 class_2 = 'results_ccnn_class_CONVtrainFULLtrain_inhouse.npz'
 
 ###################### Importing necessary libraries ##########################
+import sys
+from math import factorial
+
 import numpy as np
-from scipy.special import comb
+
+# The file names can also be given on the command line
+if len(sys.argv) == 3:
+    class_1, class_2 = sys.argv[1], sys.argv[2]
 
 ########################### Function definition ###############################
 
+# comb computes the number of combinations of n things taken k at a time 
+# exactly (as an integer)
+def comb(n, k):
+    return factorial(n) // (factorial(k) * factorial(n - k))
+
 # accuracy calculates classification accuracy from one-hot encoded labels and 
 # predictions
 # INPUT: predictions: 2D tensor (np.array), storing predicted labels 
@@ -138,6 +149,6 @@ prob = 0
 for s in range(first_better, diff+1):
     prob += comb(diff, s)
 
-prob = prob*0.5**diff
+prob = prob / 2**diff
 
 print('p = '+'{:f}'.format(prob))
\ No newline at end of file
@@ -21,11 +21,63 @@ regr_1 = 'results_ccnn_regr_baseline_inhouse.npz'
 regr_2 = 'results_ccnn_regr_transfer_inhouse.npz'
 
 ###################### Importing necessary libraries ##########################
+import sys
+from math import exp, lgamma, log
+
 import numpy as np
-from scipy.stats import ttest_rel
-from scipy.stats import pearsonr
+
+# The file names can also be given on the command line
+if len(sys.argv) == 3:
+    regr_1, regr_2 = sys.argv[1], sys.argv[2]
 
 ########################### Function definition ###############################
+# betainc computes the regularized incomplete beta function I_x(a, b) using its 
+# continued fraction representation (Press et al., Numerical Recipes, 6.4)
+def betainc(a, b, x):
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    front = exp(lgamma(a+b) - lgamma(a) - lgamma(b) + a*log(x) + b*log(1.0-x))
+    if x < (a+1.0)/(a+b+2.0):
+        return front*betacf(a, b, x)/a
+    return 1.0 - front*betacf(b, a, 1.0-x)/b
+
+# betacf evaluates the continued fraction for betainc by the modified Lentz's
+# method
+def betacf(a, b, x, max_iter=300, eps=1e-15):
+    tiny = 1e-300
+    c = 1.0
+    d = 1.0 - (a+b)*x/(a+1.0)
+    d = 1.0/(d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, max_iter+1):
+        for aa in (m*(b-m)*x/((a+2*m-1.0)*(a+2*m)), 
+                   -(a+m)*(a+b+m)*x/((a+2*m)*(a+2*m+1.0))):
+            d = 1.0 + aa*d
+            d = 1.0/(d if abs(d) > tiny else tiny)
+            c = 1.0 + aa/c
+            c = c if abs(c) > tiny else tiny
+            h *= d*c
+        if abs(d*c-1.0) < eps:
+            break
+    return h
+
+# ttest_rel performs a two-sided paired t-test
+# INPUT: a, b: 1D vectors (np.array) of paired samples
+# OUTPUT: t_statistic: t value
+#         p_value: two-sided p value
+def ttest_rel(a, b):
+    d = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+    df = d.size - 1
+    t_statistic = np.mean(d) / np.sqrt(np.var(d, ddof=1) / d.size)
+    p_value = betainc(df/2.0, 0.5, df/(df + t_statistic**2))
+    return t_statistic, p_value
+
+# pearsonr computes Pearson's correlation coefficient
+def pearsonr(x, y):
+    return np.corrcoef(np.ravel(x), np.ravel(y))[0, 1]
+
 # reg_metrics
 # INPUT: labels: 1D vector (np.array) storing actual labels
 #        predictions: 1D vector (np.array) storing predicted labels
@@ -37,7 +89,6 @@ def reg_metrics(labels, predictions):
     
     mae = np.mean(np.abs(labels-predictions))
     r = pearsonr(labels, predictions)
-    r = r[0]
     
     ss_res = np.mean(np.square(labels-predictions))
     ss_tot = np.mean(np.square(labels-np.mean(labels)))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the feedback of the scripts on the progress of
+training. The loss is fetched at every training step anyway (it is computed by
+the forward pass the optimizer needs), so its running mean over the steps since
+the last report is kept at no cost. The predictions on the minibatch, needed
+for the accuracy or R squared of the minibatch, are fetched only at the steps
+reported (every 500. step, as before), so that the other steps run only the
+forward and backward pass of the optimizer.
+
+The interval between reports is set by 'telemetry_interval' (e.g.
+CCNN_TELEMETRY_INTERVAL=100, see 'ccnn_options.py'; 0 switches the reports
+off), and the reports are also appended to the file given by 'telemetry_file'
+(one JSON object per line) if set.
+"""
+# Importing necessary libraries
+import json
+import time
+
+from ccnn_options import option
+
+# %% ####################### Function definitions #############################
+
+class Telemetry(object):
+    """Reports the progress of training at an interval of steps.
+
+    In the training loop, due(step) tells whether the predictions on the
+    minibatch have to be fetched at the given step, add(loss) is called with the
+    loss of every step and report(step, loss, **metrics) prints the feedback at
+    the steps reported.
+    """
+
+    def __init__(self, name, interval=500):
+        self.name = name
+        self.interval = int(option('telemetry_interval', interval))
+        self.log_file = option('telemetry_file', None)
+        self._reset()
+
+    def _reset(self):
+        self.loss_sum = 0.0
+        self.num_steps = 0
+        self.start = time.time()
+
+    # due tells whether the given step is reported
+    def due(self, step):
+        return self.interval > 0 and step % self.interval == 0
+
+    # add adds the loss of a training step to the running mean
+    def add(self, loss):
+        self.loss_sum += float(loss)
+        self.num_steps += 1
+
+    # report prints the loss of the minibatch and the running mean of the loss
+    # since the last report, and logs them with the given metrics of the
+    # minibatch (e.g. accuracy=...)
+    def report(self, step, loss, **metrics):
+        seconds = time.time() - self.start
+        mean_loss = self.loss_sum / max(self.num_steps, 1)
+        print('Minibatch loss at step %d: %f (mean of the last %d steps: %f, %.1f steps/s)'
+              % (step, loss, self.num_steps, mean_loss, self.num_steps / max(seconds, 1e-9)))
+        if self.log_file:
+            entry = {'name': self.name, 'step': step, 'loss': float(loss), 'mean_loss': mean_loss,
+                     'steps': self.num_steps, 'seconds': seconds}
+            entry.update((key, float(value)) for key, value in metrics.items())
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        self._reset()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the tensor store holding the functional connectivity
+matrices of a dataset (e.g. 'CORR_tensor_inhouse'). A store is a directory of
+chunks, each chunk being a float32 .npy file of shape
+[num_instances, numROI, numROI, 1] (the layout of 'data_tensor' in the scripts),
+plus an index ('index.json') listing the chunks and the subject IDs of their
+instances. New subjects are added by appending chunks, so a store can be built
+and extended without holding the full cohort in memory (see
+'ccnn_build_connectivity.py'). NaNs are replaced with 0s when a chunk is
+appended, and the statistics of the chunks (see 'ccnn_preprocess.py') are kept
+in the index, thus the scripts read sanitized data and the normalization
+constants of the dataset without rescanning it.
+
+Datasets stored previously in 'CORR_tensor_*.pickle' files can still be read
+with load_tensor.
+"""
+# Importing necessary libraries
+import json
+import os
+
+import numpy as np
+from six.moves import cPickle as pickle
+from ccnn_preprocess import combine_statistics, normalize_chunk, sanitize_and_normalize, sanitize_chunk
+
+INDEX_FILE = 'index.json'
+STORE_FORMAT = 'ccnn-tensor'
+STORE_VERSION = 1
+
+# %% ####################### Function definitions #############################
+
+# store_path returns the store directory belonging to a dataset name, i.e.
+# strips the '.pickle' extension of the old file names
+def store_path(name):
+    if name.endswith('.pickle'):
+        return name[:-len('.pickle')]
+    return name
+
+def _index_file(path):
+    return os.path.join(path, INDEX_FILE)
+
+# is_store checks whether path is a tensor store directory
+def is_store(path):
+    return os.path.isfile(_index_file(store_path(path)))
+
+# read_index returns the index of a tensor store (a dictionary)
+def read_index(path):
+    with open(_index_file(store_path(path)), 'r') as f:
+        return json.load(f)
+
+# The index is replaced atomically, so that readers never see a chunk that
+# has not been written completely
+def write_index(path, index):
+    tmp_file = _index_file(store_path(path)) + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, _index_file(store_path(path)))
+
+# create_store creates an empty tensor store, removing the chunks of any store
+# previously saved under the same name
+# INPUT: path: store directory (string)
+#        num_roi: number of ROIs, i.e. the size of the connectivity matrices
+def create_store(path, num_roi):
+    path = store_path(path)
+    if is_store(path):
+        for chunk in read_index(path)['chunks']:
+            os.remove(os.path.join(path, chunk['file']))
+    elif not os.path.isdir(path):
+        os.makedirs(path)
+    write_index(path, {'format': STORE_FORMAT, 'version': STORE_VERSION,
+                       'dtype': 'float32', 'num_roi': int(num_roi),
+                       'num_instances': 0, 'chunks': []})
+
+# append_chunk replaces NaNs with 0s in connectivity matrices, appends them to
+# a tensor store and updates the statistics of the dataset
+# INPUT: path: store directory (string)
+#        data: 4D tensor (np.array) [num_instances, numROI, numROI, 1] or 3D
+#              tensor [num_instances, numROI, numROI]
+#        subjects: list of subject IDs of the instances in data
+# OUTPUT: the index entry of the new chunk (dictionary)
+def append_chunk(path, data, subjects):
+    path = store_path(path)
+    data = np.array(data, dtype=np.float32)
+    if data.ndim == 3:
+        data = data[:, :, :, None]
+    index = read_index(path)
+    if data.shape[1:] != (index['num_roi'], index['num_roi'], 1):
+        raise ValueError('cannot append matrices of shape %s to %s (numROI = %d)'
+                         % (data.shape[1:], path, index['num_roi']))
+    if len(subjects) != data.shape[0]:
+        raise ValueError('%d subject IDs given for %d instances' % (len(subjects), data.shape[0]))
+    if any('statistics' not in c for c in index['chunks']):
+        raise ValueError('%s has chunks without statistics, convert it again with ccnn_preprocess.py'
+                         % path)
+    chunk = {'file': 'chunk_%05d.npy' % len(index['chunks']),
+             'num_instances': int(data.shape[0]),
+             'subjects': [float(s) for s in subjects]}
+    chunk['statistics'] = sanitize_chunk(data, subjects)
+    np.save(os.path.join(path, chunk['file']), data)
+    index['chunks'].append(chunk)
+    index['num_instances'] += chunk['num_instances']
+    index['statistics'] = combine_statistics([c['statistics'] for c in index['chunks']])
+    write_index(path, index)
+    return chunk
+
+# store_subjects returns the subject IDs of all instances in a tensor store
+def store_subjects(path):
+    return np.array([s for chunk in read_index(path)['chunks'] for s in chunk['subjects']])
+
+# check_subjects checks that the instances of a dataset are in the order of the
+# subjects of its labels file (the scripts pair the rows of data_tensor and
+# labels_csv by position); old pickle files carry no subject IDs and stores
+# converted from them without a labels file are numbered 0, 1, ..., thus only
+# their number of instances can be checked
+# INPUT: name: store directory or pickle file (string)
+#        subjects: subject IDs in the first column of the labels file
+def check_subjects(name, subjects):
+    path = store_path(name)
+    subjects = np.asarray(subjects, dtype=np.float64)
+    if not is_store(path):
+        return
+    stored = store_subjects(path)
+    if len(stored) != len(subjects):
+        raise ValueError('%s holds %d subjects, the labels file %d' % (path, len(stored), len(subjects)))
+    if np.array_equal(stored, np.arange(len(stored))) or np.array_equal(stored, subjects):
+        return
+    mismatch = np.nonzero(stored != subjects)[0]
+    raise ValueError('the subjects of %s are not in the order of the labels file (%d mismatches, '
+                     'first at row %d: subject %g in the store, %g in the labels file); rebuild the '
+                     'store with --labels (see ccnn_build_connectivity.py)'
+                     % (path, len(mismatch), mismatch[0], stored[mismatch[0]], subjects[mismatch[0]]))
+
+# iter_chunks iterates over the chunks of a tensor store
+# OUTPUT: (index entry, memory-mapped 4D tensor) pairs
+def iter_chunks(path):
+    path = store_path(path)
+    for chunk in read_index(path)['chunks']:
+        yield chunk, np.load(os.path.join(path, chunk['file']), mmap_mode='r')
+
+# load_tensor reads all connectivity matrices of a dataset into memory, from a
+# tensor store or, if there is no store with the given name, from the old
+# 'CORR_tensor_*.pickle' file
+# INPUT: name: store directory or pickle file (string)
+# OUTPUT: data_tensor: 4D tensor (np.array), instances are concatenated along
+#                      the first (0.) dimension
+def load_tensor(name):
+    path = store_path(name)
+    if not is_store(path):
+        with open(path + '.pickle', 'rb') as f:
+            save = pickle.load(f)
+            data_tensor = save['data_tensor']
+            del save
+        return data_tensor
+    index = read_index(path)
+    data_tensor = np.empty((index['num_instances'], index['num_roi'], index['num_roi'], 1),
+                           dtype=np.float32)
+    offset = 0
+    for chunk, data in iter_chunks(path):
+        data_tensor[offset:(offset + chunk['num_instances'])] = data
+        offset += chunk['num_instances']
+    return data_tensor
+
+# load_normalized_tensor reads all connectivity matrices of a dataset into
+# memory with NaNs replaced by 0s and normalized to have zero mean and a
+# maximal absolute value of 1, using the statistics kept in the index (old
+# pickle files and stores without statistics are sanitized and normalized chunk
+# by chunk after loading)
+# INPUT: name: store directory or pickle file (string)
+# OUTPUT: data_tensor: 4D tensor (np.array, float32)
+#         stats: statistics of the dataset (see combine_statistics in
+#                ccnn_preprocess.py), including the NaN report
+def load_normalized_tensor(name):
+    path = store_path(name)
+    if not is_store(path) or 'statistics' not in read_index(path):
+        return sanitize_and_normalize(np.asarray(load_tensor(path), dtype=np.float32))
+    index = read_index(path)
+    stats = index['statistics']
+    data_tensor = np.empty((index['num_instances'], index['num_roi'], index['num_roi'], 1),
+                           dtype=np.float32)
+    offset = 0
+    for chunk, data in iter_chunks(path):
+        normalize_chunk(data, stats, out=data_tensor[offset:(offset + chunk['num_instances'])])
+        offset += chunk['num_instances']
+    return data_tensor, stats
+
+# load_normalized_instances reads the given instances of a dataset (e.g. the
+# subjects added since a model was trained), normalized like in
+# load_normalized_tensor; only the chunks holding the instances are read
+# INPUT: name: store directory or pickle file (string)
+#        indices: instance numbers (positions in the dataset)
+# OUTPUT: data_tensor: 4D tensor (np.array, float32) of the instances, in the
+#                      order of indices
+def load_normalized_instances(name, indices):
+    indices = np.asarray(indices, dtype=np.int64)
+    path = store_path(name)
+    if not is_store(path) or 'statistics' not in read_index(path):
+        return load_normalized_tensor(path)[0][indices]
+    index = read_index(path)
+    stats = index['statistics']
+    data_tensor = np.empty((len(indices), index['num_roi'], index['num_roi'], 1), dtype=np.float32)
+    offset = 0
+    for chunk in index['chunks']:
+        selected = np.nonzero((indices >= offset) & (indices < offset + chunk['num_instances']))[0]
+        if len(selected):
+            data = np.load(os.path.join(path, chunk['file']), mmap_mode='r')
+            data_tensor[selected] = normalize_chunk(data[indices[selected] - offset], stats)
+        offset += chunk['num_instances']
+    return data_tensor
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+This script evaluates a set of trained networks on a set of datasets and
+computes the full source-by-target matrix of their performance (accuracy for
+classification, R^2 and mean absolute error for regression), e.g. the networks
+trained on the public dataset applied to the in-house dataset and NKI-RS subset
+(as 'ccnn_class_CONVconstFULLconst.py') and the networks trained on the in-house
+dataset applied to the public dataset (as 'ccnn_class_backtransfer.py'), in a
+single run:
+
+- every weights archive is read once, and every dataset is loaded (and
+  normalized) once,
+- the networks of the same architecture are evaluated together on each dataset:
+  their weights are stacked along a leading dimension and the layers are
+  computed as batched matrix products over the networks (see ensemble_output in
+  'ccnn_inference.py'), so that each batch of connectivity matrices is read
+  once for all of them.
+
+A cross-validation archive is evaluated as the ensemble of its folds (the mean
+of their predictions). Networks are only evaluated on datasets of the same
+number of ROIs, and on datasets with labels of their task (the other entries
+of the matrix are left empty). Note that a network evaluated on the dataset it
+was trained on gives its training performance.
+
+    python ccnn_transfer_matrix.py --weights weights_public weights_inhouse [--datasets public inhouse NKI-RS_subset]
+
+Other datasets are given as TENSOR_STORE:LABELS_FILE (the label columns of
+known labels files are looked up in DATASETS, other files hold class labels in
+the second column and ages in the third column). The matrix is saved
+into 'transfer_matrix.npz' (or the file given by --out), and the predictions are
+appended to the results store (condition 'transfer_WEIGHTS', see
+'ccnn_results.py').
+"""
+# Importing necessary libraries
+import argparse
+import os
+import time
+
+if __name__ == '__main__':
+    # Run as a script: threads are set before NumPy is imported (BLAS threads,
+    # see ccnn_session.py); importing the module leaves them to the caller
+    from ccnn_session import apply_threads
+    apply_threads()
+import numpy as np
+
+# Known datasets: tensor store, labels file and label column of each task
+DATASETS = {'public': ('CORR_tensor_public', 'labels_public.csv', {'class': 2}),
+            'public_regr': ('CORR_tensor_public_regr', 'labels_public_regr.csv', {'regr': 1}),
+            'inhouse': ('CORR_tensor_inhouse', 'labels_inhouse.txt', {'class': 1, 'regr': 2}),
+            'NKI-RS_subset': ('CORR_tensor_NKI-RS_subset', 'labels_NKI-RS_subset.csv', {'class': 1, 'regr': 2})}
+# Label columns of other labels files (layout of labels_inhouse.txt)
+OTHER_COLUMNS = {'class': 1, 'regr': 2}
+# Networks times instances evaluated in one pass (bounds the memory of the
+# hidden layers of the stacked networks)
+PASS_SIZE = 2048
+
+# %% ####################### Function definitions #############################
+
+# dataset_spec returns the name, tensor store, labels file and label columns of
+# a dataset given by its name (see DATASETS) or as TENSOR_STORE:LABELS_FILE
+def dataset_spec(dataset):
+    if dataset in DATASETS:
+        return (dataset,) + DATASETS[dataset]
+    if ':' not in dataset:
+        raise ValueError('unknown dataset %r: use one of %s or TENSOR_STORE:LABELS_FILE'
+                         % (dataset, ', '.join(sorted(DATASETS))))
+    tensor_store, labels_file = dataset.split(':', 1)
+    return os.path.basename(tensor_store.rstrip('/')), tensor_store, labels_file, label_columns(labels_file)
+
+# label_columns returns the label column of each task in a labels file: those
+# of the dataset of the file in DATASETS, or OTHER_COLUMNS for other files
+# (this is the lookup used by all tools reading labels files)
+def label_columns(labels_file):
+    for tensor_store, known_file, columns in DATASETS.values():
+        if os.path.basename(labels_file) == known_file:
+            return columns
+    return OTHER_COLUMNS
+
+# label_column returns the label column of a task in a labels file
+def label_column(labels_file, task):
+    columns = label_columns(labels_file)
+    if task not in columns:
+        raise ValueError('%s has no labels for the task %s' % (labels_file, task))
+    return columns[task]
+
+# source_name returns the name of a weights archive (or pickle file) used in the
+# matrix and the results store
+def source_name(path):
+    return os.path.splitext(os.path.basename(path.rstrip('/')))[0]
+
+# stacked_weights reads the weights of a source once, stacked along a leading
+# dimension (one network, or the folds of a cross-validation archive)
+# OUTPUT: dictionary of stacked weights and biases (float32)
+def stacked_weights(path):
+    from ccnn_weights import load_weights
+    weights = load_weights(path, mmap=False)
+    stacked = weights['layer1_weights'].ndim == 5
+    return dict((name, np.asarray(value if stacked else value[None], dtype=np.float32))
+                for name, value in weights.items())
+
+# architecture returns the layer names and shapes of stacked weights; sources
+# of the same architecture are evaluated together
+def architecture(weights):
+    return tuple(sorted((name, value.shape[1:]) for name, value in weights.items()))
+
+# group_sources groups the sources by architecture and stacks their weights
+# INPUT: sources: dictionary mapping source names to stacked weights
+# OUTPUT: list of (names, sizes, weights): names of the sources of a group,
+#         their numbers of networks, and their weights stacked together
+def group_sources(sources):
+    groups = {}
+    for name in sorted(sources):
+        groups.setdefault(architecture(sources[name]), []).append(name)
+    return [(names, [sources[name]['layer1_weights'].shape[0] for name in names],
+             dict((layer, np.concatenate([sources[name][layer] for name in names]))
+                  for layer in sources[names[0]]))
+            for names in groups.values()]
+
+# group_predictions evaluates the networks of a group on a dataset in a single
+# pass over the data, and averages the predictions of the networks of each
+# source (soft-max probabilities, or ages)
+# INPUT: data: 4D tensor (np.array) of normalized connectivity matrices
+#        sizes, weights: see group_sources
+# OUTPUT: list of 2D tensors (np.array) of predictions, one per source
+def group_predictions(data, sizes, weights):
+    from ccnn_inference import ensemble_predict
+    batch_size = max(1, PASS_SIZE // sum(sizes))
+    models = ensemble_predict(data, weights, batch_size)['models']
+    bounds = np.cumsum([0] + sizes)
+    return [np.mean(models[bounds[k]:bounds[k + 1]], axis=0) for k in range(len(sizes))]
+
+# score returns the accuracy in % (classification) or R^2 and the mean absolute
+# error (regression) of predictions, with the labels in the format of the
+# scripts (one-hot encoding, or a column of ages)
+def score(predictions, labels):
+    from ccnn_quantize import r_squared
+    if predictions.shape[1] > 1:
+        labels = (np.arange(predictions.shape[1]) == labels[:, None]).astype(np.float32)
+        return labels, {'accuracy': 100.0 * np.mean(np.argmax(predictions, 1) == np.argmax(labels, 1))}
+    return labels[:, None], {'r2': r_squared(labels, predictions[:, 0]),
+                             'mae': np.mean(np.abs(predictions[:, 0] - labels))}
+
+# %% ###################### Evaluating the matrix ##############################
+
+if __name__ == '__main__':
+    from ccnn_options import output_name
+    from ccnn_results import append_results
+    from ccnn_tensor_store import check_subjects, load_normalized_tensor
+
+    parser = argparse.ArgumentParser(description='Source-by-target performance matrix of trained networks.')
+    parser.add_argument('--weights', nargs='+', required=True, help='weights archives (or old pickle files)')
+    parser.add_argument('--datasets', nargs='+', default=['public', 'inhouse', 'NKI-RS_subset'],
+                        help='dataset names (%s) or TENSOR_STORE:LABELS_FILE' % ', '.join(sorted(DATASETS)))
+    parser.add_argument('--out', default='transfer_matrix.npz')
+    args = parser.parse_args()
+
+    start = time.time()
+    sources = dict((source_name(path), stacked_weights(path)) for path in args.weights)
+    if len(sources) != len(args.weights):
+        parser.error('the weights must have different names')
+    names = sorted(sources)
+    groups = group_sources(sources)
+    print('%d networks of %d sources (%d architectures) read in %.1f s' % (
+        sum(w['layer1_weights'].shape[0] for w in sources.values()), len(sources), len(groups),
+        time.time() - start))
+
+    specs = [dataset_spec(dataset) for dataset in args.datasets]
+    metrics = ['accuracy', 'r2', 'mae']
+    matrix = dict((metric, np.full((len(names), len(specs)), np.nan)) for metric in metrics)
+    for j, (dataset, tensor_store, labels_file, columns) in enumerate(specs):
+        load_start = time.time()
+        data_tensor, data_stats = load_normalized_tensor(tensor_store)
+        labels_csv = np.loadtxt(labels_file, delimiter=',')
+        check_subjects(tensor_store, labels_csv[:, 0])
+        eval_start = time.time()
+        for group_names, sizes, weights in groups:
+            task = 'class' if weights['layer4_weights'].shape[-1] > 1 else 'regr'
+            if weights['layer1_weights'].shape[2] != data_tensor.shape[1] or task not in columns:
+                continue
+            labels = labels_csv[:, columns[task]]
+            for name, predictions in zip(group_names, group_predictions(data_tensor, sizes, weights)):
+                test_labels, values = score(predictions, labels)
+                for metric, value in values.items():
+                    matrix[metric][names.index(name), j] = value
+                append_results('transfer_%s' % name, dataset, None, labels_csv[:, 0], test_labels, predictions)
+        print('%s: loaded in %.1f s, evaluated in %.1f s' % (dataset, eval_start - load_start,
+                                                            time.time() - eval_start))
+        del data_tensor
+
+    datasets = [spec[0] for spec in specs]
+    for metric, title in [('accuracy', 'Accuracy (%)'), ('r2', 'R^2'), ('mae', 'Mean absolute error')]:
+        if np.all(np.isnan(matrix[metric])):
+            continue
+        print('\n%s (rows: source weights, columns: target datasets)' % title)
+        print('%-32s' % '' + ''.join('%16s' % dataset for dataset in datasets))
+        for i, name in enumerate(names):
+            if np.all(np.isnan(matrix[metric][i])):
+                continue
+            print('%-32s' % name + ''.join('%16s' % ('-' if np.isnan(value) else '%.3f' % value)
+                                           for value in matrix[metric][i]))
+    out = output_name(args.out)
+    np.savez(out, sources=np.array(names), datasets=np.array(datasets), **matrix)
+    print('\nMatrix saved into %s in %.1f s' % (out, time.time() - start))
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements a bank of pretrained (source) weights held in shared
+memory, so that the workers running folds or seeds of the transfer scripts in
+parallel do not each read their own copy of 'weights_public',
+'weights_public_regr' or 'weights_inhouse'. The weights of an archive (see
+'ccnn_weights.py') are copied once into a read-only shared-memory segment, and
+the workers attach to the segment and use its arrays without copying them.
+
+Segments are identified by the archive and a fingerprint of its files (names,
+sizes and modification times, and the content of the index), thus a worker
+never attaches to the weights of an archive that has been rewritten since they
+were published, and attaching does not read the weights. The published segments
+are listed in a registry file ('ccnn_weight_bank.json' in the temporary
+directory, or the file given by the CCNN_WEIGHT_BANK environment variable),
+updated under a lock, so that several archives can be published or released
+concurrently.
+
+The scripts read the source weights with bank_weights, which falls back to
+reading (memory-mapping) the archive if its weights have not been published.
+Weights are published and released by running this module as a script:
+
+    python ccnn_weight_bank.py publish weights_public weights_public_regr
+    python ccnn_weight_bank.py list
+    python ccnn_weight_bank.py release weights_public weights_public_regr
+"""
+# Importing necessary libraries
+import fcntl
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+from ccnn_weights import archive_base, archive_path, is_archive, load_weights
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:   # Python < 3.8: the weights are always read from the archives
+    shared_memory = None
+
+ALIGNMENT = 64   # arrays in a segment start at multiples of 64 bytes
+HEADER = struct.Struct('<Q')   # length of the JSON header of a segment
+
+# Segments attached by this process (they have to stay open as long as their
+# arrays are used)
+_segments = {}
+
+# %% ####################### Function definitions #############################
+
+# registry_file returns the name of the registry of published segments
+def registry_file():
+    return os.environ.get('CCNN_WEIGHT_BANK', os.path.join(tempfile.gettempdir(), 'ccnn_weight_bank.json'))
+
+def _read_registry():
+    if not os.path.isfile(registry_file()):
+        return {}
+    with open(registry_file(), 'r') as f:
+        return json.load(f)
+
+# The registry is read, modified and written by one process at a time
+@contextmanager
+def _locked():
+    with open(registry_file() + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _write_registry(registry):
+    tmp_file = '%s.%d.tmp' % (registry_file(), os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(registry, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, registry_file())
+
+# _weight_files lists the files holding the weights of an archive: its arrays
+# (full, delta or sparse), its index, and the files of its base archive, whose
+# arrays the delta encoded ones are decoded against
+def _weight_files(path):
+    archive = archive_path(path)
+    if not is_archive(archive):
+        return [archive + '.pickle']
+    files = [os.path.join(archive, name) for name in sorted(os.listdir(archive))
+             if name.endswith(('.npy', '.delta', '.sparse.npz')) or name == 'index.json']
+    base = archive_base(archive)
+    return files + (_weight_files(base) if base is not None else [])
+
+# checksum computes the SHA-1 checksum of the files of a weights archive (or of
+# an old pickle file)
+def checksum(path):
+    sha = hashlib.sha1()
+    for name in _weight_files(path):
+        sha.update(os.path.basename(name).encode('utf-8'))
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+# fingerprint identifies the files of a weights archive without reading the
+# weights: SHA-1 of the names, sizes and modification times of the files and
+# of the content of the index
+def fingerprint(path):
+    sha = hashlib.sha1()
+    for name in _weight_files(path):
+        info = os.stat(name)
+        sha.update(('%s:%d:%d;' % (os.path.basename(name), info.st_size, info.st_mtime_ns)).encode('utf-8'))
+        if os.path.basename(name) == 'index.json':
+            with open(name, 'rb') as f:
+                sha.update(f.read())
+    return sha.hexdigest()
+
+# bank_key returns the registry key of the weights of an archive (and fold)
+# OUTPUT: key (string) and name of the shared-memory segment (string)
+def bank_key(path, fold=None, digest=None):
+    if digest is None:
+        digest = fingerprint(path)
+    key = '%s#%s#%s' % (os.path.abspath(archive_path(path)), '' if fold is None else fold, digest)
+    return key, 'ccnn_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:24]
+
+# The resource tracker of Python would remove the segment when the process that
+# created or attached it exits; segments of the bank live until they are
+# released
+def _untrack(segment):
+    try:
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    except Exception:
+        pass
+
+def _views(segment):
+    length, = HEADER.unpack_from(segment.buf, 0)
+    header = json.loads(bytes(segment.buf[HEADER.size:(HEADER.size + length)]).decode('utf-8'))
+    weights = {}
+    for layer, entry in header['layers'].items():
+        array = np.ndarray(entry['shape'], dtype=np.dtype(entry['dtype']), buffer=segment.buf,
+                           offset=entry['offset'])
+        array.flags.writeable = False
+        weights[layer] = array
+    return weights
+
+# publish copies the weights of an archive into a shared-memory segment (if they
+# have not been published yet) and registers the segment; int8 weights (see
+# ccnn_quantize.py) keep their type, weights pruned by rows (see
+# ccnn_prune.py) are published as dense arrays, other weights as float32
+# INPUT: path: archive directory or old pickle file (string)
+#        fold: fold number of a cross-validation archive (see load_weights)
+# OUTPUT: name of the shared-memory segment
+def publish(path, fold=None):
+    if shared_memory is None:
+        raise RuntimeError('shared memory is not supported by this Python version')
+    with _locked():
+        digest = fingerprint(path)
+        key, name = bank_key(path, fold, digest)
+        try:
+            segment = shared_memory.SharedMemory(name=name)
+            _untrack(segment)
+            segment.close()
+            return name
+        except FileNotFoundError:
+            pass
+
+        weights = {}
+        for layer, value in load_weights(path, fold=fold).items():
+            value = np.asarray(value)
+            weights[layer] = value if value.dtype == np.int8 else np.asarray(value, dtype=np.float32)
+        layers, offset = {}, 0
+        for layer, value in weights.items():
+            layers[layer] = {'shape': list(value.shape), 'dtype': str(value.dtype), 'offset': offset}
+            offset += -(-value.nbytes // ALIGNMENT) * ALIGNMENT
+        # The offsets are shifted by the (aligned) size of the header, leaving
+        # room for the longer offsets in the final header
+        header = json.dumps({'key': key, 'layers': layers}).encode('utf-8')
+        start = -(-(HEADER.size + len(header) + 256) // ALIGNMENT) * ALIGNMENT
+        for entry in layers.values():
+            entry['offset'] += start
+        header = json.dumps({'key': key, 'layers': layers}).encode('utf-8')
+
+        segment = shared_memory.SharedMemory(name=name, create=True, size=max(start + offset, 1))
+        _untrack(segment)
+        HEADER.pack_into(segment.buf, 0, len(header))
+        segment.buf[HEADER.size:(HEADER.size + len(header))] = header
+        for layer, value in weights.items():
+            np.ndarray(value.shape, dtype=value.dtype, buffer=segment.buf,
+                       offset=layers[layer]['offset'])[...] = value
+        segment.close()
+
+        registry = _read_registry()
+        registry[key] = {'path': os.path.abspath(archive_path(path)), 'fold': fold,
+                         'fingerprint': digest, 'segment': name, 'bytes': start + offset}
+        _write_registry(registry)
+        return name
+
+# attach returns the weights of an archive from the shared-memory segment they
+# were published into, without copying them
+# OUTPUT: dictionary mapping layer names to read-only np.arrays
+def attach(path, fold=None):
+    key, name = bank_key(path, fold)
+    if name not in _segments:
+        segment = shared_memory.SharedMemory(name=name)
+        _untrack(segment)
+        _segments[name] = segment
+    return _views(_segments[name])
+
+# bank_weights reads weights and bias terms from the bank if they have been
+# published, and from the archive otherwise (arguments as in load_weights)
+def bank_weights(path, layers=None, fold=None):
+    if shared_memory is not None:
+        try:
+            weights = attach(path, fold)
+        except FileNotFoundError:
+            weights = None
+        if weights is not None:
+            if layers is None:
+                return weights
+            missing = [layer for layer in layers if layer not in weights]
+            if missing:
+                raise KeyError('%s not stored in %s' % (', '.join(missing), path))
+            return dict((layer, weights[layer]) for layer in layers)
+    return load_weights(path, layers=layers, fold=fold)
+
+# release removes the segments of an archive (every fold and fingerprint) from
+# shared memory and from the registry
+# OUTPUT: number of removed segments
+def release(path):
+    with _locked():
+        registry = _read_registry()
+        target = os.path.abspath(archive_path(path))
+        removed = 0
+        for key, entry in list(registry.items()):
+            if entry['path'] != target:
+                continue
+            try:
+                # unlink also removes the segment from the resource tracker
+                segment = shared_memory.SharedMemory(name=entry['segment'])
+                segment.close()
+                segment.unlink()
+                removed += 1
+            except FileNotFoundError:
+                pass
+            del registry[key]
+        _write_registry(registry)
+    return removed
+
+# %% ####################### Managing the bank ################################
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('publish', 'release', 'list'):
+        print('usage: python ccnn_weight_bank.py publish|release WEIGHTS ... | list')
+        sys.exit(1)
+    if sys.argv[1] == 'publish':
+        for path in sys.argv[2:]:
+            print('%s published into %s' % (path, publish(path)))
+    elif sys.argv[1] == 'release':
+        for path in sys.argv[2:]:
+            print('%s: %d segment(s) released' % (path, release(path)))
+    else:
+        for key, entry in sorted(_read_registry().items()):
+            print('%s (fold %s, %s): %s, %.1f MB' % (entry['path'], entry['fold'], entry['fingerprint'][:8],
+                                                    entry['segment'], entry['bytes'] / 1024.0**2))
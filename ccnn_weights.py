@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+This module implements the weights archive used to store the weights and bias
+terms of the connectome-convolutional neural network. An archive is a directory
+(e.g. 'weights_public') containing one float32 (int8 if quantized) .npy file
+per layer (and per fold of the cross-validation) and an index ('index.json')
+describing the stored arrays. In the cross-validation scripts each fold is
+written as soon as it is finished, and arrays are memory-mapped when read, so
+that consumers only touch the layers and folds they actually need.
+
+The arrays of an archive created with a base archive (e.g. the fold weights
+of the transfer scripts, with base 'weights_public') are stored relative to the
+weights of the base: layers equal to those of the base (e.g. the constant
+convolutional layers) are stored as references to the base, and layers
+fine-tuned from the base as the XOR of their bits with those of the base, which
+are zero in the sign, exponent and leading mantissa bits of slightly changed
+weights and are compressed by zlib (losslessly). load_weights reconstructs the
+weights transparently; the checksum of each base array is verified on reading.
+
+Weights pruned by rows (see 'ccnn_prune.py') are stored in a sparse format:
+the indices of the remaining rows of the weights reshaped into a matrix
+[inputs, outputs] and the values of these rows. load_weights returns them as
+dense arrays, or as SparseRows (used by the forward pass in
+'ccnn_inference.py') if asked to.
+
+Weights saved previously into 'weights_*.pickle' files can still be read with
+load_weights, or converted into archives by running this module as a script:
+
+    python ccnn_weights.py weights_public.pickle weights_inhouse.pickle ...
+
+Archives written without a base are re-encoded relative to a base by
+
+    python ccnn_weights.py --base weights_public weights_ccnn_class_CONVinitFULLinit_inhouse ...
+"""
+# Importing necessary libraries
+import argparse
+import json
+import os
+import zlib
+from collections import namedtuple
+
+import numpy as np
+from six.moves import cPickle as pickle
+
+# 'layer2_weights_u' and 'layer2_weights_v' are the low-rank factors of
+# 'layer2_weights' (see ccnn_compress.py), stored instead of the full weights;
+# the '*_scale' arrays are the per-channel scales of weights quantized to int8
+# (see ccnn_quantize.py)
+LAYER_NAMES = ['layer1_weights', 'layer1_biases', 'layer2_weights',
+               'layer2_weights_u', 'layer2_weights_v', 'layer2_biases',
+               'layer3_weights', 'layer3_biases', 'layer4_weights', 'layer4_biases',
+               'layer1_weights_scale', 'layer2_weights_scale', 'layer2_weights_u_scale',
+               'layer2_weights_v_scale', 'layer3_weights_scale', 'layer4_weights_scale']
+
+INDEX_FILE = 'index.json'
+ARCHIVE_FORMAT = 'ccnn-weights'
+ARCHIVE_VERSION = 2
+
+# Fine-tuned layers are stored as deltas only if these are compressed below this
+# fraction of the size of the array
+DELTA_MAX_RATIO = 0.9
+
+# %% ####################### Function definitions #############################
+
+# archive_path returns the archive directory belonging to a weights file name,
+# i.e. strips the '.pickle' extension of the old file names
+# INPUT: name: name of the archive or of the old pickle file (string)
+# OUTPUT: path of the archive directory (string)
+def archive_path(name):
+    if name.endswith('.pickle'):
+        return name[:-len('.pickle')]
+    return name
+
+def _index_file(path):
+    return os.path.join(path, INDEX_FILE)
+
+def _array_file(layer, fold):
+    if fold is None:
+        return layer + '.npy'
+    return '%s.fold%d.npy' % (layer, fold)
+
+def _delta_file(array_file):
+    return array_file[:-len('.npy')] + '.delta'
+
+def _sparse_file(array_file):
+    return array_file[:-len('.npy')] + '.sparse.npz'
+
+# SparseRows holds weights whose rows (input units) have been pruned: the shape
+# of the dense weights, the indices of the remaining rows of the weights
+# reshaped into a matrix [inputs, outputs], and the values of these rows
+class SparseRows(namedtuple('SparseRows', ['shape', 'rows', 'values'])):
+    __slots__ = ()
+
+    # dense returns the dense weights (the pruned rows being 0s)
+    def dense(self):
+        full = np.zeros((int(np.prod(self.shape[:-1])), self.shape[-1]), dtype=self.values.dtype)
+        full[self.rows] = self.values
+        return full.reshape(self.shape)
+
+# sparse_rows converts dense weights into SparseRows, keeping the rows that are
+# not all 0s
+def sparse_rows(value):
+    value = np.asarray(value, dtype=np.float32)
+    matrix = value.reshape(-1, value.shape[-1])
+    rows = np.nonzero(np.any(matrix != 0, axis=1))[0].astype(np.int32)
+    return SparseRows(tuple(value.shape), rows, matrix[rows])
+
+def _read_index(path):
+    with open(_index_file(path), 'r') as f:
+        return json.load(f)
+
+# The index is replaced atomically, so that readers never see a fold whose
+# arrays have not been written completely
+def _write_index(path, index):
+    tmp_file = _index_file(path) + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, _index_file(path))
+
+def _new_index(num_folds, base=None):
+    return {'format': ARCHIVE_FORMAT, 'version': ARCHIVE_VERSION,
+            'dtype': 'float32', 'num_folds': num_folds, 'folds': [],
+            'layers': {}, 'base': base, 'encoding': {}}
+
+# is_archive checks whether path is a weights archive directory
+def is_archive(path):
+    return os.path.isfile(_index_file(path))
+
+# The base is stored relative to the directory containing the archive
+def _base_path(path, index):
+    if index.get('base') is None:
+        return None
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(path)), index['base']))
+
+def _base_array(base, layer, cache):
+    if layer not in cache:
+        stored = load_weights(base, layers=[layer]) if layer in _stored_layers(base) else {}
+        cache[layer] = (np.ascontiguousarray(stored[layer], dtype=np.float32)
+                        if layer in stored else None)
+    return cache[layer]
+
+def _stored_layers(path):
+    legacy = _legacy_file(path)
+    if legacy is not None:
+        return list(_load_pickle(legacy).keys())
+    return list(_read_index(archive_path(path))['layers'].keys())
+
+def _crc32(value):
+    return zlib.crc32(np.ascontiguousarray(value).view(np.uint8).reshape(-1)) & 0xffffffff
+
+# The XOR of the bits of the weights with those of the base is split into byte
+# planes (all sign/exponent bytes first, and so on), which compress much better
+# than interleaved bytes
+def _encode_delta(value, base):
+    bits = np.bitwise_xor(value.view(np.uint32), base.view(np.uint32))
+    planes = np.ascontiguousarray(bits.reshape(-1).view(np.uint8).reshape(-1, 4).T)
+    return zlib.compress(planes.tobytes(), 6)
+
+def _decode_delta(data, base):
+    planes = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(4, -1)
+    bits = np.ascontiguousarray(planes.T).view(np.uint32).reshape(base.shape)
+    return np.bitwise_xor(bits, base.view(np.uint32)).view(np.float32)
+
+# create_archive creates an empty weights archive, removing the arrays of any
+# archive previously stored under the same name
+# INPUT: path: archive directory (string)
+#        num_folds: number of cross-validation folds that will be stored, or
+#                   None if the archive holds a single set of weights
+#        base: archive (or old pickle file) holding a single set of weights
+#              the arrays are stored relative to (None = full arrays)
+def create_archive(path, num_folds=None, base=None):
+    path = archive_path(path)
+    if is_archive(path):
+        for name in os.listdir(path):
+            if name.endswith(('.npy', '.delta', '.sparse.npz')):
+                os.remove(os.path.join(path, name))
+    elif not os.path.isdir(path):
+        os.makedirs(path)
+    if base is not None:
+        if archive_folds(base) is not None:
+            raise ValueError('the base %s holds the weights of several folds' % base)
+        base = os.path.relpath(os.path.abspath(archive_path(base)), os.path.dirname(os.path.abspath(path)))
+    _write_index(path, _new_index(num_folds, base))
+
+# _save_arrays stores the arrays as references to the base, as deltas or as
+# full arrays, whichever is the smallest (SparseRows in the sparse format)
+def _save_arrays(path, fold, weights):
+    path = archive_path(path)
+    if not is_archive(path):
+        create_archive(path, None if fold is None else 0)
+    index = _read_index(path)
+    encoding = index.setdefault('encoding', {})
+    base = _base_path(path, index)
+    base_arrays = {}
+    for layer, value in weights.items():
+        array_file = _array_file(layer, fold)
+        for name in (array_file, _delta_file(array_file), _sparse_file(array_file)):
+            if os.path.isfile(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+        encoding.pop(array_file, None)
+        if isinstance(value, SparseRows):
+            np.savez(os.path.join(path, _sparse_file(array_file)),
+                     rows=np.asarray(value.rows, dtype=np.int32),
+                     values=np.asarray(value.values, dtype=np.float32))
+            encoding[array_file] = {'kind': 'sparse', 'num_rows': int(len(value.rows))}
+            index['layers'][layer] = {'shape': list(value.shape), 'dtype': 'float32'}
+            continue
+        value = np.asarray(value)
+        if value.dtype != np.int8:
+            value = np.ascontiguousarray(value, dtype=np.float32)
+        base_value = None if base is None else _base_array(base, layer, base_arrays)
+        if base_value is not None and base_value.shape == value.shape and value.dtype == np.float32:
+            if np.array_equal(value.view(np.uint32), base_value.view(np.uint32)):
+                encoding[array_file] = {'kind': 'reference', 'base_crc32': _crc32(base_value)}
+            else:
+                delta = _encode_delta(value, base_value)
+                if len(delta) < DELTA_MAX_RATIO * value.nbytes:
+                    with open(os.path.join(path, _delta_file(array_file)), 'wb') as f:
+                        f.write(delta)
+                    encoding[array_file] = {'kind': 'delta', 'base_crc32': _crc32(base_value)}
+        if array_file not in encoding:
+            np.save(os.path.join(path, array_file), value)
+        index['layers'][layer] = {'shape': list(value.shape), 'dtype': str(value.dtype)}
+    if fold is not None and fold not in index['folds']:
+        index['folds'] = sorted(index['folds'] + [fold])
+        index['num_folds'] = max(index['num_folds'] or 0, len(index['folds']))
+    _write_index(path, index)
+
+# save_weights stores a single set of weights and biases (e.g. the result of
+# training on the whole source dataset) into an archive
+# INPUT: path: archive directory (string)
+#        weights: dictionary mapping layer names (see LAYER_NAMES) to np.arrays
+def save_weights(path, weights):
+    create_archive(path)
+    _save_arrays(path, None, weights)
+
+# save_fold_weights stores the weights and biases learned in a given fold of the
+# cross-validation, without touching the folds stored previously
+# INPUT: path: archive directory (string)
+#        fold: number of the given fold (starting from 0)
+#        weights: dictionary mapping layer names (see LAYER_NAMES) to np.arrays
+def save_fold_weights(path, fold, weights):
+    _save_arrays(path, int(fold), weights)
+
+# archive_folds lists the cross-validation folds stored in an archive
+# INPUT: path: archive directory or old pickle file (string)
+# OUTPUT: list of fold numbers, or None if the archive holds a single set of
+#         weights
+def archive_folds(path):
+    legacy = _legacy_file(path)
+    if legacy is not None:
+        save = _load_pickle(legacy)
+        if not _pickle_has_folds(save):
+            return None
+        return list(range(save['layer3_weights'].shape[0]))
+    index = _read_index(archive_path(path))
+    if index['num_folds'] is None:
+        return None
+    return index['folds']
+
+def _legacy_file(path):
+    if path.endswith('.pickle') and os.path.isfile(path):
+        return path
+    if not is_archive(archive_path(path)) and os.path.isfile(archive_path(path) + '.pickle'):
+        return archive_path(path) + '.pickle'
+    return None
+
+def _load_pickle(pickle_file):
+    with open(pickle_file, 'rb') as f:
+        return pickle.load(f)
+
+# In the old pickle files, weights saved in the cross-validation scripts have an
+# additional leading (fold) dimension
+def _pickle_has_folds(save):
+    return save['layer3_weights'].ndim == 3
+
+# load_weights reads weights and bias terms from an archive or, if there is no
+# archive with the given name, from the old 'weights_*.pickle' file
+# INPUT: path: archive directory or pickle file (string)
+#        layers: list of layer names to load (default: all stored layers)
+#        fold: fold number to load from a cross-validation archive; if None,
+#              the arrays of all folds are stacked along a leading dimension
+#              (as in the old pickle files)
+#        mmap: if True, arrays are memory-mapped instead of read into memory
+#        sparse: if True, weights stored in the sparse format are returned as
+#                SparseRows (not if the arrays of all folds are stacked)
+# OUTPUT: weights: dictionary mapping layer names to np.arrays
+def load_weights(path, layers=None, fold=None, mmap=True, sparse=False):
+    legacy = _legacy_file(path)
+    if legacy is not None:
+        save = _load_pickle(legacy)
+        if layers is None:
+            layers = [layer for layer in LAYER_NAMES if layer in save]
+        if fold is not None and _pickle_has_folds(save):
+            return dict((layer, save[layer][fold]) for layer in layers)
+        return dict((layer, save[layer]) for layer in layers)
+
+    path = archive_path(path)
+    index = _read_index(path)
+    if layers is None:
+        layers = [layer for layer in LAYER_NAMES if layer in index['layers']]
+    missing = [layer for layer in layers if layer not in index['layers']]
+    if missing:
+        raise KeyError('%s not stored in %s' % (', '.join(missing), path))
+    mmap_mode = 'r' if mmap else None
+    base_arrays = {}
+
+    def load_array(layer, fold, sparse=False):
+        array_file = _array_file(layer, fold)
+        stored = index.get('encoding', {}).get(array_file)
+        if stored is None:
+            return np.load(os.path.join(path, array_file), mmap_mode=mmap_mode)
+        if stored['kind'] == 'sparse':
+            with np.load(os.path.join(path, _sparse_file(array_file))) as data:
+                value = SparseRows(tuple(index['layers'][layer]['shape']), data['rows'], data['values'])
+            return value if sparse else value.dense()
+        base_value = _base_array(_base_path(path, index), layer, base_arrays)
+        if base_value is None or _crc32(base_value) != stored['base_crc32']:
+            raise ValueError('%s of %s is stored relative to %s, whose weights have changed'
+                             % (array_file, path, _base_path(path, index)))
+        if stored['kind'] == 'reference':
+            return base_value
+        with open(os.path.join(path, _delta_file(array_file)), 'rb') as f:
+            return _decode_delta(f.read(), base_value)
+
+    weights = {}
+    for layer in layers:
+        if index['num_folds'] is None:
+            weights[layer] = load_array(layer, None, sparse)
+        elif fold is not None:
+            if fold not in index['folds']:
+                raise KeyError('fold %d not stored in %s' % (fold, path))
+            weights[layer] = load_array(layer, fold, sparse)
+        else:
+            weights[layer] = np.stack([load_array(layer, k) for k in index['folds']])
+    return weights
+
+# archive_base returns the base archive of an archive (None if its arrays are
+# stored in full)
+def archive_base(path):
+    if _legacy_file(path) is not None:
+        return None
+    path = archive_path(path)
+    return _base_path(path, _read_index(path))
+
+# archive_size returns the number of bytes stored in an archive (without its
+# base)
+def archive_size(path):
+    path = archive_path(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+               if os.path.isfile(os.path.join(path, name)))
+
+# convert_pickle converts an old 'weights_*.pickle' file into an archive
+# INPUT: pickle_file: name of the pickle file (string)
+#        path: archive directory (default: the pickle file name without the
+#              '.pickle' extension)
+#        base: base archive of cross-validation weights (see create_archive)
+# OUTPUT: path of the archive directory
+def convert_pickle(pickle_file, path=None, base=None):
+    if path is None:
+        path = archive_path(pickle_file)
+    save = _load_pickle(pickle_file)
+    layers = [layer for layer in LAYER_NAMES if layer in save]
+    if _pickle_has_folds(save):
+        num_folds = save['layer3_weights'].shape[0]
+        create_archive(path, num_folds, base)
+        for fold in range(num_folds):
+            save_fold_weights(path, fold, dict((layer, save[layer][fold]) for layer in layers))
+    else:
+        save_weights(path, dict((layer, save[layer]) for layer in layers))
+    return path
+
+# rebase_archive re-encodes the cross-validation weights of an archive
+# relative to a base archive (see create_archive), in place
+# OUTPUT: number of bytes stored before and after
+def rebase_archive(path, base):
+    path = archive_path(path)
+    size = archive_size(path)
+    folds = archive_folds(path)
+    if folds is None:
+        raise ValueError('%s holds a single set of weights, not those of folds' % path)
+    fold_weights = [load_weights(path, fold=fold, mmap=False) for fold in folds]
+    num_folds = _read_index(path)['num_folds']
+    create_archive(path, num_folds, base)
+    for fold, weights in zip(folds, fold_weights):
+        save_fold_weights(path, fold, weights)
+    return size, archive_size(path)
+
+# %% ######################## Converting old files ############################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Conversion of weights into archives.')
+    parser.add_argument('weights', nargs='+', help='old pickle files, or archives (with --base)')
+    parser.add_argument('--base', default=None,
+                        help='store the weights of the folds relative to this archive')
+    args = parser.parse_args()
+
+    for name in args.weights:
+        if name.endswith('.pickle'):
+            print('Converting %s to %s ...' % (name, convert_pickle(name, base=args.base)))
+        elif args.base is not None:
+            size, new_size = rebase_archive(name, args.base)
+            print('%s stored relative to %s: %.1f MB -> %.1f MB' % (
+                name, args.base, size / 1024.0**2, new_size / 1024.0**2))
+        else:
+            print('%s is not a pickle file, give --base to re-encode an archive' % name)